@@ -1,353 +1,126 @@
-import os
-
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy.exc import IntegrityError
-
-from forms import UserAddForm, LoginForm, UserEditForm, MessageForm
-from models import db, connect_db, User, Message, Follows
-from functools import wraps
-import pdb
-
-CURR_USER_KEY = "curr_user"
-
-app = Flask(__name__)
-
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
-
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-toolbar = DebugToolbarExtension(app)
-
-connect_db(app)
-
-
-@app.before_request
-def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
-
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
-
-    else:
-        g.user = None
-
-
-def do_login(user):
-    """Log in user."""
-
-    session[CURR_USER_KEY] = user.id
-
-
-def do_logout():
-    """Logout user."""
-
-    if CURR_USER_KEY in session:
-        del session[CURR_USER_KEY]
-
-
-def redirect_if_missing(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        if not g.user:
-            flash("Access unauthorized.", "danger")
-            return redirect("/")
-        return func(*args,**kwargs)
-    return wrapper
-
-@app.route('/signup', methods=["GET", "POST"])
-def signup():
-    """Handle user signup.
-
-    Create new user and add to DB. Redirect to home page.
-
-    If form not valid, present form.
-
-    If the there already is a user with that username: flash message
-    and re-present form.
-    """
-
-    form = UserAddForm()
-
-    if form.validate_on_submit():
-        try:
-            user = User.signup(
-                username=form.username.data,
-                password=form.password.data,
-                email=form.email.data,
-                image_url=form.image_url.data or User.image_url.default.arg,
-                header_image_url=form.header_image_url.data or User.header_image_url.default.arg,
-                bio=form.bio.data or User.bio.default.arg,
-            )
-            db.session.commit()
-
-        except IntegrityError:
-            flash("Username already taken", 'danger')
-            return render_template('users/signup.html', form=form)
-
-        do_login(user)
-
-        return redirect("/")
-
-    else:
-        return render_template('users/signup.html', form=form)
-
-
-@app.route('/login', methods=["GET", "POST"])
-def login():
-    """Handle user login."""
-
-    form = LoginForm()
-
-    if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
-
-        if user:
-            do_login(user)
-            flash(f"Hello, {user.username}!", "success")
-            return redirect("/")
-
-        flash("Invalid credentials.", 'danger')
-
-    return render_template('users/login.html', form=form)
-
-
-@app.route('/logout')
-def logout():
-    """Handle logout of user."""
-
-    do_logout()
-    flash("You have successfully logged out")
-    return redirect('/login')
-
-
-##############################################################################
-# General user routes:
-
-@app.route('/users')
-def list_users():
-    """Page with listing of users.
-
-    Can take a 'q' param in querystring to search by that username.
-    """
+"""Warbler application factory.
 
-    search = request.args.get('q')
+    app = create_app('production')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+Profiles are in config.py; with no argument the profile is taken from
+FLASK_ENV (Flask's own default is production). That app is also this
+module's `app`, for servers and the flask CLI; it's only built when first
+looked up, so importing create_app doesn't build it too.
+"""
 
-    return render_template('users/index.html', users=users)
-
-
-@app.route('/users/<int:user_id>')
-def users_show(user_id):
-    """Show user profile."""
-
-    user = User.query.get_or_404(user_id)
-
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
-
-@app.route('/users/<int:user_id>/following')
-@redirect_if_missing
-def show_following(user_id):
-    """Show list of people this user is following."""
-
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
-
-
-@app.route('/users/<int:user_id>/followers')
-@redirect_if_missing
-def users_followers(user_id):
-    """Show list of followers of this user."""
-
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
-
-@app.route('/users/<int:user_id>/likes')
-@redirect_if_missing
-def users_likes(user_id):
-    """Show list of liked messages for this user."""
-
-    user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html',user=user)
-
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
-@redirect_if_missing
-def add_follow(follow_id):
-    """Add a follow for the currently-logged-in user."""
-
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
-
-    return redirect(f"/users/{g.user.id}/following")
-
-
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
-@redirect_if_missing
-def stop_following(follow_id):
-    """Have currently-logged-in-user stop following this user."""
-
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
-
-    return redirect(f"/users/{g.user.id}/following")
-
-@app.route('/users/toggle_like/<int:like_id>', methods=['POST'])
-@redirect_if_missing
-def add_like(like_id):
-    """Toggle like for the currently-logged-in user."""
-    liked_message = Message.query.get(like_id)
-    if liked_message in g.user.likes:
-        g.user.likes.remove(liked_message)
-    else:
-        g.user.likes.append(liked_message)
-    db.session.commit()
-    if request.referrer:
-        return redirect(f"{request.referrer}")
-    return redirect('/')
-
-@app.route('/users/profile', methods=["GET", "POST"])
-@redirect_if_missing
-def profile():
-    """Update profile for current user."""
-    form = UserEditForm(obj=g.user)
-    if form.validate_on_submit():
-        user = User.authenticate(g.user.username,
-                                 form.password.data)
-        if user:
-            user.username = form.username.data
-            user.email = form.email.data
-            user.image_url = form.image_url.data
-            user.header_image_url = form.header_image_url.data
-            user.bio = form.bio.data
-            db.session.add(user)
-            db.session.commit()
-            return redirect(f"/users/{user.id}")
-        flash('Incorrect password.', "danger")
-        return redirect('/users/profile')
-    return render_template('users/edit.html',form=form)
-
-
-@app.route('/users/delete', methods=["POST"])
-@redirect_if_missing
-def delete_user():
-    """Delete user."""
-
-    do_logout()
-
-    db.session.delete(g.user)
-    db.session.commit()
-
-    return redirect("/signup")
-
-
-##############################################################################
-# Messages routes:
-
-@app.route('/messages/new', methods=["GET", "POST"])
-@redirect_if_missing
-def messages_add():
-    """Add a message:
+import os
 
-    Show form if GET. If valid, update message and redirect to user page.
+from flask import Flask
+
+from config import CONFIGS
+from models import db, connect_db
+from snowflake import init_snowflake
+from replicas import init_replicas
+from queries import init_queries
+from profiler import init_profiler
+from slow_queries import init_slow_queries
+from archive import init_archive
+from export import init_export
+from availability import init_availability
+from trending import init_trending
+from follow_graph import init_follow_graph
+from images import init_images
+from ratelimit import init_ratelimit
+from like_counts import init_like_counts
+from entity_cache import init_entity_cache
+from live import init_live
+from explore import init_explore
+from notifications import init_notifications
+from group_commit import init_group_commit
+from nearby import init_nearby
+from partitions import init_partitions
+from typeahead import init_typeahead
+from views import bp, CURR_USER_KEY
+
+
+def create_app(config=None):
+    """Create and configure a Warbler app.
+
+    `config` is a profile name from config.CONFIGS or a config object.
     """
 
-    form = MessageForm()
-
-    if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
-
-        return redirect(f"/users/{g.user.id}")
-
-    return render_template('messages/new.html', form=form)
-
-
-@app.route('/messages/<int:message_id>', methods=["GET"])
-def messages_show(message_id):
-    """Show a message."""
-
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
-
-
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
-@redirect_if_missing
-def messages_destroy(message_id):
-    """Delete a message."""
-    
-    msg = Message.query.get(message_id)
-    if msg.user_id != g.user.id:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-    db.session.delete(msg)
-    db.session.commit()
-
-    return redirect(f"/users/{g.user.id}")
-
-
-##############################################################################
-# Homepage and error pages
-
-
-@app.route('/')
-def homepage():
-    """Show homepage:
-
-    - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    if config is None:
+        config = os.environ.get('FLASK_ENV', 'production')
+    if isinstance(config, str):
+        config = CONFIGS[config]
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+
+    if app.config['PROXY_COUNT']:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_COUNT'])
+
+    cache_dir = app.config['JINJA_BYTECODE_CACHE_DIR']
+    if cache_dir:
+        from jinja2 import FileSystemBytecodeCache
+
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_options = dict(
+            app.jinja_options,
+            bytecode_cache=FileSystemBytecodeCache(cache_dir))
+
+    if app.config['DEBUG_TB_ENABLED']:
+        # only development pays for importing and running the toolbar
+        from flask_debugtoolbar import DebugToolbarExtension
+
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+    init_snowflake(app)
+    init_profiler(app)
+    init_replicas(app)
+    init_queries(app)
+    init_slow_queries(app)
+    init_archive(app)
+    init_export(app)
+    init_availability(app)
+    init_trending(app)
+    init_follow_graph(app)
+    init_images(app)
+    init_ratelimit(app)
+    init_like_counts(app)
+    init_entity_cache(app)
+    init_live(app)
+    init_explore(app)
+    init_notifications(app)
+    init_group_commit(app)
+    init_nearby(app)
+    init_partitions(app)
+    init_typeahead(app)
+
+    app.register_blueprint(bp)
+    app.cli.command('precompile-templates')(precompile_templates)
+
+    return app
+
+
+def precompile_templates():
+    """Compile every template into the Jinja bytecode cache.
+
+    Run at build time so workers don't compile templates on first use.
     """
 
-    if g.user:
-        filtered_messages = [f.id for f in g.user.following]
-        filtered_messages.append(g.user.id)
-        messages = (Message 
-                    .query
-                    .join(User)
-                    .join(Follows, User.id==Follows.user_following_id)
-                    .filter(Message.user_id.in_(filtered_messages))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        return render_template('home.html', messages=messages)
-
-    else:
-        return render_template('home-anon.html')
+    from flask import current_app
 
+    env = current_app.jinja_env
+    if env.bytecode_cache is None:
+        raise SystemExit("JINJA_BYTECODE_CACHE_DIR is not set")
 
-##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+    for name in env.list_templates(extensions=['html']):
+        env.get_template(name)
+        print(f"compiled {name}")
 
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
\ No newline at end of file
+def __getattr__(name):
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,446 @@
+"""Cold storage for old messages.
+
+Messages older than a cutoff are moved out of the messages table into
+immutable, gzip-compressed JSONL segment files on local disk, with their
+tags and the ids of the users who liked them. Each segment has an index,
+arrays of 64-bit ints sorted by message id, by author and by liker, so a
+single message, a user's archived history or their archived likes can be
+found without reading every segment. A segment is a series of gzip
+members of BLOCK_ROWS rows each, and the index holds their byte offsets,
+so finding one message decompresses one block. Segments and indexes are
+memory-mapped, not read in, so workers share one copy in the page cache
+and only touch the pages a lookup needs.
+
+A manifest lists the segments, and the cutoff of the last completed run:
+every message older than it is in the archive, so timelines don't search
+the database further back. `python archive.py` runs in its own process,
+and each worker sees its new segments and cutoff the next time it looks,
+as replacing the manifest changes its inode.
+
+    python archive.py [days]
+
+archives messages older than `days` (by default, two years).
+"""
+
+import gzip
+import json
+import mmap
+import os
+import sys
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+from flask import current_app
+
+from models import db, Message, MessageTag, Likes, User, HOT_HISTORY
+
+SEGMENT_SIZE = 50000
+BLOCK_ROWS = 256
+DEFAULT_MAX_AGE = HOT_HISTORY
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+MANIFEST = 'manifest.json'
+
+ArchivedTag = namedtuple('ArchivedTag', 'kind tag')
+
+
+class ArchivedMessage:
+    """A read-only message loaded from the archive."""
+
+    archived = True
+
+    def __init__(self, id, text, timestamp, user_id, like_count=0, tags=(),
+                 liked_by=()):
+        self.id = id
+        self.text = text
+        self.timestamp = datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+        self.user_id = user_id
+        self.like_count = like_count
+        self.tags = [ArchivedTag(kind, tag) for kind, tag in tags]
+        self.liked_by = list(liked_by)
+        self._user = None
+
+    def __repr__(self):
+        return f"<ArchivedMessage #{self.id}: user {self.user_id}>"
+
+    @property
+    def user(self):
+        if self._user is None:
+            self._user = User.query.get(self.user_id)
+        return self._user
+
+
+def _with_authors(messages):
+    """Load the authors of `messages` in one query; return `messages`."""
+
+    authors = {user.id: user for user in User.query.filter(
+        User.id.in_({msg.user_id for msg in messages}))} if messages else {}
+    for msg in messages:
+        msg._user = authors.get(msg.user_id)
+    return messages
+
+
+def _sorted_pairs(pairs):
+    """Return (keys, values) arrays of `pairs`, sorted."""
+
+    pairs = sorted(pairs)
+    return (array('q', (key for key, _ in pairs)),
+            array('q', (value for _, value in pairs)))
+
+
+class SegmentIndex:
+    """One segment's index, mapped from its .idx file.
+
+    Rows are sorted by id, so `ids[line]` is the id on `line`. `authors`
+    and `likers` are sorted user ids, with the row of each in
+    `author_lines` and `liker_lines`. Block n of the segment, lines
+    n * block_rows on, is at bytes offsets[n] to offsets[n + 1].
+    """
+
+    def __init__(self, directory, header):
+        self.segment = header['segment']
+        self.min_id = header['min_id']
+        self.max_id = header['max_id']
+        self.min_ts = header['min_ts']
+
+        rows, likes = header['count'], header['likes']
+        self._map = _map_file(os.path.join(directory, header['index']))
+        view = memoryview(self._map).cast('q')
+
+        self.ids = view[:rows]
+        self.authors = view[rows:2 * rows]
+        self.author_lines = view[2 * rows:3 * rows]
+        self.likers = view[3 * rows:3 * rows + likes]
+        self.liker_lines = view[3 * rows + likes:3 * rows + 2 * likes]
+        self.offsets = view[3 * rows + 2 * likes:]
+
+        self._data = _map_file(os.path.join(directory, self.segment))
+        # segments from before blocks are a single gzip stream
+        self.block_rows = header.get('block_rows', rows)
+        if not len(self.offsets):
+            self.offsets = [0, len(self._data)]
+
+    @staticmethod
+    def write(path, rows, offsets):
+        """Write the index of `rows` (sorted by id) and their blocks'
+        `offsets` to `path`; return its sizes, for the header."""
+
+        ids = array('q', (row['id'] for row in rows))
+        authors, author_lines = _sorted_pairs(
+            (row['user_id'], line) for line, row in enumerate(rows))
+        likers, liker_lines = _sorted_pairs(
+            (user_id, line) for line, row in enumerate(rows)
+            for user_id in row.get('liked_by', ()))
+
+        _write_immutable(path, b"".join(
+            a.tobytes() for a in (ids, authors, author_lines, likers,
+                                  liker_lines, array('q', offsets))))
+        return {'count': len(ids), 'likes': len(likers),
+                'block_rows': BLOCK_ROWS}
+
+    def rows(self, lines):
+        """Yield the rows on `lines` (ascending), decompressing each block
+        they're in once."""
+
+        block = text = None
+        for line in lines:
+            number, offset = divmod(line, self.block_rows)
+            if number != block:
+                block = number
+                text = gzip.decompress(self._data[
+                    self.offsets[number]:self.offsets[number + 1]
+                ]).split(b"\n")
+            yield ArchivedMessage(**json.loads(text[offset]))
+
+    def line(self, message_id):
+        """Return the line of `message_id`, or None."""
+
+        if not self.min_id <= message_id <= self.max_id:
+            return None
+        i = bisect_left(self.ids, message_id)
+        if i < len(self.ids) and self.ids[i] == message_id:
+            return i
+        return None
+
+    def lines_by(self, user_id):
+        """Return the lines of `user_id`'s messages, in id order."""
+
+        return self._lines(self.authors, self.author_lines, user_id)
+
+    def lines_liked_by(self, user_id):
+        """Return the lines of messages `user_id` liked, in id order."""
+
+        return self._lines(self.likers, self.liker_lines, user_id)
+
+    @staticmethod
+    def _lines(keys, lines, user_id):
+        start = bisect_left(keys, user_id)
+        end = bisect_right(keys, user_id, start)
+        return lines[start:end].tolist()
+
+
+class Archive:
+    """The set of segments in `directory`."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._indexes = []
+        self._cutoff = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    @property
+    def indexes(self):
+        """Segment indexes, oldest segment first.
+
+        Checked against the manifest on every use, which costs a stat.
+        """
+
+        self._refresh()
+        return self._indexes
+
+    @property
+    def cutoff(self):
+        """The time (a datetime) before which every message has been
+        archived, or None if nothing has been."""
+
+        self._refresh()
+        return self._cutoff
+
+    def _refresh(self):
+        version = self._manifest_version()
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    segments, cutoff = self._read_manifest()
+                    self._indexes = self._load_indexes(segments,
+                                                       self._indexes)
+                    self._cutoff = (
+                        datetime.strptime(cutoff, TIMESTAMP_FORMAT)
+                        if cutoff else None)
+                    self._version = version
+
+    def _manifest_version(self):
+        try:
+            st = os.stat(os.path.join(self.directory, MANIFEST))
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _read_manifest(self):
+        """Return the manifest's (segment names, cutoff string or None)."""
+
+        try:
+            with open(os.path.join(self.directory, MANIFEST)) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return [], None
+        # manifests from before cutoffs were recorded are bare lists
+        if isinstance(manifest, list):
+            return manifest, None
+        return manifest['segments'], manifest['cutoff']
+
+    def _write_manifest(self, segments, cutoff):
+        _write_immutable(os.path.join(self.directory, MANIFEST),
+                         json.dumps({'segments': segments,
+                                     'cutoff': cutoff}).encode())
+
+    def _load_indexes(self, segments, loaded):
+        """Return the indexes of `segments`, reusing `loaded` ones
+        (segments never change)."""
+
+        indexes = list(loaded)
+        for segment in segments[len(indexes):]:
+            with open(os.path.join(self.directory,
+                                   f"{segment}.idx.json")) as f:
+                header = json.load(f)
+            indexes.append(SegmentIndex(self.directory, header))
+        return indexes
+
+    def get(self, message_id):
+        """Return archived message `message_id`, or None."""
+
+        for index in self.indexes:
+            line = index.line(message_id)
+            if line is not None:
+                return next(index.rows([line]))
+        return None
+
+    def user_messages(self, user_id, limit, before=None):
+        """Return up to `limit` of `user_id`'s archived messages, newest first.
+
+        Only messages older than `before` (a datetime) are returned, if given.
+        """
+
+        messages = []
+        for index in reversed(self.indexes):
+            if before and index.min_ts >= before.strftime(TIMESTAMP_FORMAT):
+                continue
+            for msg in index.rows(index.lines_by(user_id)):
+                if before is None or msg.timestamp < before:
+                    messages.append(msg)
+            if len(messages) >= limit:
+                break
+
+        messages.sort(key=lambda m: m.timestamp, reverse=True)
+        return _with_authors(messages[:limit])
+
+    def iter_user_messages(self, user_id):
+        """Yield all of `user_id`'s archived messages, oldest first.
+
+        Reads one segment at a time, so memory doesn't grow with history.
+        """
+
+        for index in self.indexes:
+            yield from index.rows(index.lines_by(user_id))
+
+    def iter_user_likes(self, user_id):
+        """Yield the archived messages `user_id` liked, oldest first."""
+
+        for index in self.indexes:
+            yield from index.rows(index.lines_liked_by(user_id))
+
+    def write_segment(self, rows):
+        """Write `rows` (dicts, sorted by id) as a new immutable segment."""
+
+        os.makedirs(self.directory, exist_ok=True)
+        indexes = self.indexes
+        name = f"segment-{len(indexes) + 1:06d}"
+        segment = f"{name}.jsonl.gz"
+
+        # each block a gzip member of its own; together, still one gzip file
+        blocks = [gzip.compress("\n".join(
+                      json.dumps(row)
+                      for row in rows[start:start + BLOCK_ROWS]).encode())
+                  for start in range(0, len(rows), BLOCK_ROWS)]
+        _write_immutable(os.path.join(self.directory, segment),
+                         b"".join(blocks))
+        header = {
+            'segment': segment,
+            'index': f"{name}.idx",
+            'min_id': rows[0]['id'],
+            'max_id': rows[-1]['id'],
+            'min_ts': min(row['timestamp'] for row in rows),
+            **SegmentIndex.write(
+                os.path.join(self.directory, f"{name}.idx"), rows,
+                accumulate([len(block) for block in blocks], initial=0)),
+        }
+        _write_immutable(
+            os.path.join(self.directory, f"{name}.idx.json"),
+            json.dumps(header).encode())
+
+        # last, so readers only ever see complete segments
+        segments, cutoff = self._read_manifest()
+        self._write_manifest(segments + [name], cutoff)
+
+    def advance_cutoff(self, cutoff):
+        """Record that every message older than `cutoff` is archived."""
+
+        os.makedirs(self.directory, exist_ok=True)
+        segments, current = self._read_manifest()
+        cutoff = cutoff.strftime(TIMESTAMP_FORMAT)
+        if current is None or cutoff > current:
+            self._write_manifest(segments, cutoff)
+
+
+def _map_file(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _write_immutable(path, data):
+    """Durably write `data` to `path` and make it read-only."""
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, path)
+
+
+def archive_messages(archive, cutoff, segment_size=SEGMENT_SIZE):
+    """Move messages older than `cutoff` from the database into `archive`.
+
+    Their tags and likes go with them. Each segment is on disk before its
+    rows are deleted; rows already in the archive (from a run that died
+    before deleting) are just deleted. The archive's cutoff only moves
+    once every message before it is gone from the database. Returns the
+    number of messages archived.
+    """
+
+    archived = 0
+    while True:
+        messages = (Message
+                    .query
+                    .filter(Message.timestamp < cutoff)
+                    .order_by(Message.id)
+                    .limit(segment_size)
+                    .all())
+        if not messages:
+            archive.advance_cutoff(cutoff)
+            return archived
+
+        ids = [m.id for m in messages]
+        tags = defaultdict(list)
+        for message_id, kind, tag in (
+                db.session.query(MessageTag.message_id, MessageTag.kind,
+                                 MessageTag.tag)
+                .filter(MessageTag.message_id.in_(ids))
+                .order_by(MessageTag.kind, MessageTag.tag)):
+            tags[message_id].append((kind, tag))
+        liked_by = defaultdict(list)
+        for message_id, user_id in (
+                db.session.query(Likes.message_id, Likes.user_id)
+                .filter(Likes.message_id.in_(ids))
+                .order_by(Likes.id)):
+            liked_by[message_id].append(user_id)
+
+        rows = [{'id': m.id,
+                 'text': m.text,
+                 'timestamp': m.timestamp.strftime(TIMESTAMP_FORMAT),
+                 'user_id': m.user_id,
+                 'like_count': m.like_count,
+                 'tags': tags[m.id],
+                 'liked_by': liked_by[m.id]}
+                for m in messages if archive.get(m.id) is None]
+        if rows:
+            archive.write_segment(rows)
+
+        for model in (MessageTag, Likes):
+            model.query.filter(model.message_id.in_(ids)).delete(
+                synchronize_session=False)
+        Message.query.filter(Message.id.in_(ids)).delete(
+            synchronize_session=False)
+        db.session.commit()
+        archived += len(rows)
+
+
+def init_archive(app):
+    """Attach the message archive in ARCHIVE_DIR to `app`."""
+
+    app.config.setdefault(
+        'ARCHIVE_DIR',
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive'))
+    app.extensions['archive'] = Archive(app.config['ARCHIVE_DIR'])
+
+
+def get_archive():
+    """Return the current app's archive."""
+
+    return current_app.extensions['archive']
+
+
+if __name__ == '__main__':
+    from app import app
+
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_MAX_AGE.days
+
+    with app.app_context():
+        count = archive_messages(
+            get_archive(), datetime.utcnow() - timedelta(days=days))
+    print(f"archived {count} messages")
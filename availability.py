@@ -0,0 +1,164 @@
+"""Cheap username/email availability checks.
+
+Signup used to find out a username was taken only after paying for bcrypt.
+An in-memory Bloom filter of every username and email answers "definitely
+free" without touching the database; a hit is confirmed with an indexed
+exact lookup, since Bloom filters have false positives.
+
+Each worker has its own filter, built and then periodically rebuilt by a
+background thread, so requests never wait on a scan of users; until the
+first build finishes, checks go to the database. A name taken through
+another worker may briefly look free; the unique constraints still catch
+that on commit.
+"""
+
+import hashlib
+import math
+import os
+import threading
+
+from flask import current_app
+from sqlalchemy import func, select
+
+from models import db, User
+
+
+class BloomFilter:
+    """A fixed-size Bloom filter of strings."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(capacity, 1)
+        self.size = max(64, int(-self.capacity * math.log(error_rate)
+                                / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(item))
+
+
+class AvailabilityChecker:
+    """Answer "is this username/email taken?" mostly from memory."""
+
+    def __init__(self, engine, rebuild_seconds=600, error_rate=0.01,
+                 logger=None):
+        self.engine = engine
+        self.rebuild_seconds = rebuild_seconds
+        self.error_rate = error_rate
+        self.logger = logger
+        self._bloom = None
+        # names added while a rebuild is reading users, or None
+        self._added_during_rebuild = None
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._overfull = threading.Event()
+        self._thread_pid = None
+
+    def rebuild(self):
+        """Reload the filter from the users table."""
+
+        with self._rebuild_lock:
+            with self._lock:
+                self._added_during_rebuild = []
+
+            with self.engine.connect() as conn:
+                count = conn.execute(select([func.count(User.id)])).scalar()
+
+                # leave room to grow before the error rate degrades
+                bloom = BloomFilter(max(4 * count, 1000), self.error_rate)
+                rows = conn.execution_options(stream_results=True).execute(
+                    select([User.username, User.email]))
+                for username, email in rows:
+                    bloom.add("u:" + username)
+                    bloom.add("e:" + email)
+
+            with self._lock:
+                for item in self._added_during_rebuild:
+                    bloom.add(item)
+                self._added_during_rebuild = None
+                self._bloom = bloom
+
+    @property
+    def bloom(self):
+        """The filter, or None until it's first built."""
+
+        self._start_rebuilder()
+        return self._bloom
+
+    def add(self, username, email):
+        """Record a new or changed username and email."""
+
+        with self._lock:
+            for item in ("u:" + username, "e:" + email):
+                if self._bloom is not None:
+                    self._bloom.add(item)
+                if self._added_during_rebuild is not None:
+                    self._added_during_rebuild.append(item)
+            if self._bloom is not None and (self._bloom.count
+                                            > self._bloom.capacity):
+                self._overfull.set()
+
+    def username_taken(self, username):
+        bloom = self.bloom
+        if bloom is not None and "u:" + username not in bloom:
+            return False
+        return db.session.query(
+            User.query.filter_by(username=username).exists()).scalar()
+
+    def email_taken(self, email):
+        bloom = self.bloom
+        if bloom is not None and "e:" + email not in bloom:
+            return False
+        return db.session.query(
+            User.query.filter_by(email=email).exists()).scalar()
+
+    def _start_rebuilder(self):
+        # one thread per process; a forked worker needs its own
+        if self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.rebuild()
+            except Exception:
+                if self.logger:
+                    self.logger.exception(
+                        "couldn't rebuild the availability filter")
+            # early if signups fill the filter past its capacity
+            self._overfull.wait(self.rebuild_seconds)
+            self._overfull.clear()
+
+
+def init_availability(app):
+    """Attach an availability checker to `app`."""
+
+    app.config.setdefault('AVAILABILITY_REBUILD_SECONDS', 600)
+    app.extensions['availability'] = AvailabilityChecker(
+        db.get_engine(app),
+        rebuild_seconds=app.config['AVAILABILITY_REBUILD_SECONDS'],
+        logger=app.logger)
+
+
+def get_availability():
+    """Return the current app's availability checker."""
+
+    return current_app.extensions['availability']
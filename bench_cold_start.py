@@ -0,0 +1,45 @@
+"""Benchmark import-to-first-request time.
+
+Starts fresh interpreters that import the app, build it and serve one
+request to /login, as a newly forked worker would. Target: median under
+400 ms for the production profile (it was ~450 ms before the factory).
+
+    python bench_cold_start.py [config] [runs]
+"""
+
+import statistics
+import subprocess
+import sys
+
+TARGET_MS = 400
+
+CHILD = """
+import time
+start = time.perf_counter()
+from app import create_app
+app = create_app({config!r})
+resp = app.test_client().get('/login')
+assert resp.status_code == 200, resp.status_code
+print((time.perf_counter() - start) * 1000)
+"""
+
+
+def cold_start(config):
+    """Return milliseconds from import to first response in a new process."""
+
+    out = subprocess.run([sys.executable, "-c", CHILD.format(config=config)],
+                         check=True, capture_output=True, text=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    config = sys.argv[1] if len(sys.argv) > 1 else 'production'
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    times = [cold_start(config) for _ in range(runs)]
+    median = statistics.median(times)
+
+    print(f"{config}: median {median:.1f} ms, "
+          f"min {min(times):.1f} ms, max {max(times):.1f} ms "
+          f"(target {TARGET_MS} ms)")
+    sys.exit(0 if median <= TARGET_MS else 1)
@@ -0,0 +1,114 @@
+"""Benchmark posting throughput and latency with group commit.
+
+CLIENTS threads post messages as fast as they can for SECONDS each run,
+first committing each message on its own (what messages_add does without
+GROUP_COMMIT), then through a GroupCommitter at each of BATCH_SIZES.
+Prints posts per second and the median and 99th percentile time from
+submitting a message to it being committed.
+
+    createdb warbler-bench
+    python bench_group_commit.py
+
+This DROPS AND RECREATES every table in the bench database.
+"""
+
+import os
+import threading
+import time
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', "postgresql:///warbler-bench")
+
+from sqlalchemy import create_engine, text
+
+from app import app
+from models import db
+from group_commit import GroupCommitter, PendingPost
+
+USERS = 100
+CLIENTS = 32
+SECONDS = 5
+BATCH_SIZES = (1, 4, 16, 64)
+MAX_WAIT = 0.002
+
+
+def build():
+    """Recreate the schema with USERS users to post as."""
+
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+            INSERT INTO users (email, username, password)
+            SELECT 'user' || i || '@test.com', 'user' || i, 'x'
+            FROM generate_series(1, :users) i
+        """), users=USERS)
+        return [user_id for (user_id,) in
+                conn.execute(text("SELECT id FROM users ORDER BY id"))]
+
+
+def run(post, user_ids):
+    """Call post(user_id, text) from CLIENTS threads for SECONDS, as each
+    of `user_ids` in turn.
+
+    Returns (posts per second, sorted latencies in ms).
+    """
+
+    latencies = [[] for _ in range(CLIENTS)]
+    stop = time.perf_counter() + SECONDS
+
+    def client(n):
+        i = 0
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            post(user_ids[(n + i) % len(user_ids)], f"warble {n} {i}")
+            latencies[n].append((time.perf_counter() - start) * 1000)
+            i += 1
+
+    threads = [threading.Thread(target=client, args=(n,))
+               for n in range(CLIENTS)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    times = sorted(t for client_times in latencies for t in client_times)
+    return len(times) / elapsed, times
+
+
+def report(label, result):
+    rate, times = result
+    p50 = times[len(times) // 2]
+    p99 = times[min(len(times) - 1, len(times) * 99 // 100)]
+    print(f"{label:>10} {rate:>10.0f} {p50:>8.2f} {p99:>8.2f}")
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        user_ids = build()
+        # a connection per client, so the baseline doesn't queue on the pool
+        engine = create_engine(db.engine.url, pool_size=CLIENTS)
+
+        print(f"{'batch':>10} {'posts/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+
+        alone = GroupCommitter(engine)
+
+        def commit_alone(user_id, text):
+            post = PendingPost(user_id, text, [])
+            alone.commit([post])
+            post.wait(0)
+
+        report("alone", run(commit_alone, user_ids))
+
+        for size in BATCH_SIZES:
+            committer = GroupCommitter(engine, max_batch=size,
+                                       max_wait=MAX_WAIT)
+
+            def commit_grouped(user_id, text):
+                committer.submit(user_id, text).wait(committer.timeout)
+
+            report(size, run(commit_grouped, user_ids))
@@ -0,0 +1,97 @@
+"""Benchmark recent-timeline latency against total history size.
+
+Builds a partitioned messages table holding the same number of messages per
+month for increasingly long histories, then times the profile and homepage
+timeline queries. With partition pruning the latency should stay flat as
+history grows.
+
+    createdb warbler-bench
+    python bench_partitions.py
+
+This DROPS AND RECREATES every table in the bench database.
+"""
+
+import os
+import time
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', "postgresql:///warbler-bench")
+
+from sqlalchemy import text
+
+from app import app
+from models import db, Message
+from partitions import migrate
+from snowflake import make_id_sql
+
+USERS = 1000
+MESSAGES_PER_MONTH = 20000
+HISTORY_MONTHS = (1, 12, 60)
+RUNS = 50
+
+
+def build(months):
+    """Recreate the schema with `months` months of messages."""
+
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+            INSERT INTO users (email, username, password)
+            SELECT 'user' || i || '@test.com', 'user' || i, 'x'
+            FROM generate_series(1, :users) i
+        """), users=USERS)
+        conn.execute(text(f"""
+            INSERT INTO messages (id, text, timestamp, user_id)
+            SELECT {make_id_sql('ts', 'i')}, 'warble ' || i, ts, 1 + i % :users
+            FROM (SELECT i, now() at time zone 'utc'
+                            - random() * :days * interval '1 day' AS ts
+                  FROM generate_series(1, :count) i) m
+        """), days=months * 30, users=USERS,
+              count=months * MESSAGES_PER_MONTH)
+        conn.execute(text("""
+            INSERT INTO follows (user_being_followed_id, user_following_id)
+            SELECT 1 + (i * 7) % :users, 1
+            FROM generate_series(1, 50) i
+            ON CONFLICT DO NOTHING
+        """), users=USERS)
+        migrate(conn)
+        conn.execute(text("ANALYZE"))
+
+
+def timed(fn):
+    """Return the median wall time of `fn` in milliseconds."""
+
+    fn()
+    times = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return sorted(times)[len(times) // 2]
+
+
+def profile_timeline():
+    db.session.expunge_all()
+    Message.most_recent(Message.query.filter(Message.user_id == 1))
+
+
+def home_timeline():
+    db.session.expunge_all()
+    followed = [i for (i,) in db.session.execute(text(
+        "SELECT user_being_followed_id FROM follows "
+        "WHERE user_following_id = 1"))]
+    Message.most_recent(Message.query.filter(Message.user_id.in_(followed)))
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        print(f"{'months':>6} {'messages':>10} {'profile ms':>11} "
+              f"{'home ms':>8}")
+        for months in HISTORY_MONTHS:
+            build(months)
+            print(f"{months:>6} {months * MESSAGES_PER_MONTH:>10} "
+                  f"{timed(profile_timeline):>11.2f} "
+                  f"{timed(home_timeline):>8.2f}")
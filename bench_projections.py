@@ -0,0 +1,131 @@
+"""Benchmark loading a timeline page as ORM entities versus MessageRows.
+
+For the home, profile and likes pages, loads what the page renders, as
+a new request would, both ways:
+
+- orm: Message entities, each message's author, and the viewer's likes
+  (what `msg.user.username` and `msg in g.user.likes` used to load)
+- rows: projections' MessageRows and liked_ids for the page
+
+Prints the median CPU time (time.process_time, so excluding waits on
+Postgres) and the peak Python memory (tracemalloc) of each.
+
+    createdb warbler-bench
+    python bench_projections.py
+
+This DROPS AND RECREATES every table in the bench database.
+"""
+
+import os
+import time
+import tracemalloc
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', "postgresql:///warbler-bench")
+
+from sqlalchemy import text
+
+from app import app
+from models import db, User, Message
+import projections
+from snowflake import make_id_sql
+
+USERS = 1000
+MESSAGES = 100000
+FOLLOWED = 100
+LIKES = 2000
+RUNS = 50
+
+
+def build():
+    """Recreate the schema. User 1 follows FOLLOWED users and has liked
+    LIKES of their messages."""
+
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+            INSERT INTO users (email, username, password, image_url)
+            SELECT 'user' || i || '@test.com', 'user' || i, 'x',
+                   '/static/images/default-pic.png'
+            FROM generate_series(1, :users) i
+        """), users=USERS)
+        conn.execute(text(f"""
+            INSERT INTO messages (id, text, timestamp, user_id)
+            SELECT {make_id_sql('ts', 'i')}, 'warble ' || i, ts,
+                   1 + i % :users
+            FROM (SELECT i, now() at time zone 'utc'
+                            - i * interval '1 minute' AS ts
+                  FROM generate_series(1, :count) i) m
+        """), users=USERS, count=MESSAGES)
+        conn.execute(text("""
+            INSERT INTO follows (user_being_followed_id, user_following_id)
+            SELECT u, f
+            FROM generate_series(2, :followed + 1) u,
+                 (VALUES (1), (2)) AS v(f)
+            WHERE u <> f
+        """), followed=FOLLOWED)
+        conn.execute(text("""
+            INSERT INTO likes (user_id, message_id)
+            SELECT 1, id FROM messages
+            WHERE user_id BETWEEN 2 AND :followed + 1
+            ORDER BY id DESC LIMIT :likes
+        """), followed=FOLLOWED, likes=LIKES)
+        conn.execute(text("ANALYZE"))
+
+
+def orm_page(load):
+    viewer = User.query.get(1)
+    messages = load()
+    liked = set(viewer.likes)
+    return [(msg.user.username, msg in liked) for msg in messages]
+
+
+def rows_page(load):
+    messages = load()
+    liked_ids = projections.liked_ids(1, messages)
+    return [(msg.username, msg.id in liked_ids) for msg in messages]
+
+
+def measure(page, load):
+    """Return (median CPU ms, median peak KiB) of page(load)."""
+
+    cpu, peak = [], []
+    for _ in range(RUNS):
+        db.session.remove()
+        tracemalloc.start()
+        start = time.process_time()
+        page(load)
+        cpu.append((time.process_time() - start) * 1000)
+        peak.append(tracemalloc.get_traced_memory()[1] / 1024)
+        tracemalloc.stop()
+    db.session.remove()
+    return sorted(cpu)[RUNS // 2], sorted(peak)[RUNS // 2]
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        build()
+        followed = range(2, FOLLOWED + 2)
+
+        pages = {
+            'home': (lambda: Message.home_timeline(followed),
+                     lambda: projections.home_timeline(followed)),
+            'profile': (lambda: Message.user_timeline(2),
+                        lambda: projections.user_timeline(2)),
+            'likes': (lambda: User.query.get(1).likes,
+                      lambda: projections.liked_messages(1)),
+        }
+
+        print(f"{'page':>8} {'orm ms':>8} {'rows ms':>8} "
+              f"{'orm KiB':>8} {'rows KiB':>8}")
+        for name, (orm_load, rows_load) in pages.items():
+            # warm the baked query caches
+            orm_page(orm_load)
+            rows_page(rows_load)
+            orm_ms, orm_kib = measure(orm_page, orm_load)
+            rows_ms, rows_kib = measure(rows_page, rows_load)
+            print(f"{name:>8} {orm_ms:>8.2f} {rows_ms:>8.2f} "
+                  f"{orm_kib:>8.0f} {rows_kib:>8.0f}")
@@ -0,0 +1,123 @@
+"""Benchmark per-call cost of the hot lookups: ORM vs baked vs prepared.
+
+Times each lookup as the ORM query the views used to build, as a baked
+query (compiled once), and as a server-side prepared statement, against a
+small dataset so the difference is SQLAlchemy and Postgres overhead rather
+than data access.
+
+    createdb warbler-bench
+    python bench_queries.py
+
+This DROPS AND RECREATES every table in the bench database.
+"""
+
+import os
+import time
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', "postgresql:///warbler-bench")
+
+import sqlalchemy
+
+from app import app
+from models import db, User, Message, Follows, get_by_id
+from queries import PREPARED_KEY, fetch
+
+USERS = 1000
+MESSAGES_PER_USER = 20
+RUNS = 2000
+
+
+def build():
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+    db.session.bulk_insert_mappings(User, [
+        {'username': f"user{i}", 'email': f"user{i}@test.com",
+         'password': "HASHED_PASSWORD"}
+        for i in range(USERS)])
+    db.session.commit()
+
+    ids = [id for id, in db.session.query(User.id)]
+    db.session.bulk_insert_mappings(Follows, [
+        {'user_following_id': ids[0], 'user_being_followed_id': other}
+        for other in ids[1:50]])
+    db.session.bulk_insert_mappings(Message, [
+        {'text': f"message {n}", 'user_id': user_id}
+        for user_id in ids for n in range(MESSAGES_PER_USER)])
+    db.session.commit()
+    return ids
+
+
+def per_call(fn):
+    """Return microseconds per call of `fn`, in a fresh session each time."""
+
+    fn()
+    start = time.perf_counter()
+    for _ in range(RUNS):
+        fn()
+        db.session.remove()
+    return (time.perf_counter() - start) / RUNS * 1e6
+
+
+def with_prepared(enabled, fn):
+    """Run `fn` with prepared statements turned on or off."""
+
+    def run():
+        info = db.session.connection().info
+        saved = info.get(PREPARED_KEY, set())
+        if not enabled:
+            info[PREPARED_KEY] = set()
+        try:
+            return fn()
+        finally:
+            info[PREPARED_KEY] = saved
+    return run
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        ids = build()
+        user_id = ids[0]
+        followed = ids[:50]
+
+        cases = {
+            'user by username': {
+                'orm': lambda: User.query.filter_by(
+                    username="user500").first(),
+                'baked': with_prepared(False, lambda: fetch(
+                    db.session(), 'warbler_users_by_username', "user500")),
+                'prepared': with_prepared(True, lambda: fetch(
+                    db.session(), 'warbler_users_by_username', "user500")),
+            },
+            'user by id': {
+                'orm': lambda: User.query.get(user_id),
+                'baked': with_prepared(False,
+                                       lambda: get_by_id(User, user_id)),
+                'prepared': with_prepared(True,
+                                          lambda: get_by_id(User, user_id)),
+            },
+            'profile timeline': {
+                'orm': lambda: Message.most_recent(
+                    Message.query.filter(Message.user_id == user_id)),
+                'baked': lambda: Message.user_timeline(user_id),
+            },
+            'home timeline': {
+                'orm': lambda: Message.most_recent(
+                    Message.query
+                    .join(User)
+                    .join(Follows, User.id == Follows.user_following_id)
+                    .filter(Message.user_id.in_(followed))),
+                'baked': lambda: Message.home_timeline(followed),
+            },
+        }
+
+        print(f"SQLAlchemy {sqlalchemy.__version__}, {RUNS} runs each")
+        for name, variants in cases.items():
+            timings = {variant: per_call(fn)
+                       for variant, fn in variants.items()}
+            baseline = timings['orm']
+            print(f"{name:>17}: " + ", ".join(
+                f"{variant} {us:7.1f} us ({baseline / us:.2f}x)"
+                for variant, us in timings.items()))
@@ -0,0 +1,308 @@
+"""Benchmark the hot model methods and routes at several dataset sizes.
+
+For each scale, builds a dataset with power-law follows (a few accounts
+follow thousands and are followed by most; the rest follow a handful)
+and messages skewed the same way, then times:
+
+    authenticate     User.authenticate, bcrypt included
+    is_following     User.is_following, loading the follow list
+    home query       the homepage timeline query, for the busiest follower
+    profile query    the users_show timeline query, for the most followed
+    list query       the list_users query, with and without a search
+    GET /, ...       full route renders through the test client
+
+Results are written as JSON. Given a baseline from an earlier run, any
+case whose median is more than --threshold slower is reported, and the
+exit status is 1.
+
+    createdb warbler-bench
+    python bench_suite.py --scales 1k 100k --out bench-results.json
+    python bench_suite.py --baseline bench-results.json
+
+This DROPS AND RECREATES every table in the bench database. Building 1m
+takes several minutes, and its unpaginated /users render takes minutes.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', "postgresql:///warbler-bench")
+
+import sqlalchemy
+from sqlalchemy import text
+
+from app import app, CURR_USER_KEY
+from archive import Archive
+from follow_graph import FollowGraph, build_snapshot
+from entity_cache import init_entity_cache
+from models import db, bcrypt, User, Message
+from snowflake import make_id_sql
+from views import feed_author_ids
+
+SCALES = {'1k': 1_000, '100k': 100_000, '1m': 1_000_000}
+
+# out-degrees are Pareto distributed: P(follows >= k) = k ** -FOLLOW_ALPHA
+FOLLOW_ALPHA = 1.2
+MAX_FOLLOWS = 5000
+
+# who gets followed (and who posts) is 1 + floor(users * random() ** SKEW),
+# so low ids are the popular accounts
+FOLLOWED_SKEW = 4
+AUTHOR_SKEW = 2
+
+MESSAGES_PER_USER = 5
+HISTORY_DAYS = 365
+
+PASSWORD = "password"
+
+# so every run of a scale builds the same dataset
+SEED = 0.41
+
+# each case runs RUNS times or for BUDGET_SECONDS, whichever is first
+RUNS = 200
+MIN_RUNS = 3
+BUDGET_SECONDS = 5
+
+DEFAULT_THRESHOLD = 0.25
+
+
+def build(users):
+    """Recreate the schema with `users` users, their follows and messages."""
+
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+    # one real hash for everyone; hashing per user would dominate the build
+    password = bcrypt.generate_password_hash(PASSWORD).decode('UTF-8')
+
+    with db.engine.begin() as conn:
+        conn.execute(text("SELECT setseed(:seed)"), seed=SEED)
+        conn.execute(text("""
+            INSERT INTO users (email, username, password)
+            SELECT 'user' || i || '@test.com', 'user' || i, :password
+            FROM generate_series(1, :users) i
+        """), users=users, password=password)
+        conn.execute(text("""
+            INSERT INTO follows (user_following_id, user_being_followed_id)
+            SELECT follower, followed
+            FROM (SELECT f.id AS follower,
+                         1 + floor(:users * power(random(), :skew))::int
+                             AS followed
+                  FROM (SELECT i AS id,
+                               least(:max_follows,
+                                     floor(power(1 - random(), -1 / :alpha)))
+                                   ::int AS out_degree
+                        FROM generate_series(1, :users) i) f,
+                       generate_series(1, f.out_degree)) e
+            WHERE follower <> followed
+            ON CONFLICT DO NOTHING
+        """), users=users, skew=FOLLOWED_SKEW, max_follows=MAX_FOLLOWS,
+              alpha=FOLLOW_ALPHA)
+        conn.execute(text(f"""
+            INSERT INTO messages (id, text, timestamp, user_id)
+            SELECT {make_id_sql('ts', 'i')}, 'warble ' || i, ts,
+                   1 + floor(:users * power(random(), :skew))::int
+            FROM (SELECT i, now() at time zone 'utc'
+                            - random() * :days * interval '1 day' AS ts
+                  FROM generate_series(1, :count) i) m
+            ON CONFLICT DO NOTHING
+        """), users=users, skew=AUTHOR_SKEW, days=HISTORY_DAYS,
+              count=users * MESSAGES_PER_USER)
+        conn.execute(text("ANALYZE"))
+
+
+def use_fresh_extensions(graph_dir, archive_dir):
+    """Point the app at this dataset's follow graph and an empty archive,
+    and drop entities cached from the previous scale."""
+
+    os.makedirs(graph_dir)
+    os.makedirs(archive_dir)
+    with db.engine.connect() as conn:
+        build_snapshot(conn, graph_dir)
+    app.extensions['follow_graph'] = FollowGraph(graph_dir)
+    app.extensions['archive'] = Archive(archive_dir)
+    init_entity_cache(app)
+
+
+def pick_users():
+    """Return (busiest follower id, most followed id, typical user id)."""
+
+    busiest, = db.session.execute(text("""
+        SELECT user_following_id FROM follows
+        GROUP BY 1 ORDER BY count(*) DESC LIMIT 1""")).first()
+    followed, = db.session.execute(text("""
+        SELECT user_being_followed_id FROM follows
+        GROUP BY 1 ORDER BY count(*) DESC LIMIT 1""")).first()
+    typical, = db.session.execute(text("""
+        SELECT user_following_id FROM follows
+        GROUP BY 1 ORDER BY count(*), 1 LIMIT 1
+        OFFSET (SELECT count(DISTINCT user_following_id) / 2 FROM follows)
+    """)).first()
+    db.session.remove()
+    return busiest, followed, typical
+
+
+def measure(fn):
+    """Time `fn`, in a fresh session each call; return stats in ms."""
+
+    start = time.perf_counter()
+    fn()
+    db.session.remove()
+    warmup = time.perf_counter() - start
+
+    # a warm-up slower than the whole budget counts as a run: caching
+    # won't change it much, and the 1m list renders take minutes
+    times = [warmup * 1000] if warmup > BUDGET_SECONDS else []
+    deadline = time.perf_counter() + BUDGET_SECONDS
+    while len(times) < RUNS and (len(times) < MIN_RUNS
+                                 or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+        db.session.remove()
+
+    times.sort()
+    return {
+        'median_ms': round(statistics.median(times), 3),
+        'p95_ms': round(times[min(len(times) - 1,
+                                  int(len(times) * 0.95))], 3),
+        'min_ms': round(times[0], 3),
+        'runs': len(times),
+    }
+
+
+def route(client, url):
+    def get():
+        resp = client.get(url)
+        assert resp.status_code == 200, (url, resp.status_code)
+    return get
+
+
+def cases(busiest, followed, typical):
+    """Return {case name: function to time}."""
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = busiest
+
+    return {
+        'authenticate': lambda: User.authenticate(f"user{typical}",
+                                                  PASSWORD),
+        'is_following (typical)': lambda: User.query.get(
+            typical).is_following(User.query.get(followed)),
+        'is_following (busiest)': lambda: User.query.get(
+            busiest).is_following(User.query.get(followed)),
+        'home query': lambda: Message.home_timeline(
+            feed_author_ids(User.query.get(busiest))),
+        'profile query': lambda: Message.user_timeline(followed),
+        'list query': lambda: User.query.all(),
+        'list query (search)': lambda: User.query.filter(
+            User.username.like("%user12%")).all(),
+        'GET /': route(client, "/"),
+        'GET /users/<id>': route(client, f"/users/{followed}"),
+        'GET /users': route(client, "/users"),
+        'GET /users?q=': route(client, "/users?q=user12"),
+    }
+
+
+def run_scale(scale, workdir):
+    users = SCALES[scale]
+
+    start = time.perf_counter()
+    build(users)
+    use_fresh_extensions(os.path.join(workdir, scale, 'graph'),
+                         os.path.join(workdir, scale, 'archive'))
+    busiest, followed, typical = pick_users()
+    built_seconds = time.perf_counter() - start
+
+    counts = {table: db.session.execute(
+                  text(f"SELECT count(*) FROM {table}")).scalar()
+              for table in ('users', 'follows', 'messages')}
+    print(f"{scale}: built {counts} in {built_seconds:.0f} s")
+
+    results = {}
+    for name, fn in cases(busiest, followed, typical).items():
+        results[name] = measure(fn)
+        print(f"  {name:>24}: {results[name]['median_ms']:10.2f} ms median, "
+              f"{results[name]['p95_ms']:10.2f} ms p95 "
+              f"({results[name]['runs']} runs)")
+
+    return {'rows': counts, 'cases': results}
+
+
+def git_commit():
+    out = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                         capture_output=True, text=True)
+    return out.stdout.strip() or None
+
+
+def regressions(results, baseline, threshold):
+    """Return (scale, case, old ms, new ms) for cases that got slower by
+    more than `threshold` (a fraction) than in `baseline`."""
+
+    slower = []
+    for scale, scale_results in results['scales'].items():
+        old_cases = baseline['scales'].get(scale, {}).get('cases', {})
+        for name, stats in scale_results['cases'].items():
+            old = old_cases.get(name)
+            if old and stats['median_ms'] > old['median_ms'] * (1 + threshold):
+                slower.append((scale, name, old['median_ms'],
+                               stats['median_ms']))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', nargs='+', choices=SCALES,
+                        default=list(SCALES))
+    parser.add_argument('--out', default=None,
+                        help="results file (default bench-results-<time>.json)")
+    parser.add_argument('--baseline', help="earlier results to compare with")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown, as a fraction of baseline")
+    args = parser.parse_args(argv)
+
+    results = {
+        'started': datetime.utcnow().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'scales': {},
+    }
+
+    with app.app_context(), tempfile.TemporaryDirectory() as workdir:
+        for scale in args.scales:
+            results['scales'][scale] = run_scale(scale, workdir)
+
+    out = args.out or f"bench-results-{results['started']}.json"
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"wrote {out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = regressions(results, baseline, args.threshold)
+        for scale, name, old, new in slower:
+            print(f"REGRESSION {scale} {name}: {old:.2f} ms -> {new:.2f} ms "
+                  f"({new / old - 1:+.0%})")
+        if slower:
+            return 1
+        print(f"no regressions beyond {args.threshold:.0%} "
+              f"of {args.baseline}")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""Per-process write buffers, flushed by a background thread.
+
+Requests add to a buffer in memory, which is cheap and never waits on the
+database. A thread in each worker process writes the buffer every
+`flush_seconds`, in one transaction, and once more at exit. A flush that
+fails keeps its writes for the next one.
+
+Subclasses say how writes are merged, taken and written:
+
+    _take()                  return what's pending, leaving the buffer empty
+    _write(conn, pending)    write it, in the flush's transaction
+    _restore(pending)        put it back after a failed write
+    _written(pending)        note it as written, once committed
+
+`_take`, `_restore` and `_written` are called holding `_lock`, which
+`add` methods should hold too.
+"""
+
+import atexit
+import os
+import threading
+import time
+
+
+class BufferedWriter:
+    """Base class for buffers written in batches by a background thread."""
+
+    def __init__(self, engine, flush_seconds):
+        self.engine = engine
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        # one flush at a time, so a pending write is never taken twice
+        self._flush_lock = threading.Lock()
+        self._thread_pid = None
+
+    def flush(self):
+        """Write everything pending. Returns what `_write` returns, or 0
+        when there was nothing to write."""
+
+        with self._flush_lock:
+            with self._lock:
+                pending = self._take()
+            if not pending:
+                return 0
+
+            try:
+                with self.engine.begin() as conn:
+                    result = self._write(conn, pending)
+            except Exception:
+                with self._lock:
+                    self._restore(pending)
+                raise
+
+            with self._lock:
+                self._written(pending)
+            return result
+
+    def _take(self):
+        raise NotImplementedError
+
+    def _write(self, conn, pending):
+        raise NotImplementedError
+
+    def _restore(self, pending):
+        raise NotImplementedError
+
+    def _written(self, pending):
+        pass
+
+    def _start_flusher(self):
+        # one thread per process; a forked worker needs its own
+        if self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, daemon=True).start()
+        atexit.register(self._flush_quietly)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            self._flush_quietly()
+
+    def _flush_quietly(self):
+        try:
+            self.flush()
+        except Exception:
+            pass
@@ -0,0 +1,71 @@
+"""Configuration profiles for Warbler.
+
+Pick one by name with `create_app('production')`, or through FLASK_ENV.
+"""
+
+import os
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'DATABASE_URL', 'postgresql:///warbler')
+
+    # Comma-separated read replicas; reads use the primary without them.
+    REPLICA_DATABASE_URLS = [
+        url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+        if url]
+
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    SECRET_KEY = os.environ.get('SECRET_KEY', "it's a secret")
+
+    # Proxies (load balancers) in front of the app. With one or more, the
+    # client IP is taken from that many X-Forwarded-For hops, which only
+    # they can be trusted to set.
+    PROXY_COUNT = int(os.environ.get('PROXY_COUNT', 0))
+
+    # Largest request body, which bounds image uploads.
+    MAX_CONTENT_LENGTH = 8 * 1024 * 1024
+
+    DEBUG_TB_ENABLED = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+    # Compiled templates are cached here when set (see `flask
+    # precompile-templates`).
+    JINJA_BYTECODE_CACHE_DIR = None
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+    DEBUG_TB_ENABLED = True
+    SQLALCHEMY_ECHO = bool(os.environ.get('SQLALCHEMY_ECHO'))
+
+
+class TestConfig(Config):
+    """What the tests build their app from (see testing.py)."""
+
+    TESTING = True
+    # Not DATABASE_URL: the tests empty every table they use.
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'TEST_DATABASE_URL', 'postgresql:///warbler-test')
+    REPLICA_DATABASE_URLS = []
+    WTF_CSRF_ENABLED = False
+    RATELIMIT_ENABLED = False
+    # no background partition checks; test_partitions.py runs them itself
+    PARTITION_CHECK_SECONDS = 0
+
+
+class ProductionConfig(Config):
+    JINJA_BYTECODE_CACHE_DIR = os.environ.get(
+        'JINJA_BYTECODE_CACHE_DIR', os.path.join(BASE_DIR, '.jinja-cache'))
+
+
+CONFIGS = {
+    'development': DevelopmentConfig,
+    'test': TestConfig,
+    'production': ProductionConfig,
+}
@@ -0,0 +1,331 @@
+"""Read-through cache for loading users and messages by primary key.
+
+    user = get_entity_cache().get(User, user_id)
+
+A hit skips the SELECT: the cached row (an immutable tuple of column
+values) is turned back into an instance and merged into the session
+without loading, so relationships still lazy-load as usual and changes
+flush as usual.
+
+Entries live in a per-process LRU with a short TTL, and optionally in a
+shared memcached (ENTITY_CACHE_MEMCACHED = 'host:port', needs pymemcache)
+with a longer one, as JSON, so whoever can write to memcached can only
+ever hand workers column values. Any change to a cached row flushed
+through the ORM invalidates it when the transaction commits, here and in
+memcached; bulk updates and deletes invalidate the whole model, and
+like_counts.py invalidates the messages it recounts. Other workers' LRUs
+can serve a changed row until their TTL runs out, and so can anything
+else written with raw SQL, which is the staleness the TTL is chosen to
+bound.
+
+Hit ratios are at /cache-stats.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict, Counter
+from datetime import datetime
+
+from flask import current_app, abort
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import db, User, Message, get_by_id
+from replicas import RoutingSession
+
+STALE_KEY = 'entity_cache_stale'
+
+
+class LRUCache:
+    """A thread-safe LRU of at most `max_entries`, each kept `ttl` seconds."""
+
+    def __init__(self, max_entries=10000, ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._entries[key] = (now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == prefix]:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {'datetime': value.isoformat()}
+    raise TypeError(f"can't cache a {type(value).__name__}")
+
+
+def _decode(obj):
+    if obj.keys() == {'datetime'}:
+        return datetime.fromisoformat(obj['datetime'])
+    return obj
+
+
+def dumps(values):
+    """Return a row's column `values` as JSON bytes."""
+
+    return json.dumps(values, default=_encode).encode()
+
+
+def loads(data):
+    """Return the column values tuple in JSON bytes `data`."""
+
+    return tuple(json.loads(data, object_hook=_decode))
+
+
+class MemcachedTier:
+    """Shared second tier in memcached."""
+
+    def __init__(self, server, ttl=300):
+        from pymemcache.client.base import Client
+
+        host, _, port = server.partition(':')
+        self.client = Client((host, int(port or 11211)),
+                             connect_timeout=0.05, timeout=0.05)
+        self.ttl = ttl
+
+    def _key(self, key):
+        # the table's generation is bumped by bulk changes, which moves
+        # all of its entries to new keys
+        table, pk = key
+        return f"warbler:{table}:{self._generation(table)}:{pk}"
+
+    def _generation(self, table):
+        generation = self.client.get(f"warbler:{table}:generation")
+        return int(generation) if generation else 0
+
+    def get(self, key):
+        try:
+            data = self.client.get(self._key(key))
+        except Exception:
+            return None
+        try:
+            return loads(data) if data else None
+        except ValueError:
+            return None
+
+    def set(self, key, value):
+        try:
+            self.client.set(self._key(key), dumps(value),
+                            expire=self.ttl, noreply=True)
+        except Exception:
+            pass
+
+    def delete(self, key):
+        try:
+            self.client.delete(self._key(key), noreply=False)
+        except Exception:
+            pass
+
+    def delete_prefix(self, table):
+        key = f"warbler:{table}:generation"
+        try:
+            if self.client.incr(key, 1, noreply=False) is None:
+                self.client.add(key, b"1", noreply=False)
+        except Exception:
+            pass
+
+
+class EntityCache:
+    """Primary-key loads of `models`, through the cache tiers."""
+
+    def __init__(self, models, local, shared=None):
+        self.tables = {model.__tablename__ for model in models}
+        self.local = local
+        self.shared = shared
+        self.hits = Counter()
+        self.misses = Counter()
+
+    @staticmethod
+    def _key(model, pk):
+        return (model.__tablename__, int(pk))
+
+    def get(self, model, pk):
+        """Return `model` `pk` in the current session, or None."""
+
+        if model.__tablename__ not in self.tables:
+            return model.query.get(pk)
+
+        key = self._key(model, pk)
+        values = self.local.get(key)
+        if values is None and self.shared is not None:
+            values = self.shared.get(key)
+            if values is not None:
+                self.local.set(key, values)
+
+        if values is not None:
+            self.hits[model.__tablename__] += 1
+            return self._merge(model, values)
+
+        self.misses[model.__tablename__] += 1
+        obj = get_by_id(model, pk)
+        if obj is not None:
+            values = self._values(obj)
+            if values is not None:
+                self.local.set(key, values)
+                if self.shared is not None:
+                    self.shared.set(key, values)
+        return obj
+
+    def get_or_404(self, model, pk):
+        obj = self.get(model, pk)
+        if obj is None:
+            abort(404)
+        return obj
+
+    @staticmethod
+    def _values(obj):
+        """Return obj's column values, or None if it isn't clean and loaded."""
+
+        state = inspect(obj)
+        if state.modified or state.expired_attributes:
+            return None
+        keys = [attr.key for attr in state.mapper.column_attrs]
+        if any(key not in state.dict for key in keys):
+            return None
+        return tuple(state.dict[key] for key in keys)
+
+    @staticmethod
+    def _merge(model, values):
+        mapper = inspect(model)
+        obj = mapper.class_manager.new_instance()
+        for attr, value in zip(mapper.column_attrs, values):
+            set_committed_value(obj, attr.key, value)
+        make_transient_to_detached(obj)
+        return db.session.merge(obj, load=False)
+
+    def invalidate(self, keys):
+        for key in keys:
+            self.local.delete(key)
+            if self.shared is not None:
+                self.shared.delete(key)
+
+    def invalidate_ids(self, model, pks):
+        """Drop `model` rows `pks`, changed outside the ORM."""
+
+        self.invalidate(self._key(model, pk) for pk in pks)
+
+    def invalidate_table(self, table):
+        self.local.delete_prefix(table)
+        if self.shared is not None:
+            self.shared.delete_prefix(table)
+
+    def stats(self):
+        """Return {table: {'hits', 'misses', 'hit_ratio'}} for this worker."""
+
+        result = {}
+        for table in sorted(self.tables):
+            hits, misses = self.hits[table], self.misses[table]
+            result[table] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_ratio': hits / (hits + misses) if hits + misses else None,
+            }
+        return result
+
+
+def _cache_for(session):
+    app = getattr(session, 'app', None)
+    return app.extensions.get('entity_cache') if app else None
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _collect_stale(session, flush_context):
+    cache = _cache_for(session)
+    if cache is None:
+        return
+    stale = session.info.setdefault(STALE_KEY, set())
+    for obj in list(session.dirty) + list(session.deleted):
+        table = getattr(obj, '__tablename__', None)
+        if table in cache.tables:
+            pk = inspect(obj).identity
+            if pk:
+                stale.add((table, pk[0]))
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _invalidate_stale(session):
+    cache = _cache_for(session)
+    stale = session.info.pop(STALE_KEY, None)
+    if cache is not None and stale:
+        cache.invalidate(stale)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _forget_stale(session):
+    session.info.pop(STALE_KEY, None)
+
+
+def _invalidate_bulk(update_context):
+    cache = _cache_for(update_context.session)
+    table = getattr(update_context.mapper.class_, '__tablename__', None)
+    if cache is not None and table in cache.tables:
+        cache.invalidate_table(table)
+
+
+event.listen(RoutingSession, 'after_bulk_update', _invalidate_bulk)
+event.listen(RoutingSession, 'after_bulk_delete', _invalidate_bulk)
+
+
+def init_entity_cache(app):
+    """Attach a cache of users and messages by primary key to `app`."""
+
+    app.config.setdefault('ENTITY_CACHE_SIZE', 10000)
+    app.config.setdefault('ENTITY_CACHE_TTL', 30)
+    app.config.setdefault('ENTITY_CACHE_MEMCACHED', None)
+    app.config.setdefault('ENTITY_CACHE_SHARED_TTL', 300)
+
+    shared = None
+    if app.config['ENTITY_CACHE_MEMCACHED']:
+        shared = MemcachedTier(app.config['ENTITY_CACHE_MEMCACHED'],
+                               ttl=app.config['ENTITY_CACHE_SHARED_TTL'])
+
+    cache = app.extensions['entity_cache'] = EntityCache(
+        (User, Message),
+        LRUCache(app.config['ENTITY_CACHE_SIZE'],
+                 app.config['ENTITY_CACHE_TTL']),
+        shared)
+
+    # like counts are written with raw SQL, which the ORM events don't see
+    like_counts = app.extensions.get('like_counts')
+    if like_counts is not None:
+        like_counts.on_recount = (
+            lambda message_ids: cache.invalidate_ids(Message, message_ids))
+
+
+def get_entity_cache():
+    """Return the current app's entity cache."""
+
+    return current_app.extensions['entity_cache']
@@ -0,0 +1,172 @@
+"""The latest public messages, from an in-process ring buffer.
+
+The explore page and the anonymous homepage show the newest messages
+from everyone. Rather than sort the messages table for every visitor, each
+worker keeps the newest EXPLORE_SIZE messages in memory, each with a
+snapshot of its author's name and avatar, and renders from those without
+touching the database.
+
+The buffer is loaded from the database on first use and reloaded every
+EXPLORE_REFRESH_SECONDS, which picks up messages posted (and deleted)
+through other workers. Between reloads, this worker's own posts are
+appended and its deletes recorded as tombstones, which hide a message
+until it drops out of the buffer.
+"""
+
+import threading
+import time
+from collections import deque
+
+from flask import current_app
+from sqlalchemy.orm import joinedload
+
+
+class AuthorSnapshot:
+    """What the explore page shows of a message's author."""
+
+    __slots__ = ('id', 'username', 'image_url')
+
+    def __init__(self, id, username, image_url):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+
+    @classmethod
+    def of(cls, user):
+        return cls(user.id, user.username, user.image_url)
+
+
+class MessageSnapshot:
+    """A message as the explore page shows it."""
+
+    __slots__ = ('id', 'text', 'timestamp', 'like_count', 'user')
+
+    def __init__(self, id, text, timestamp, like_count, user):
+        self.id = id
+        self.text = text
+        self.timestamp = timestamp
+        self.like_count = like_count
+        self.user = user
+
+    @classmethod
+    def of(cls, msg, author):
+        return cls(msg.id, msg.text, msg.timestamp, msg.like_count or 0,
+                   author)
+
+
+class Firehose:
+    """Ring buffer of the newest messages, with tombstones for deletes."""
+
+    def __init__(self, size=200, refresh_seconds=30, clock=time.monotonic):
+        self.size = size
+        self.refresh_seconds = refresh_seconds
+        self.clock = clock
+        self._messages = deque(maxlen=size)
+        self._authors = {}
+        self._tombstones = set()
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._loading = threading.Lock()
+
+    def load(self):
+        """Replace the buffer with the newest messages in the database."""
+
+        from models import Message
+
+        messages = (Message.query
+                    .options(joinedload(Message.user))
+                    .order_by(Message.id.desc())
+                    .limit(self.size)
+                    .all())
+
+        authors = {}
+        snapshots = deque(maxlen=self.size)
+        for msg in reversed(messages):
+            author = authors.get(msg.user_id)
+            if author is None:
+                author = authors[msg.user_id] = AuthorSnapshot.of(msg.user)
+            snapshots.append(MessageSnapshot.of(msg, author))
+
+        with self._lock:
+            # messages appended while loading are already in the database;
+            # deletes made while loading may not be
+            ids = {snapshot.id for snapshot in snapshots}
+            self._messages = snapshots
+            self._authors = authors
+            self._tombstones &= ids
+            self._loaded_at = self.clock()
+
+    def _refresh_if_stale(self):
+        loaded_at = self._loaded_at
+        if (loaded_at is not None
+                and self.clock() - loaded_at < self.refresh_seconds):
+            return
+
+        # one request reloads; the others serve what's there, unless empty
+        if self._loading.acquire(blocking=loaded_at is None):
+            try:
+                if self._loaded_at == loaded_at:
+                    self.load()
+            finally:
+                self._loading.release()
+
+    def latest(self, limit=None):
+        """Return up to `limit` of the newest live messages, newest first."""
+
+        self._refresh_if_stale()
+        with self._lock:
+            live = [msg for msg in reversed(self._messages)
+                    if msg.id not in self._tombstones]
+        return live[:limit] if limit else live
+
+    def append(self, msg):
+        """Add ORM message `msg`, just committed, by its loaded author."""
+
+        with self._lock:
+            author = self._authors.get(msg.user_id)
+            if author is None:
+                author = self._authors[msg.user_id] = AuthorSnapshot.of(
+                    msg.user)
+            # the oldest message is about to drop out, tombstone and all
+            if len(self._messages) == self.size:
+                self._tombstones.discard(self._messages[0].id)
+            self._messages.append(MessageSnapshot.of(msg, author))
+
+    def delete(self, message_id):
+        """Hide message `message_id`."""
+
+        with self._lock:
+            if any(msg.id == message_id for msg in self._messages):
+                self._tombstones.add(message_id)
+
+    def delete_author(self, user_id):
+        """Hide every message by `user_id`."""
+
+        with self._lock:
+            self._tombstones.update(msg.id for msg in self._messages
+                                    if msg.user.id == user_id)
+            self._authors.pop(user_id, None)
+
+    def update_author(self, user):
+        """Show `user`'s new name and avatar on their buffered messages."""
+
+        with self._lock:
+            author = self._authors.get(user.id)
+            if author is not None:
+                author.username = user.username
+                author.image_url = user.image_url
+
+
+def init_explore(app):
+    """Attach a firehose of the newest messages to `app`."""
+
+    app.config.setdefault('EXPLORE_SIZE', 200)
+    app.config.setdefault('EXPLORE_REFRESH_SECONDS', 30)
+    app.extensions['explore'] = Firehose(
+        app.config['EXPLORE_SIZE'], app.config['EXPLORE_REFRESH_SECONDS'])
+
+
+def get_explore():
+    """Return the current app's firehose."""
+
+    return current_app.extensions['explore']
@@ -0,0 +1,357 @@
+"""Personal data export: a zip of JSON Lines files, built as it streams.
+
+    profile.json       the account, without its password hash
+    messages.jsonl     every message, archived ones included, oldest first
+    likes.jsonl        liked messages, archived ones included
+    following.jsonl    accounts followed
+    followers.jsonl    followers
+
+Rows are read from server-side cursors EXPORT_CHUNK at a time, inside one
+REPEATABLE READ transaction so the files agree with each other, and each
+chunk is compressed into the zip and handed on before the next is read.
+Memory use doesn't depend on the size of the account.
+
+/users/export builds the zip into a temporary file (in memory up to
+SPOOL_BYTES) and then sends it, so the transaction lasts as long as the
+database takes, not as long as the client takes to download. Accounts of
+more than EXPORT_STREAM_MAX_ROWS rows are too big to build while the
+request waits: ExportJobs builds the same zip in a background thread under
+EXPORT_DIR/<user id>/ for download later; the file name is an unguessable
+token, and files expire after EXPORT_MAX_AGE seconds.
+
+A build that raises leaves a <token>.failed marker, so its page says so
+instead of pretending the export never existed. A build whose worker died
+leaves a <token>.zip.part that stops growing; once it hasn't been written
+for EXPORT_STALE_AFTER seconds, the next look at its page starts the build
+again, and if that stalls too, the export is marked failed.
+"""
+
+import io
+import itertools
+import json
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+import zipfile
+from contextlib import suppress
+
+from flask import current_app
+from sqlalchemy import select, text
+
+from models import User, Message, Follows, Likes
+
+EXPORT_CHUNK = 1000
+SPOOL_BYTES = 8 * 1024 * 1024
+
+SIZE_SQL = text("""
+    SELECT (SELECT count(*) FROM messages WHERE user_id = :user_id)
+         + (SELECT count(*) FROM likes WHERE user_id = :user_id)
+         + (SELECT count(*) FROM follows
+            WHERE user_following_id = :user_id
+               OR user_being_followed_id = :user_id)
+""")
+
+TOKEN_RE = re.compile(r'^[A-Za-z0-9_-]{22}$')
+
+
+class ChunkWriter(io.RawIOBase):
+    """An unseekable file that collects writes until they're taken."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _jsonl_rows(conn, query, row_to_dict):
+    """Yield `query`'s rows as dicts, fetched EXPORT_CHUNK at a time."""
+
+    result = conn.execution_options(stream_results=True).execute(query)
+    try:
+        while True:
+            rows = result.fetchmany(EXPORT_CHUNK)
+            if not rows:
+                return
+            for row in rows:
+                yield row_to_dict(row)
+    finally:
+        result.close()
+
+
+def _message_dict(msg):
+    return {'id': str(msg.id),
+            'text': msg.text,
+            'timestamp': msg.timestamp.isoformat(),
+            'like_count': msg.like_count}
+
+
+def export_members(conn, archive, user_id):
+    """Yield (file name, iterable of dicts or a dict) for `user_id`."""
+
+    users = User.__table__
+    messages = Message.__table__
+    follows = Follows.__table__
+    likes = Likes.__table__
+
+    profile = conn.execute(select([
+        users.c.id, users.c.username, users.c.email, users.c.image_url,
+        users.c.header_image_url, users.c.bio, users.c.location,
+    ]).where(users.c.id == user_id)).first()
+    yield 'profile.json', dict(profile)
+
+    def all_messages():
+        for msg in archive.iter_user_messages(user_id):
+            yield _message_dict(msg)
+        yield from _jsonl_rows(
+            conn,
+            select([messages.c.id, messages.c.text, messages.c.timestamp,
+                    messages.c.like_count])
+            .where(messages.c.user_id == user_id)
+            .order_by(messages.c.id),
+            _message_dict)
+
+    yield 'messages.jsonl', all_messages()
+
+    authors = users.alias('authors')
+
+    def archived_likes():
+        """Yield archived likes, looking up each chunk's authors at once."""
+
+        liked = archive.iter_user_likes(user_id)
+        while True:
+            chunk = list(itertools.islice(liked, EXPORT_CHUNK))
+            if not chunk:
+                return
+            authors = dict(conn.execute(
+                select([users.c.id, users.c.username])
+                .where(users.c.id.in_({msg.user_id for msg in chunk})))
+                .fetchall())
+            for msg in chunk:
+                yield {'message_id': str(msg.id),
+                       'text': msg.text,
+                       'author': authors.get(msg.user_id)}
+
+    def all_likes():
+        yield from archived_likes()
+        yield from _jsonl_rows(
+            conn,
+            select([likes.c.message_id, messages.c.text, authors.c.username])
+            .select_from(
+                likes
+                .outerjoin(messages, messages.c.id == likes.c.message_id)
+                .outerjoin(authors, authors.c.id == messages.c.user_id))
+            .where(likes.c.user_id == user_id)
+            .order_by(likes.c.id),
+            lambda row: {'message_id': str(row.message_id),
+                         'text': row.text,
+                         'author': row.username})
+
+    yield 'likes.jsonl', all_likes()
+
+    for name, mine, theirs in [
+            ('following.jsonl', follows.c.user_following_id,
+             follows.c.user_being_followed_id),
+            ('followers.jsonl', follows.c.user_being_followed_id,
+             follows.c.user_following_id)]:
+        yield name, _jsonl_rows(
+            conn,
+            select([users.c.id, users.c.username])
+            .select_from(follows.join(users, users.c.id == theirs))
+            .where(mine == user_id)
+            .order_by(users.c.id),
+            lambda row: {'id': row.id, 'username': row.username})
+
+
+def export_zip(engine, archive, user_id):
+    """Yield the bytes of `user_id`'s export zip, a chunk at a time."""
+
+    out = ChunkWriter()
+    with engine.connect() as conn, conn.begin():
+        conn.execute(text(
+            "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY"))
+
+        with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for name, content in export_members(conn, archive, user_id):
+                with zf.open(name, 'w', force_zip64=True) as member:
+                    if isinstance(content, dict):
+                        member.write(json.dumps(content).encode())
+                        continue
+                    for n, row in enumerate(content, 1):
+                        member.write(json.dumps(row).encode() + b"\n")
+                        if n % EXPORT_CHUNK == 0:
+                            yield out.take()
+                yield out.take()
+    yield out.take()
+
+
+def export_size(conn, user_id):
+    """Return how many database rows `user_id`'s export has."""
+
+    return conn.execute(SIZE_SQL, {'user_id': user_id}).scalar()
+
+
+def export_file(engine, archive, user_id):
+    """Return a temporary file holding `user_id`'s export zip, rewound."""
+
+    f = tempfile.SpooledTemporaryFile(SPOOL_BYTES)
+    for chunk in export_zip(engine, archive, user_id):
+        f.write(chunk)
+    f.seek(0)
+    return f
+
+
+def _owns(f, path):
+    """Is the open file `f` still the one at `path`?"""
+
+    try:
+        return os.path.samestat(os.fstat(f.fileno()), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+
+class ExportJobs:
+    """Exports built in background threads, as files in `directory`."""
+
+    def __init__(self, directory, engine, archive, max_age=86400,
+                 stale_after=600, logger=None):
+        self.directory = directory
+        self.engine = engine
+        self.archive = archive
+        self.max_age = max_age
+        self.stale_after = stale_after
+        self.logger = logger
+
+    def _path(self, user_id, token):
+        return os.path.join(self.directory, str(user_id), f"{token}.zip")
+
+    def start(self, user_id):
+        """Start building `user_id`'s export; return its token."""
+
+        self.remove_expired()
+        token = secrets.token_urlsafe(16)
+        path = self._path(user_id, token)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._begin(user_id, path)
+        return token
+
+    def _begin(self, user_id, path):
+        # the .part file exists from now on, so the export shows as pending
+        open(path + '.part', 'wb').close()
+        threading.Thread(target=self._build, args=(user_id, path),
+                         daemon=True).start()
+
+    def _build(self, user_id, path):
+        tmp = path + '.part'
+        with open(tmp, 'wb') as f:
+            try:
+                for chunk in export_zip(self.engine, self.archive, user_id):
+                    f.write(chunk)
+                f.flush()
+            except Exception:
+                if self.logger:
+                    self.logger.exception("couldn't export user %s", user_id)
+                if _owns(f, tmp):
+                    self._fail(path)
+                return
+
+            # a build that stalled for long enough has been started again;
+            # leave the file to the new build
+            if _owns(f, tmp):
+                os.replace(tmp, path)
+
+    def _fail(self, path):
+        open(path + '.failed', 'wb').close()
+        with suppress(FileNotFoundError):
+            os.remove(path + '.part')
+
+    def status(self, user_id, token):
+        """Return ('ready', path), or ('pending', None), ('failed', None) or
+        ('missing', None).
+
+        A build that has stopped writing is started again, once.
+        """
+
+        if not TOKEN_RE.match(token):
+            return 'missing', None
+        path = self._path(user_id, token)
+        if os.path.exists(path):
+            return 'ready', path
+        if os.path.exists(path + '.failed'):
+            return 'failed', None
+        try:
+            written = os.stat(path + '.part').st_mtime
+        except FileNotFoundError:
+            return 'missing', None
+
+        now = time.time()
+        if now - written <= self.stale_after:
+            return 'pending', None
+
+        # the builder's worker died; the first to get here starts it again
+        try:
+            os.close(os.open(path + '.retried',
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600))
+        except FileExistsError:
+            try:
+                retried = os.stat(path + '.retried').st_mtime
+            except FileNotFoundError:
+                return 'missing', None
+            if now - retried > self.stale_after:
+                self._fail(path)
+                return 'failed', None
+            return 'pending', None
+
+        os.remove(path + '.part')
+        self._begin(user_id, path)
+        return 'pending', None
+
+    def remove_expired(self):
+        """Delete exports, finished or failed, older than max_age."""
+
+        if not os.path.isdir(self.directory):
+            return
+        cutoff = time.time() - self.max_age
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir():
+                continue
+            for export in os.scandir(entry.path):
+                if export.stat().st_mtime < cutoff:
+                    with suppress(FileNotFoundError):
+                        os.remove(export.path)
+
+
+def init_export(app):
+    """Attach background export jobs, writing to EXPORT_DIR, to `app`."""
+
+    from models import db
+
+    app.config.setdefault(
+        'EXPORT_DIR',
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exports'))
+    app.config.setdefault('EXPORT_MAX_AGE', 86400)
+    app.config.setdefault('EXPORT_STALE_AFTER', 600)
+    app.config.setdefault('EXPORT_STREAM_MAX_ROWS', 50000)
+
+    app.extensions['export'] = ExportJobs(
+        app.config['EXPORT_DIR'], db.get_engine(app),
+        app.extensions['archive'], app.config['EXPORT_MAX_AGE'],
+        app.config['EXPORT_STALE_AFTER'], logger=app.logger)
+
+
+def get_export():
+    """Return the current app's export jobs."""
+
+    return current_app.extensions['export']
@@ -0,0 +1,309 @@
+"""Read-only, memory-mapped snapshot of the follow graph.
+
+A snapshot is a directory of .npy arrays in CSR form, for both directions:
+
+    following_offsets, following   who each user follows
+    follower_offsets, followers    who follows each user
+
+user u's neighbors are neighbors[offsets[u]:offsets[u + 1]], sorted, so
+mutual counts are sorted-array intersections. Every worker mmaps the same
+files read-only, so the OS page cache holds one copy for all of them.
+
+Snapshots are rebuilt periodically (python follow_graph.py); the `current`
+symlink is swapped atomically and workers notice it on their next lookup.
+Follows and unfollows made by this worker since the snapshot are kept in a
+small in-memory overlay, so a user sees their own changes immediately;
+other workers see them once the next snapshot is built. The overlay holds
+at most MAX_OVERLAY changes; past that, the oldest half is dropped, so a
+worker that never sees a new snapshot doesn't grow without bound. numpy is
+imported on first use, not at startup.
+
+    python follow_graph.py
+"""
+
+import os
+import shutil
+import threading
+import time
+from collections import defaultdict
+
+from flask import current_app
+from sqlalchemy import text
+
+LOAD_BATCH = 1_000_000
+MAX_OVERLAY = 100_000
+
+ARRAYS = ('following_offsets', 'following', 'follower_offsets', 'followers')
+
+
+def load_follow_edges(conn, batch_size=LOAD_BATCH):
+    """Return (follower ids, followed ids, max user id) as numpy arrays.
+
+    Rows are streamed with a server-side cursor into preallocated arrays,
+    all read in one REPEATABLE READ transaction, so the count, the max id
+    and the edges agree.
+    """
+
+    import numpy as np
+
+    with conn.begin():
+        conn.execute(text(
+            "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY"))
+        max_id = conn.execute(text(
+            "SELECT coalesce(max(id), 0) FROM users")).scalar()
+        edges = conn.execute(text("SELECT count(*) FROM follows")).scalar()
+
+        follower = np.empty(edges, dtype=np.int32)
+        followed = np.empty(edges, dtype=np.int32)
+
+        result = conn.execution_options(stream_results=True).execute(text(
+            "SELECT user_following_id, user_being_followed_id FROM follows"))
+
+        loaded = 0
+        while loaded < edges:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            batch = np.array(rows, dtype=np.int32)
+            follower[loaded:loaded + len(batch)] = batch[:, 0]
+            followed[loaded:loaded + len(batch)] = batch[:, 1]
+            loaded += len(batch)
+        result.close()
+
+    return follower[:loaded], followed[:loaded], max_id
+
+
+def _csr(sources, targets, n):
+    """Return (offsets, neighbors) with each source's targets sorted."""
+
+    import numpy as np
+
+    order = np.lexsort((targets, sources))
+    counts = np.bincount(sources, minlength=n)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets, targets[order]
+
+
+def build_snapshot(conn, root):
+    """Write a new snapshot under `root` and make it current.
+
+    The snapshot is named for when loading started, so local changes made
+    after that are kept in overlays even if the snapshot also has them.
+    """
+
+    import numpy as np
+
+    started = time.time()
+    follower, followed, max_id = load_follow_edges(conn)
+    n = max(max_id, follower.max(initial=0), followed.max(initial=0)) + 1
+
+    following_offsets, following = _csr(follower, followed, n)
+    follower_offsets, followers = _csr(followed, follower, n)
+
+    name = f"graph-{started:.6f}"
+    path = os.path.join(root, name)
+    os.makedirs(path)
+
+    for array_name, array in zip(ARRAYS, (following_offsets, following,
+                                          follower_offsets, followers)):
+        with open(os.path.join(path, array_name + '.npy'), 'wb') as f:
+            np.save(f, array)
+            f.flush()
+            os.fsync(f.fileno())
+
+    link = os.path.join(root, 'current')
+    try:
+        superseded = os.readlink(link)
+    except OSError:
+        superseded = None
+    tmp_link = link + '.tmp'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(name, tmp_link)
+    os.replace(tmp_link, link)
+    if superseded:
+        # the grace period runs from now, not from when it was built
+        os.utime(os.path.join(root, superseded))
+
+    _remove_old_snapshots(root, keep=name)
+    return path
+
+
+def _remove_old_snapshots(root, keep, grace=300):
+    """Delete superseded snapshots once workers have had time to swap.
+
+    A snapshot's mtime is set when it's superseded, so that's what the
+    grace period is measured from.
+    """
+
+    now = time.time()
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if (name.startswith('graph-') and name != keep
+                and now - os.path.getmtime(path) > grace):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class FollowGraph:
+    """Follow lookups from the current snapshot plus local changes."""
+
+    def __init__(self, root, check_seconds=10, max_overlay=MAX_OVERLAY):
+        self.root = root
+        self.check_seconds = check_seconds
+        self.max_overlay = max_overlay
+        self._snapshot = None
+        self._snapshot_name = None
+        self._checked_at = 0
+
+        # overlays: {user id: {other id: (followed?, when)}} in each direction
+        self._outgoing = defaultdict(dict)
+        self._incoming = defaultdict(dict)
+        self._changes = 0
+        self._lock = threading.Lock()
+
+    def _current(self):
+        """Return the mmapped arrays of the current snapshot, or None."""
+
+        now = time.monotonic()
+        if now - self._checked_at < self.check_seconds:
+            return self._snapshot
+        self._checked_at = now
+
+        try:
+            name = os.readlink(os.path.join(self.root, 'current'))
+        except OSError:
+            return self._snapshot
+
+        if name != self._snapshot_name:
+            import numpy as np
+
+            path = os.path.join(self.root, name)
+            snapshot = {array_name: np.load(
+                            os.path.join(path, array_name + '.npy'),
+                            mmap_mode='r')
+                        for array_name in ARRAYS}
+            with self._lock:
+                self._snapshot = snapshot
+                self._snapshot_name = name
+                self._forget_before(float(name[len('graph-'):]))
+
+        return self._snapshot
+
+    def _forget_before(self, started):
+        """Drop overlay changes made before `started`: ones a new snapshot
+        already includes, or the oldest, when the overlay is full."""
+
+        for overlay in (self._outgoing, self._incoming):
+            for user_id in list(overlay):
+                changes = overlay[user_id]
+                for other_id in [o for o, (_, when) in changes.items()
+                                 if when < started]:
+                    del changes[other_id]
+                if not changes:
+                    del overlay[user_id]
+        self._changes = sum(len(changes)
+                            for changes in self._outgoing.values())
+
+    def _neighbors(self, offsets_name, neighbors_name, overlay, user_id):
+        import numpy as np
+
+        snapshot = self._current()
+        base = np.empty(0, dtype=np.int32)
+
+        if snapshot is not None:
+            offsets = snapshot[offsets_name]
+            if user_id + 1 < len(offsets):
+                base = snapshot[neighbors_name][
+                    offsets[user_id]:offsets[user_id + 1]]
+
+        changes = overlay.get(user_id)
+        if not changes:
+            return base
+
+        added = [o for o, (followed, _) in changes.items() if followed]
+        removed = [o for o, (followed, _) in changes.items() if not followed]
+        if added:
+            base = np.union1d(base, np.array(added, dtype=np.int32))
+        if removed:
+            base = np.setdiff1d(base, np.array(removed, dtype=np.int32),
+                                assume_unique=True)
+        return base
+
+    def following(self, user_id):
+        """Return the sorted ids `user_id` follows."""
+
+        return self._neighbors('following_offsets', 'following',
+                               self._outgoing, user_id)
+
+    def followers(self, user_id):
+        """Return the sorted ids following `user_id`."""
+
+        return self._neighbors('follower_offsets', 'followers',
+                               self._incoming, user_id)
+
+    def is_following(self, user_id, other_id):
+        """Does `user_id` follow `other_id`?"""
+
+        import numpy as np
+
+        following = self.following(user_id)
+        i = np.searchsorted(following, other_id)
+        return bool(i < len(following) and following[i] == other_id)
+
+    def followed_by_followed(self, viewer_id, user_id):
+        """Return ids that `viewer_id` follows who follow `user_id`."""
+
+        import numpy as np
+
+        return np.intersect1d(self.following(viewer_id),
+                              self.followers(user_id), assume_unique=True)
+
+    def _record(self, user_id, other_id, followed):
+        change = (followed, time.time())
+        with self._lock:
+            if other_id not in self._outgoing[user_id]:
+                self._changes += 1
+            self._outgoing[user_id][other_id] = change
+            self._incoming[other_id][user_id] = change
+
+            if self._changes > self.max_overlay:
+                times = sorted(when for changes in self._outgoing.values()
+                               for _, when in changes.values())
+                self._forget_before(times[len(times) // 2])
+
+    def follow(self, user_id, other_id):
+        """Record a follow made since the snapshot."""
+
+        self._record(user_id, other_id, True)
+
+    def unfollow(self, user_id, other_id):
+        """Record an unfollow made since the snapshot."""
+
+        self._record(user_id, other_id, False)
+
+
+def init_follow_graph(app):
+    """Attach the follow graph snapshot in FOLLOW_GRAPH_DIR to `app`."""
+
+    app.config.setdefault(
+        'FOLLOW_GRAPH_DIR',
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'graph'))
+    app.extensions['follow_graph'] = FollowGraph(app.config['FOLLOW_GRAPH_DIR'])
+
+
+def get_follow_graph():
+    """Return the current app's follow graph."""
+
+    return current_app.extensions['follow_graph']
+
+
+if __name__ == '__main__':
+    from app import app
+    from models import db
+
+    with app.app_context():
+        root = app.config['FOLLOW_GRAPH_DIR']
+        os.makedirs(root, exist_ok=True)
+        with db.engine.connect() as conn:
+            print(f"wrote {build_snapshot(conn, root)}")
@@ -1,7 +1,10 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileAllowed
 from wtforms import StringField, PasswordField, TextAreaField
 from wtforms.validators import DataRequired, Email, Length
 
+IMAGE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'gif', 'webp']
+
 
 class MessageForm(FlaskForm):
     """Form for adding/editing messages."""
@@ -16,7 +19,12 @@ class UserAddForm(FlaskForm):
     email = StringField('E-mail', validators=[DataRequired(), Email()])
     password = PasswordField('Password', validators=[Length(min=6)])
     image_url = StringField('(Optional) Image URL')
+    image_file = FileField('(Optional) Upload Image', validators=[
+        FileAllowed(IMAGE_EXTENSIONS, 'Images only')])
     header_image_url = StringField('(Optional) Header Image URL')
+    header_image_file = FileField('(Optional) Upload Header Image',
+                                  validators=[FileAllowed(IMAGE_EXTENSIONS,
+                                                          'Images only')])
     bio = StringField('(Optional) Bio')
 
 class UserEditForm(FlaskForm):
@@ -26,8 +34,14 @@ class UserEditForm(FlaskForm):
     email = StringField('E-mail', validators=[DataRequired(), Email()])
     password = PasswordField('Password', validators=[Length(min=6)])
     image_url = StringField('(Optional) Image URL')
+    image_file = FileField('(Optional) Upload Image', validators=[
+        FileAllowed(IMAGE_EXTENSIONS, 'Images only')])
     header_image_url = StringField('(Optional) Header Image URL')
+    header_image_file = FileField('(Optional) Upload Header Image',
+                                  validators=[FileAllowed(IMAGE_EXTENSIONS,
+                                                          'Images only')])
     bio = StringField('(Optional) Bio')
+    location = StringField('(Optional) Location')
 
 
 class LoginForm(FlaskForm):
@@ -0,0 +1,211 @@
+"""Group commit for new messages.
+
+Each post normally commits on its own, so a burst of posts is bound by
+one WAL flush per message. With GROUP_COMMIT on, `messages_add` hands the
+validated message to a per-process writer thread instead, which inserts
+whatever has queued up, up to GROUP_COMMIT_MAX_BATCH messages or
+GROUP_COMMIT_MAX_WAIT seconds after the first, in one transaction. The
+request waits until that transaction has committed, so a redirect still
+means the message is durable; it just shares its flush with its
+neighbours.
+
+The price is up to GROUP_COMMIT_MAX_WAIT of extra latency when posts are
+sparse. `python bench_group_commit.py` shows the trade-off.
+"""
+
+import os
+import queue
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import text
+
+from models import db, Message, MessageTag
+from replicas import stick_to_primary
+from snowflake import next_id
+
+
+class PendingPost:
+    """A message waiting for its group to commit."""
+
+    __slots__ = ('id', 'user_id', 'text', 'tags', 'timestamp', 'error',
+                 '_done')
+
+    def __init__(self, user_id, text, tags):
+        self.id = next_id()
+        self.user_id = user_id
+        self.text = text
+        self.tags = tags
+        self.timestamp = None
+        self.error = None
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Block until committed; raise if the insert failed."""
+
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"message {self.id} not committed in time")
+        if self.error is not None:
+            raise self.error
+
+
+def insert_sql(count):
+    """Return the multi-row message INSERT for `count` messages."""
+
+    values = ", ".join(f"(:id{i}, :text{i}, :user_id{i})"
+                       for i in range(count))
+    return text(f"""
+        INSERT INTO messages (id, text, user_id)
+        VALUES {values}
+        RETURNING id, timestamp
+    """)
+
+
+def insert_tags_sql(count):
+    """Return the multi-row message_tags INSERT for `count` tags."""
+
+    values = ", ".join(f"(:kind{i}, :tag{i}, :message_id{i})"
+                       for i in range(count))
+    return text(f"""
+        INSERT INTO message_tags (kind, tag, message_id)
+        VALUES {values}
+    """)
+
+
+class GroupCommitter:
+    """Insert queued messages in shared transactions."""
+
+    def __init__(self, engine, max_batch=50, max_wait=0.005, timeout=10):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread_pid = None
+
+    def submit(self, user_id, text, tags=()):
+        """Queue a message; `tags` are (kind, tag) pairs. Returns a
+        PendingPost to wait on."""
+
+        post = PendingPost(user_id, text, list(tags))
+        self._start_writer()
+        self._queue.put(post)
+        return post
+
+    def post(self, user, text):
+        """Add `user`'s message and return it once durable.
+
+        The Message returned is not in any session; it has its id,
+        timestamp and tags set, and `user` as its author. The writer's
+        connection isn't db.session's, so the poster is pinned to the
+        primary here, to read their post back.
+        """
+
+        tags = MessageTag.extract(text)
+        stick_to_primary()
+        post = self.submit(user.id, text, [(t.kind, t.tag) for t in tags])
+        post.wait(self.timeout)
+
+        msg = Message(id=post.id, text=text, timestamp=post.timestamp,
+                      user_id=user.id, like_count=0, tags=tags)
+        msg.user = user
+        return msg
+
+    def next_batch(self):
+        """Wait for a message, then take others up to max_batch or until
+        max_wait has passed."""
+
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    # don't wait, but take what's already there
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def commit(self, batch):
+        """Insert `batch` in one transaction and wake its requests.
+
+        If the group fails, each message is retried alone, so one bad
+        message (say, by a user deleted meanwhile) fails only itself.
+        """
+
+        try:
+            self._insert(batch)
+        except Exception as exc:
+            if len(batch) == 1:
+                batch[0].error = exc
+            else:
+                for post in batch:
+                    self.commit([post])
+                return
+        for post in batch:
+            post._done.set()
+
+    def _insert(self, batch):
+        params = {}
+        for i, post in enumerate(batch):
+            params[f"id{i}"] = post.id
+            params[f"text{i}"] = post.text
+            params[f"user_id{i}"] = post.user_id
+
+        tag_params = {}
+        tags = [(kind, tag, post.id)
+                for post in batch for kind, tag in post.tags]
+        for i, (kind, tag, message_id) in enumerate(tags):
+            tag_params[f"kind{i}"] = kind
+            tag_params[f"tag{i}"] = tag
+            tag_params[f"message_id{i}"] = message_id
+
+        with self.engine.begin() as conn:
+            timestamps = dict(
+                conn.execute(insert_sql(len(batch)), params).fetchall())
+            if tags:
+                conn.execute(insert_tags_sql(len(tags)), tag_params)
+
+        for post in batch:
+            post.timestamp = timestamps[post.id]
+
+    def _start_writer(self):
+        # one thread per process; a forked worker needs its own
+        if self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            # a new queue before the pid, which lets submit() skip the lock
+            self._queue = queue.Queue()
+            self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            self.commit(self.next_batch())
+
+
+def init_group_commit(app):
+    """Attach a group committer to `app`, used when GROUP_COMMIT is on."""
+
+    app.config.setdefault('GROUP_COMMIT', False)
+    app.config.setdefault('GROUP_COMMIT_MAX_BATCH', 50)
+    app.config.setdefault('GROUP_COMMIT_MAX_WAIT', 0.005)
+    app.extensions['group_commit'] = GroupCommitter(
+        db.get_engine(app),
+        max_batch=app.config['GROUP_COMMIT_MAX_BATCH'],
+        max_wait=app.config['GROUP_COMMIT_MAX_WAIT'])
+
+
+def get_group_commit():
+    """Return the current app's group committer, or None if it's off."""
+
+    if not current_app.config['GROUP_COMMIT']:
+        return None
+    return current_app.extensions['group_commit']
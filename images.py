@@ -0,0 +1,158 @@
+"""Content-addressed storage for uploaded avatars and header images.
+
+An upload is stored under the SHA-256 of its bytes, so an image uploaded by
+many users is processed and stored once. Every size the templates display
+is generated at upload time:
+
+    <IMAGE_DIR>/<kind>/<sha256>/<size>.jpg
+
+and the user's image_url becomes /images/<kind>/<sha256>. The bytes behind
+a thumbnail URL can never change, so thumbnails are served with immutable
+cache headers. The `thumb` template filter turns an image URL and a size
+into a thumbnail URL; remote URLs pass through unchanged.
+"""
+
+import hashlib
+import io
+import os
+import re
+import shutil
+import tempfile
+
+from flask import current_app, abort, send_from_directory
+
+URL_PREFIX = '/images/'
+
+# twice the CSS size of each place an image is shown, for high-DPI screens
+SIZES = {
+    'avatar': {
+        'nav': (64, 64),            # navbar, 32px
+        'timeline': (96, 96),       # .timeline-image, 48px
+        'card': (140, 140),         # .card-image, 70px
+        'profile': (400, 400),      # #profile-avatar, 200px
+    },
+    'header': {
+        'card': (600, 200),         # .card-hero
+        'hero': (1600, 720),        # #warbler-hero, 360px tall
+    },
+}
+
+# headers are shown from the top (background-position: top center)
+CENTERING = {'avatar': (0.5, 0.5), 'header': (0.5, 0.0)}
+
+FORMATS = {'JPEG', 'PNG', 'GIF', 'WEBP'}
+MAX_PIXELS = 40_000_000
+
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+# thumbnails never change, so caches may keep them for good
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+class InvalidImage(ValueError):
+    """The upload isn't an image we can use."""
+
+
+def make_thumbnails(data, sizes, centering=(0.5, 0.5)):
+    """Return {size name: JPEG bytes} for image bytes `data`."""
+
+    # Pillow is only needed for uploads, so it isn't loaded at startup
+    from PIL import Image, ImageOps
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.format not in FORMATS:
+            raise InvalidImage("Image must be a JPEG, PNG, GIF or WebP")
+        if image.width * image.height > MAX_PIXELS:
+            raise InvalidImage("Image is too large")
+
+        # let JPEGs decode at reduced scale when we only need small sizes
+        image.draft('RGB', max(sizes.values()))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+    except (OSError, Image.DecompressionBombError) as exc:
+        raise InvalidImage("Couldn't read image") from exc
+
+    thumbnails = {}
+    for name, size in sizes.items():
+        thumbnail = ImageOps.fit(image, size, Image.LANCZOS,
+                                 centering=centering)
+        buf = io.BytesIO()
+        thumbnail.save(buf, 'JPEG', quality=85, optimize=True,
+                       progressive=True)
+        thumbnails[name] = buf.getvalue()
+    return thumbnails
+
+
+class ImageStore:
+    """Uploaded images and their thumbnails under `root`."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def save(self, kind, data):
+        """Store image bytes `data` as `kind`; return its image URL.
+
+        Raises InvalidImage if `data` can't be used.
+        """
+
+        digest = hashlib.sha256(data).hexdigest()
+        kind_dir = os.path.join(self.root, kind)
+        path = os.path.join(kind_dir, digest)
+
+        if not os.path.isdir(path):
+            thumbnails = make_thumbnails(data, SIZES[kind], CENTERING[kind])
+
+            # write everything, then rename into place, so a digest's
+            # directory is either complete or missing
+            os.makedirs(kind_dir, exist_ok=True)
+            tmp = tempfile.mkdtemp(dir=kind_dir, prefix='.tmp-')
+            for name, content in thumbnails.items():
+                with open(os.path.join(tmp, name + '.jpg'), 'wb') as f:
+                    f.write(content)
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                # stored by another worker in the meantime
+                shutil.rmtree(tmp, ignore_errors=True)
+
+        return f"{URL_PREFIX}{kind}/{digest}"
+
+    def send(self, kind, digest, size):
+        """Return a response for one thumbnail, cacheable forever."""
+
+        if size not in SIZES.get(kind, ()) or not DIGEST_RE.match(digest):
+            abort(404)
+
+        response = send_from_directory(
+            self.root, f"{kind}/{digest}/{size}.jpg")
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+        return response
+
+
+def thumbnail_url(url, size):
+    """Return the URL of image `url` at `size`; for the `thumb` filter.
+
+    Remote URLs and static defaults are returned as they are.
+    """
+
+    if not url or not url.startswith(URL_PREFIX):
+        return url
+    return f"{url}/{size}.jpg"
+
+
+def init_images(app):
+    """Attach an image store in IMAGE_DIR to `app`."""
+
+    app.config.setdefault(
+        'IMAGE_DIR',
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'images'))
+    app.extensions['images'] = ImageStore(app.config['IMAGE_DIR'])
+    app.add_template_filter(thumbnail_url, 'thumb')
+
+
+def get_images():
+    """Return the current app's image store."""
+
+    return current_app.extensions['images']
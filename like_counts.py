@@ -0,0 +1,156 @@
+"""Buffered per-message like counts.
+
+messages.like_count is a cached count of the message's likes. Each like or
+unlike marks the message in a per-process buffer (see buffered.py), and
+every `flush_seconds` the marked messages are recounted from the likes
+table in one statement, so a burst of likes on one message is a single row
+update however many there were.
+
+Recounting, rather than adding up +1s and -1s, makes a write correct
+whenever it lands: a flush that's retried, or that races the reconcile job
+or another worker's flush, can't count a like twice. Rows are locked before
+they're counted, so the last writer always counts every like committed
+before it. Once a flush commits, `on_recount` is called with the ids it
+recounted, which the entity cache uses to drop their cached rows. A worker
+that dies loses up to `flush_seconds` of marks; the reconcile job finds
+counts that drifted that way and recounts them too:
+
+    python like_counts.py migrate       # add the column, count everything
+    python like_counts.py reconcile [days]
+"""
+
+import sys
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import text
+
+from buffered import BufferedWriter
+from models import db
+
+MIGRATE_SQL = [
+    """ALTER TABLE messages
+       ADD COLUMN IF NOT EXISTS like_count INTEGER NOT NULL DEFAULT 0""",
+    "CREATE INDEX IF NOT EXISTS ix_likes_message_id ON likes (message_id)",
+]
+
+# in id order, so concurrent recounts can't deadlock; and in a statement of
+# its own, so the recount's snapshot is taken once the rows are ours
+LOCK_SQL = text("""
+    SELECT id FROM messages
+    WHERE id = ANY(CAST(:ids AS BIGINT[]))
+    ORDER BY id
+    FOR UPDATE
+""")
+
+# only rows that are wrong are written
+RECOUNT_SQL = text("""
+    UPDATE messages AS m
+    SET like_count = actual.n
+    FROM (
+        SELECT m.id, count(l.message_id) AS n
+        FROM messages AS m LEFT JOIN likes AS l ON l.message_id = m.id
+        WHERE m.id = ANY(CAST(:ids AS BIGINT[]))
+        GROUP BY m.id
+    ) AS actual
+    WHERE m.id = actual.id AND m.like_count <> actual.n
+""")
+
+DRIFTED_SQL = text("""
+    SELECT m.id
+    FROM messages AS m LEFT JOIN likes AS l ON l.message_id = m.id
+    WHERE m.timestamp >= :since
+    GROUP BY m.id, m.like_count
+    HAVING m.like_count <> count(l.message_id)
+""")
+
+RECONCILE_DAYS = 7
+
+
+def recount(conn, message_ids):
+    """Set the like counts of `message_ids` from the likes table.
+
+    Returns the number of messages whose count was wrong.
+    """
+
+    ids = sorted(message_ids)
+    if not ids:
+        return 0
+    conn.execute(LOCK_SQL, {'ids': ids})
+    return conn.execute(RECOUNT_SQL, {'ids': ids}).rowcount
+
+
+class LikeCounter(BufferedWriter):
+    """Note messages whose likes changed and recount them in batches."""
+
+    def __init__(self, engine, flush_seconds=0.25, on_recount=None):
+        super().__init__(engine, flush_seconds)
+        self.on_recount = on_recount
+        self._pending = set()
+
+    def add(self, message_id):
+        """Note that `message_id` was liked or unliked."""
+
+        with self._lock:
+            self._pending.add(message_id)
+        self._start_flusher()
+
+    def _take(self):
+        pending = self._pending
+        self._pending = set()
+        return pending
+
+    def _write(self, conn, pending):
+        return recount(conn, pending)
+
+    def _restore(self, pending):
+        self._pending |= pending
+
+    def _written(self, pending):
+        if self.on_recount is not None:
+            self.on_recount(pending)
+
+
+def reconcile(conn, since=None):
+    """Recount likes of messages since `since` (default: all) whose count
+    is wrong.
+
+    Returns the number of messages corrected.
+    """
+
+    since = since or datetime(1970, 1, 1)
+    drifted = [row.id for row in conn.execute(DRIFTED_SQL, {'since': since})]
+    return recount(conn, drifted)
+
+
+def init_like_counts(app):
+    """Attach a like counter to `app`."""
+
+    app.config.setdefault('LIKE_COUNT_FLUSH_SECONDS', 0.25)
+    app.extensions['like_counts'] = LikeCounter(
+        db.get_engine(app),
+        flush_seconds=app.config['LIKE_COUNT_FLUSH_SECONDS'])
+
+
+def get_like_counts():
+    """Return the current app's like counter."""
+
+    return current_app.extensions['like_counts']
+
+
+if __name__ == '__main__':
+    from app import app
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'reconcile'
+
+    with app.app_context(), db.engine.begin() as conn:
+        if command == 'migrate':
+            for statement in MIGRATE_SQL:
+                conn.execute(text(statement))
+            print(f"counted likes for {reconcile(conn)} messages")
+        elif command == 'reconcile':
+            days = int(sys.argv[2]) if len(sys.argv) > 2 else RECONCILE_DAYS
+            since = datetime.utcnow() - timedelta(days=days)
+            print(f"corrected {reconcile(conn, since)} messages")
+        else:
+            sys.exit(f"usage: {sys.argv[0]} migrate|reconcile [days]")
@@ -0,0 +1,97 @@
+"""In-process pub/sub of new messages, for live "N new warbles" counts.
+
+messages_add publishes the author's id; each open event stream
+subscribes to the authors in its viewer's feed and is woken when one of
+them posts. Subscriptions are indexed by author, so a publish only
+touches the streams that care.
+
+This is per process: streams see messages posted through the same worker
+immediately. A stream also counts what was posted since the page was
+rendered when it connects, and clients reconnect periodically (see
+STREAM_SECONDS), which picks up messages posted through other workers.
+
+Idle streams cost a subscription and a blocked greenlet each when served
+by serve.py (gevent), rather than a thread each.
+"""
+
+import threading
+from collections import defaultdict
+
+from flask import current_app
+
+
+class Subscription:
+    """New-message count for one stream."""
+
+    def __init__(self, author_ids, count=0):
+        self.author_ids = frozenset(author_ids)
+        self.count = count
+        # the count the last wait returned at; news is any count past it,
+        # so a notify between two waits isn't lost
+        self._seen = 0
+        self._changed = threading.Condition()
+
+    def notify(self):
+        with self._changed:
+            self.count += 1
+            self._changed.notify_all()
+
+    def wait(self, timeout):
+        """Wait up to `timeout` seconds for news; return True if any came."""
+
+        with self._changed:
+            fired = self._changed.wait_for(
+                lambda: self.count != self._seen, timeout)
+            self._seen = self.count
+        return fired
+
+
+class FeedBroker:
+    """Route published messages to the streams following their author."""
+
+    def __init__(self):
+        self._by_author = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, author_ids, count=0):
+        sub = Subscription(author_ids, count)
+        with self._lock:
+            for author_id in sub.author_ids:
+                self._by_author[author_id].add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            for author_id in sub.author_ids:
+                subs = self._by_author.get(author_id)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._by_author[author_id]
+
+    def publish(self, author_id):
+        """Tell streams following `author_id` that they posted."""
+
+        with self._lock:
+            subs = list(self._by_author.get(author_id, ()))
+        for sub in subs:
+            sub.notify()
+
+    def __len__(self):
+        with self._lock:
+            return len({sub for subs in self._by_author.values()
+                        for sub in subs})
+
+
+def init_live(app):
+    """Attach a feed broker to `app`."""
+
+    app.config.setdefault('STREAM_HEARTBEAT_SECONDS', 15)
+    app.config.setdefault('STREAM_SECONDS', 300)
+    app.extensions['live'] = FeedBroker()
+
+
+def get_live():
+    """Return the current app's feed broker."""
+
+    return current_app.extensions['live']
@@ -0,0 +1,38 @@
+"""Move messages to time-ordered 64-bit ids and a real timestamp default.
+
+Existing serial ids are far below any snowflake id (see snowflake.py), so
+old rows keep their ids and their order; only column types, defaults and
+indexes change. Timestamps already written with the old import-time
+default can't be recovered and are left alone.
+
+    python migrate_ids.py
+"""
+
+from sqlalchemy import text
+
+MIGRATE_SQL = [
+    "ALTER TABLE likes ALTER COLUMN message_id TYPE BIGINT",
+    "ALTER TABLE message_tags ALTER COLUMN message_id TYPE BIGINT",
+    "ALTER TABLE messages ALTER COLUMN id DROP DEFAULT",
+    "ALTER TABLE messages ALTER COLUMN id TYPE BIGINT",
+    "DROP SEQUENCE IF EXISTS messages_id_seq",
+    "ALTER TABLE messages ALTER COLUMN timestamp "
+    "SET DEFAULT (now() at time zone 'utc')",
+    # newest-first now sorts by id, which the primary key already indexes
+    "DROP INDEX IF EXISTS ix_messages_user_id_timestamp",
+    "DROP INDEX IF EXISTS ix_messages_timestamp",
+    "CREATE INDEX IF NOT EXISTS ix_messages_user_id_id "
+    "ON messages (user_id, id DESC)",
+]
+
+
+def migrate(conn):
+    for statement in MIGRATE_SQL:
+        conn.execute(text(statement))
+
+
+if __name__ == '__main__':
+    from app import app, db
+
+    with db.engine.begin() as conn:
+        migrate(conn)
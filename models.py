@@ -1,12 +1,36 @@
 """SQLAlchemy models for Warbler."""
 
-from datetime import datetime
+import re
+from datetime import datetime, timedelta
 
+from flask import current_app, has_app_context
 from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import bindparam
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm.util import identity_key
+
+from queries import bakery, register, fetch
+from replicas import RoutingSQLAlchemy
+from snowflake import next_id, id_time
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+HASHTAG_RE = re.compile(r'(?<!\w)#(\w{1,100})')
+MENTION_RE = re.compile(r'(?<!\w)@(\w{1,100})')
+
+# Look this far back for recent messages before widening the search; bounded
+# ranges let Postgres skip message partitions outside them.
+RECENT_WINDOW = timedelta(days=7)
+
+# Messages older than this are moved to the archive (see archive.py) by
+# default. Searches of the messages table go back to the archive's cutoff,
+# not this, so history that hasn't been archived yet is still found.
+HOT_HISTORY = timedelta(days=730)
+
+# how far a message's timestamp (database clock) may trail the time in its
+# id (app clock)
+ID_CLOCK_SKEW = timedelta(minutes=5)
 
 
 class Follows(db.Model):
@@ -43,8 +67,157 @@ class Likes(db.Model):
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='cascade'),
+        index=True,
+    )
+
+
+class MessageTag(db.Model):
+    """A hashtag ('#') or mention ('@') found in a message."""
+
+    __tablename__ = 'message_tags'
+
+    kind = db.Column(
+        db.String(1),
+        primary_key=True,
+    )
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    # no foreign key: messages can be partitioned (see partitions.py), and
+    # then messages.id alone isn't unique. Message.tags deletes them.
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    @classmethod
+    def extract(cls, text):
+        """Return a MessageTag for each distinct hashtag and mention in `text`.
+
+        Hashtags are case-insensitive and stored lowercased; mentions keep
+        the username's case.
+        """
+
+        found = ({('#', tag.lower()) for tag in HASHTAG_RE.findall(text)}
+                 | {('@', name) for name in MENTION_RE.findall(text)})
+        return [cls(kind=kind, tag=tag) for kind, tag in sorted(found)]
+
+
+class TagCount(db.Model):
+    """How often a hashtag was used in one trending time bucket."""
+
+    __tablename__ = 'tag_counts'
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    bucket = db.Column(
+        db.DateTime,
+        primary_key=True,
+        index=True,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class Recommendation(db.Model):
+    """An account suggested for a user to follow (see recommend.py)."""
+
+    __tablename__ = 'recommendations'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    candidate_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+
+class Notification(db.Model):
+    """Likes or follows for one user, grouped by target and time bucket.
+
+    Written in batches by notifications.py; a like of message 5 in the same
+    hour as an earlier one adds to the earlier row rather than making one.
+    """
+
+    __tablename__ = 'notifications'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # 'like' or 'follow'
+    kind = db.Column(
+        db.String(10),
+        primary_key=True,
+    )
+
+    # the liked message's id; 0 for follows
+    target_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    bucket = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # the most recent few actors, newest first
+    actor_ids = db.Column(
+        ARRAY(db.Integer),
+        nullable=False,
+    )
+
+    # a snowflake id from the latest write: the inbox order and page key
+    seq = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+    unread = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=True,
+    )
+
+    __table_args__ = (
+        db.Index('ix_notifications_user_id_seq', user_id, seq.desc()),
+        db.Index('ix_notifications_unread', user_id,
+                 postgresql_where=unread),
     )
 
 
@@ -89,6 +262,21 @@ class User(db.Model):
         db.Text,
     )
 
+    # `location` resolved against the gazetteer, in the background (see
+    # nearby.py); all three are null when it couldn't be
+    latitude = db.Column(
+        db.Float,
+    )
+
+    longitude = db.Column(
+        db.Float,
+    )
+
+    # prefix-searchable: users in a geohash cell are a B-tree range
+    geohash = db.Column(
+        db.String(12),
+    )
+
     password = db.Column(
         db.Text,
         nullable=False,
@@ -115,9 +303,32 @@ class User(db.Model):
         secondary="likes"
     )
 
+    __table_args__ = (
+        # text_pattern_ops, so LIKE 'prefix%' can use it in any collation
+        db.Index('ix_users_geohash', geohash,
+                 postgresql_ops={'geohash': 'text_pattern_ops'}),
+    )
+
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    def who_to_follow(self, limit=5):
+        """Return recommended users this user doesn't already follow."""
+
+        already_following = (db.session
+                             .query(Follows)
+                             .filter(Follows.user_following_id == self.id,
+                                     Follows.user_being_followed_id == User.id)
+                             .exists())
+
+        return (User
+                .query
+                .join(Recommendation, Recommendation.candidate_id == User.id)
+                .filter(Recommendation.user_id == self.id, ~already_following)
+                .order_by(Recommendation.rank)
+                .limit(limit)
+                .all())
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
@@ -162,7 +373,8 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        rows = fetch(db.session(), 'warbler_users_by_username', username)
+        user = rows[0] if rows else None
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -177,9 +389,12 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    # time-ordered (see snowflake.py), so newest-first is id order
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=next_id,
     )
 
     text = db.Column(
@@ -190,7 +405,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        server_default=db.text("(now() at time zone 'utc')"),
     )
 
     user_id = db.Column(
@@ -199,8 +414,145 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # kept up to date in batches (see like_counts.py)
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
+    tags = db.relationship(
+        'MessageTag',
+        primaryjoin='Message.id == foreign(MessageTag.message_id)',
+        cascade="all,delete-orphan")
+
+    __table_args__ = (
+        db.Index('ix_messages_user_id_id', user_id, id.desc()),
+    )
+
+    # fetch the server-side timestamp with RETURNING on insert
+    __mapper_args__ = {'eager_defaults': True}
+
+    @staticmethod
+    def _widening(run, limit):
+        """Return run(since) for the last week, or if that doesn't find
+        `limit`, for everything not yet archived.
+
+        So at most two queries, and both only scan the partitions in their
+        time range.
+        """
+
+        messages = run(datetime.utcnow() - RECENT_WINDOW)
+        if len(messages) >= limit:
+            return messages
+        return run(_unarchived_since())
+
+    @classmethod
+    def most_recent(cls, query, limit=100):
+        """Return the `limit` newest messages from `query`, newest first.
+
+        Ids are time-ordered, so sorting needs no timestamp index.
+        """
+
+        query = query.order_by(cls.id.desc())
+
+        def run(since):
+            return query.filter(cls.timestamp >= since).limit(limit).all()
+
+        return cls._widening(run, limit)
+
+    @classmethod
+    def most_recent_baked(cls, baked_query, limit=100, **params):
+        """Like most_recent, for a baked query and its `params`."""
+
+        session = db.session()
+
+        def run(since):
+            query = baked_query + _since + _newest_first
+            return query(session).params(since=since, limit=limit,
+                                         **params).all()
+
+        return cls._widening(run, limit)
+
+    @classmethod
+    def user_timeline(cls, user_id, limit=100):
+        """Return `user_id`'s newest messages."""
+
+        return cls.most_recent_baked(USER_MESSAGES, limit, user_id=user_id)
+
+    @classmethod
+    def home_timeline(cls, user_ids, limit=100):
+        """Return the newest messages by any of `user_ids`."""
+
+        return cls.most_recent_baked(HOME_MESSAGES, limit,
+                                     user_ids=list(user_ids))
+
+    @classmethod
+    def count_since(cls, user_ids, since_id):
+        """Return how many messages by `user_ids` came after `since_id`."""
+
+        return (COUNT_SINCE(db.session())
+                .params(user_ids=list(user_ids),
+                        since_id=since_id,
+                        since=id_time(since_id) - ID_CLOCK_SKEW)
+                .scalar())
+
+
+def _unarchived_since():
+    """Return the oldest time a message in the table can have: the
+    archive's cutoff, or if nothing has been archived, the beginning."""
+
+    archive = (current_app.extensions.get('archive')
+               if has_app_context() else None)
+    cutoff = archive.cutoff if archive is not None else None
+    return cutoff or datetime.min
+
+
+def _since(query):
+    return query.filter(Message.timestamp >= bindparam('since'))
+
+
+def _after_id(query):
+    return query.filter(Message.id > bindparam('since_id'),
+                        Message.timestamp >= bindparam('since'))
+
+
+def _newest_first(query):
+    return query.order_by(Message.id.desc()).limit(bindparam('limit'))
+
+
+USER_MESSAGES = bakery(lambda s: s.query(Message).filter(
+    Message.user_id == bindparam('user_id')))
+
+HOME_MESSAGES = bakery(lambda s: s.query(Message)
+                       .join(User)
+                       .join(Follows, User.id == Follows.user_following_id)
+                       .filter(Message.user_id.in_(
+                           bindparam('user_ids', expanding=True))))
+
+# counts what projections.home_timeline_since would return
+COUNT_SINCE = HOME_MESSAGES + _after_id + (
+    lambda q: q.with_entities(db.func.count(db.distinct(Message.id))))
+
+register('warbler_users_by_username', User, 'username = $1')
+register('warbler_users_by_id', User, 'id = $1')
+register('warbler_messages_by_id', Message, 'id = $1')
+
+
+def get_by_id(model, pk):
+    """Like model.query.get(pk), through a prepared statement."""
+
+    session = db.session()
+    obj = session.identity_map.get(identity_key(model, pk))
+    if obj is not None:
+        return obj
+
+    rows = fetch(session, f"warbler_{model.__tablename__}_by_id", pk)
+    return rows[0] if rows else None
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
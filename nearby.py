@@ -0,0 +1,437 @@
+"""Users near me.
+
+Profile locations are free text. They're resolved against a bundled,
+offline gazetteer (gazetteer.csv, the world's larger cities, most
+populous first, so "Birmingham" is the bigger one) into a latitude,
+longitude and geohash on each user. That happens on a background thread
+when a profile's location changes, not on the request.
+
+Two indexes answer "the K users nearest here", chosen by NEARBY_INDEX:
+
+- 'geohash' (the default), in SQL. users.geohash has a prefix-searchable
+  B-tree, so the users in a geohash cell are one index range. The search
+  takes the 3x3 block of small cells around the point and moves to
+  coarser cells until the K nearest it found are within the distance the
+  block certainly covers, so they are the K nearest overall. Dense areas
+  stop at small cells; sparse ones stop at NEARBY_MIN_PRECISION (cells
+  of about 1250 km) with the nearest found so far. Either way it's at
+  most a few range scans.
+- 'kdtree', in memory. This is a scipy cKDTree over every located
+  user's position on the unit sphere, rebuilt every
+  NEARBY_REFRESH_SECONDS. Lookups are exact and don't touch the
+  database, at the cost of one tree per worker and locations that are
+  up to a refresh old. numpy and scipy are only imported when it's used,
+  as they'd otherwise add a few hundred ms to every worker's start.
+
+    python nearby.py migrate    # add the columns and index
+    python nearby.py geocode    # resolve every user's location
+"""
+
+import csv
+import math
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import unicodedata
+
+from flask import current_app
+from sqlalchemy import text
+
+from models import db
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'gazetteer.csv')
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+GEOHASH_PRECISION = 9
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+MIGRATE_SQL = """
+    ALTER TABLE users
+        ADD COLUMN IF NOT EXISTS latitude DOUBLE PRECISION,
+        ADD COLUMN IF NOT EXISTS longitude DOUBLE PRECISION,
+        ADD COLUMN IF NOT EXISTS geohash VARCHAR(12);
+    CREATE INDEX IF NOT EXISTS ix_users_geohash
+        ON users (geohash text_pattern_ops);
+"""
+
+# only writes if the location is still the one resolved
+GEOCODE_SQL = text("""
+    UPDATE users
+    SET latitude = :latitude, longitude = :longitude, geohash = :geohash
+    WHERE id = :user_id AND location IS NOT DISTINCT FROM :location
+""")
+
+
+def geohash_encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    """Return the geohash of (latitude, longitude), `precision` chars long."""
+
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    even = True
+    for bit in range(precision * 5):
+        # even bits split longitude, odd ones latitude
+        span, value = (lon_range, longitude) if even else (lat_range, latitude)
+        middle = (span[0] + span[1]) / 2
+        if value >= middle:
+            bits = bits * 2 + 1
+            span[0] = middle
+        else:
+            bits = bits * 2
+            span[1] = middle
+        even = not even
+        if bit % 5 == 4:
+            chars.append(BASE32[bits])
+            bits = 0
+    return "".join(chars)
+
+
+def cell_size(precision):
+    """Return (degrees of latitude, of longitude) spanned by a cell."""
+
+    bits = precision * 5
+    return 180 / 2 ** (bits // 2), 360 / 2 ** ((bits + 1) // 2)
+
+
+def geohash_block(latitude, longitude, precision):
+    """Return the cell holding the point and its (up to) 8 neighbours."""
+
+    lat_step, lon_step = cell_size(precision)
+    cells = set()
+    for dlat in (-1, 0, 1):
+        lat = latitude + dlat * lat_step
+        if not -90 <= lat <= 90:
+            continue
+        for dlon in (-1, 0, 1):
+            lon = (longitude + dlon * lon_step + 180) % 360 - 180
+            cells.add(geohash_encode(lat, lon, precision))
+    return sorted(cells)
+
+
+def block_radius_km(latitude, precision):
+    """Return a distance every point within is inside geohash_block().
+
+    The point is in the middle cell, so it's at least a cell from the
+    block's edge; cells narrow towards the poles, so the width is taken
+    at the block's poleward edge.
+    """
+
+    lat_step, lon_step = cell_size(precision)
+    poleward = min(90.0, abs(latitude) + 2 * lat_step)
+    return KM_PER_DEGREE * min(lat_step,
+                               lon_step * math.cos(math.radians(poleward)))
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Return the great-circle distance between two points."""
+
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def normalize(name):
+    """Lowercase, unaccented, punctuation as spaces: "São Paulo" is
+    "sao paulo"."""
+
+    name = unicodedata.normalize('NFKD', name)
+    name = "".join(c for c in name if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^\w]+", " ", name.lower()).split())
+
+
+class Gazetteer:
+    """Place names to (latitude, longitude)."""
+
+    def __init__(self, places):
+        self._places = places
+
+    @classmethod
+    def load(cls, path=GAZETTEER_PATH):
+        """Load a CSV of name, aliases (|-separated), region, country,
+        latitude and longitude, most populous first."""
+
+        places = {}
+        with open(path, encoding='utf-8', newline='') as f:
+            for row in csv.DictReader(f):
+                point = (float(row['latitude']), float(row['longitude']))
+                names = [row['name']] + [alias for alias in
+                                         row['aliases'].split('|') if alias]
+                for name in map(normalize, names):
+                    # earlier, bigger places keep ambiguous names
+                    places.setdefault(name, point)
+                    for qualifier in (row['region'], row['country']):
+                        if qualifier:
+                            places.setdefault(
+                                f"{name}, {normalize(qualifier)}", point)
+        return cls(places)
+
+    def resolve(self, location):
+        """Return (latitude, longitude) for free-text `location`, or None.
+
+        Tries "city, region-or-country", then the city alone.
+        """
+
+        parts = [normalize(part) for part in (location or "").split(',')]
+        parts = [part for part in parts if part]
+        if not parts:
+            return None
+        if len(parts) > 1:
+            point = self._places.get(f"{parts[0]}, {parts[1]}")
+            if point:
+                return point
+        return self._places.get(parts[0])
+
+
+class Geocoder:
+    """Resolves users' locations on a background thread."""
+
+    def __init__(self, engine, gazetteer_path=GAZETTEER_PATH, logger=None):
+        self.engine = engine
+        self.gazetteer_path = gazetteer_path
+        self.logger = logger
+        self._gazetteer = None
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread_pid = None
+
+    @property
+    def gazetteer(self):
+        if self._gazetteer is None:
+            self._gazetteer = Gazetteer.load(self.gazetteer_path)
+        return self._gazetteer
+
+    def geocode(self, conn, user_id, location):
+        """Resolve `location` and store it on `user_id`, unless it changed
+        again meanwhile. Returns the point, or None."""
+
+        point = self.gazetteer.resolve(location)
+        latitude, longitude = point or (None, None)
+        conn.execute(GEOCODE_SQL, {
+            'user_id': user_id, 'location': location,
+            'latitude': latitude, 'longitude': longitude,
+            'geohash': geohash_encode(*point) if point else None})
+        return point
+
+    def geocode_later(self, user_id, location):
+        """Queue `user_id`'s new `location` to be resolved."""
+
+        self._start_worker()
+        self._queue.put((user_id, location))
+
+    def join(self):
+        """Wait until everything queued has been resolved."""
+
+        self._queue.join()
+
+    def _start_worker(self):
+        # one thread per process; a forked worker needs its own
+        if self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            user_id, location = self._queue.get()
+            try:
+                with self.engine.begin() as conn:
+                    self.geocode(conn, user_id, location)
+            except Exception:
+                if self.logger:
+                    self.logger.exception("couldn't geocode user %s",
+                                          user_id)
+            finally:
+                self._queue.task_done()
+
+
+def nearest_sql(cells):
+    """Return the nearest-first query over `cells` geohash prefixes."""
+
+    prefixes = " OR ".join(f"geohash LIKE :cell{i}" for i in range(cells))
+    # equirectangular, which orders nearby points as the sphere does
+    return text(f"""
+        SELECT id, latitude, longitude
+        FROM users
+        WHERE ({prefixes}) AND id <> :exclude_id
+        ORDER BY power(latitude - :latitude, 2)
+                 + power(least(abs(longitude - :longitude),
+                               360 - abs(longitude - :longitude))
+                         * :lon_scale, 2)
+        LIMIT :k
+    """)
+
+
+class GeohashIndex:
+    """Nearest users by widening geohash blocks, in SQL."""
+
+    def __init__(self, max_precision=6, min_precision=2):
+        self.max_precision = max_precision
+        self.min_precision = min_precision
+
+    def nearest(self, latitude, longitude, k, exclude_id=None):
+        """Return [(user id, km)] of the `k` users nearest the point."""
+
+        params = {'latitude': latitude, 'longitude': longitude, 'k': k,
+                  'exclude_id': exclude_id or 0,
+                  'lon_scale': math.cos(math.radians(latitude))}
+
+        found = []
+        for precision in range(self.max_precision, self.min_precision - 1,
+                               -1):
+            cells = geohash_block(latitude, longitude, precision)
+            for i, cell in enumerate(cells):
+                params[f'cell{i}'] = cell + '%'
+            rows = db.session.execute(nearest_sql(len(cells)), params)
+
+            found = sorted(
+                (distance_km(latitude, longitude, lat, lon), user_id)
+                for user_id, lat, lon in rows)
+            if (len(found) == k
+                    and found[-1][0] <= block_radius_km(latitude, precision)):
+                break
+
+        return [(user_id, km) for km, user_id in found]
+
+
+def unit_vectors(latitudes, longitudes):
+    """Return points on the unit sphere, where straight-line distance
+    orders pairs as great-circle distance does."""
+
+    import numpy as np
+
+    lat = np.radians(latitudes)
+    lon = np.radians(longitudes)
+    return np.column_stack((np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon),
+                            np.sin(lat)))
+
+
+class KDTreeIndex:
+    """Nearest users from an in-memory k-d tree, reloaded periodically."""
+
+    def __init__(self, refresh_seconds=60, clock=time.monotonic):
+        self.refresh_seconds = refresh_seconds
+        self.clock = clock
+        self._tree = None
+        self._ids = None
+        self._loaded_at = None
+        self._loading = threading.Lock()
+
+    def load(self):
+        """Rebuild the tree from every located user."""
+
+        import numpy as np
+        from scipy.spatial import cKDTree
+
+        rows = db.session.execute(text("""
+            SELECT id, latitude, longitude FROM users
+            WHERE latitude IS NOT NULL
+        """)).fetchall()
+        points = np.array([(lat, lon) for _, lat, lon in rows],
+                          dtype=np.float64).reshape(-1, 2)
+
+        tree = cKDTree(unit_vectors(points[:, 0], points[:, 1]))
+        ids = np.array([user_id for user_id, _, _ in rows], dtype=np.int64)
+        # one assignment, so lookups never see a tree with the wrong ids
+        self._tree = (tree, ids)
+        self._loaded_at = self.clock()
+
+    def _refresh_if_stale(self):
+        loaded_at = self._loaded_at
+        if (loaded_at is not None
+                and self.clock() - loaded_at < self.refresh_seconds):
+            return
+
+        # one request reloads; the others use the old tree, unless none
+        if self._loading.acquire(blocking=loaded_at is None):
+            try:
+                if self._loaded_at == loaded_at:
+                    self.load()
+            finally:
+                self._loading.release()
+
+    def nearest(self, latitude, longitude, k, exclude_id=None):
+        """Return [(user id, km)] of the `k` users nearest the point."""
+
+        import numpy as np
+
+        self._refresh_if_stale()
+        tree, ids = self._tree
+        if not len(ids):
+            return []
+
+        # one extra, in case it's the user asking
+        count = min(k + 1, len(ids))
+        chords, indexes = tree.query(
+            unit_vectors([latitude], [longitude])[0], k=count)
+        chords, indexes = np.atleast_1d(chords), np.atleast_1d(indexes)
+
+        found = []
+        for chord, index in zip(chords, indexes):
+            user_id = int(ids[index])
+            if user_id != exclude_id:
+                angle = 2 * math.asin(min(1.0, chord / 2))
+                found.append((user_id, angle * EARTH_RADIUS_KM))
+        return found[:k]
+
+
+def init_nearby(app):
+    """Attach a geocoder and a nearest-users index to `app`."""
+
+    app.config.setdefault('NEARBY_INDEX', 'geohash')
+    app.config.setdefault('NEARBY_GAZETTEER', GAZETTEER_PATH)
+    app.config.setdefault('NEARBY_MIN_PRECISION', 2)
+    app.config.setdefault('NEARBY_REFRESH_SECONDS', 60)
+
+    app.extensions['geocoder'] = Geocoder(db.get_engine(app),
+                                          app.config['NEARBY_GAZETTEER'],
+                                          logger=app.logger)
+    if app.config['NEARBY_INDEX'] == 'kdtree':
+        index = KDTreeIndex(app.config['NEARBY_REFRESH_SECONDS'])
+    else:
+        index = GeohashIndex(
+            min_precision=app.config['NEARBY_MIN_PRECISION'])
+    app.extensions['nearby'] = index
+
+
+def get_geocoder():
+    """Return the current app's geocoder."""
+
+    return current_app.extensions['geocoder']
+
+
+def get_nearby():
+    """Return the current app's nearest-users index."""
+
+    return current_app.extensions['nearby']
+
+
+if __name__ == '__main__':
+    from app import app
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'geocode'
+
+    with app.app_context(), db.engine.begin() as conn:
+        if command == 'migrate':
+            conn.execute(text(MIGRATE_SQL))
+        elif command == 'geocode':
+            geocoder = get_geocoder()
+            rows = conn.execute(text(
+                "SELECT id, location FROM users")).fetchall()
+            resolved = sum(geocoder.geocode(conn, user_id, location)
+                           is not None for user_id, location in rows)
+            print(f"resolved {resolved} of {len(rows)} locations")
+        else:
+            sys.exit(f"usage: {sys.argv[0]} migrate|geocode")
@@ -0,0 +1,183 @@
+"""Aggregated like and follow notifications, written in batches.
+
+A notification row covers every like of one message, or every follow,
+that one user received in one time bucket (NOTIFICATION_BUCKET_SECONDS),
+so a viral warble is "alice and 37 others liked your warble", one row,
+rather than 38 of them. Each row keeps the count and the last few actors.
+
+Events are added to a per-process buffer (see buffered.py), which
+merges events for the same row, and the buffer is written every
+`flush_seconds` with one INSERT ... ON CONFLICT DO UPDATE for every row
+touched. A burst of likes on one message then costs one row write per
+flush, however many there are. A worker that dies loses up to `flush_seconds` of notifications,
+which are a courtesy rather than a record.
+
+The inbox is ordered by `seq`, a snowflake id taken when a row was last
+written, so updated rows move to the top and pages are keyed by the last
+seq shown.
+"""
+
+from datetime import datetime
+
+from flask import current_app, g
+from sqlalchemy import text
+
+from buffered import BufferedWriter
+from models import db, Notification
+from replicas import use_primary
+from snowflake import next_id, millis
+
+# actors kept per row, newest first
+ACTORS_KEPT = 3
+
+UNREAD_CAP = 100
+
+
+def upsert_sql(count):
+    """Return the batched upsert for `count` rows.
+
+    Rows for users deleted since the event are dropped, rather than
+    failing the whole batch on the foreign key.
+    """
+
+    values = ", ".join(
+        f"(CAST(:user_id{i} AS INTEGER), CAST(:kind{i} AS VARCHAR),"
+        f" CAST(:target_id{i} AS BIGINT), CAST(:bucket{i} AS TIMESTAMP),"
+        f" CAST(:count{i} AS INTEGER), CAST(:actor_ids{i} AS INTEGER[]),"
+        f" CAST(:seq{i} AS BIGINT))"
+        for i in range(count))
+    return text(f"""
+        INSERT INTO notifications
+            (user_id, kind, target_id, bucket, count, actor_ids, seq, unread)
+        SELECT v.*, true
+        FROM (VALUES {values})
+            AS v (user_id, kind, target_id, bucket, count, actor_ids, seq)
+        JOIN users ON users.id = v.user_id
+        ON CONFLICT (user_id, kind, target_id, bucket) DO UPDATE SET
+            count = notifications.count + excluded.count,
+            actor_ids = (excluded.actor_ids
+                         || notifications.actor_ids)[1:{ACTORS_KEPT}],
+            seq = excluded.seq,
+            unread = true
+    """)
+
+
+class NotificationBuffer(BufferedWriter):
+    """Merge notification events in memory and write them in batches."""
+
+    def __init__(self, engine, flush_seconds=0.25, bucket_seconds=3600,
+                 clock=datetime.utcnow):
+        super().__init__(engine, flush_seconds)
+        self.bucket_seconds = bucket_seconds
+        self.clock = clock
+        self._pending = {}
+
+    def bucket(self, now):
+        """Return the start of the time bucket `now` falls in."""
+
+        start = millis(now) // 1000 // self.bucket_seconds * self.bucket_seconds
+        return datetime.utcfromtimestamp(start)
+
+    def add(self, user_id, kind, actor_id, target_id=0):
+        """Notify `user_id` that `actor_id` did `kind` (to `target_id`)."""
+
+        if user_id == actor_id:
+            return
+
+        key = (user_id, kind, target_id, self.bucket(self.clock()))
+        with self._lock:
+            count, actors = self._pending.get(key, (0, []))
+            actors = [actor_id] + [a for a in actors if a != actor_id]
+            self._pending[key] = (count + 1, actors[:ACTORS_KEPT])
+        self._start_flusher()
+
+    def _take(self):
+        pending = self._pending
+        self._pending = {}
+        return pending
+
+    def _write(self, conn, pending):
+        # a fixed order, so concurrent flushes can't deadlock
+        params = {}
+        for i, key in enumerate(sorted(pending)):
+            count, actors = pending[key]
+            (params[f"user_id{i}"], params[f"kind{i}"],
+             params[f"target_id{i}"], params[f"bucket{i}"]) = key
+            params[f"count{i}"] = count
+            params[f"actor_ids{i}"] = actors
+            params[f"seq{i}"] = next_id()
+
+        conn.execute(upsert_sql(len(pending)), params)
+        return len(pending)
+
+    def _restore(self, pending):
+        for key, (count, actors) in pending.items():
+            newer_count, newer = self._pending.get(key, (0, []))
+            merged = newer + [a for a in actors if a not in newer]
+            self._pending[key] = (count + newer_count, merged[:ACTORS_KEPT])
+
+
+def unread_count(user_id):
+    """Return `user_id`'s unread notifications, counting up to UNREAD_CAP."""
+
+    return db.session.execute(text("""
+        SELECT count(*) FROM (
+            SELECT 1 FROM notifications
+            WHERE user_id = :user_id AND unread
+            LIMIT :cap) AS unread
+    """), {'user_id': user_id, 'cap': UNREAD_CAP}).scalar()
+
+
+def inbox_page(user_id, before=None, limit=20):
+    """Return (notifications, next page's `before` or None), newest first."""
+
+    query = Notification.query.filter(Notification.user_id == user_id)
+    if before is not None:
+        query = query.filter(Notification.seq < before)
+    rows = query.order_by(Notification.seq.desc()).limit(limit + 1).all()
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return rows, (rows[-1].seq if more else None)
+
+
+def mark_read(user_id, up_to=None):
+    """Mark `user_id`'s notifications read, only up to seq `up_to` if given.
+
+    A row written since `up_to` was shown has a later seq, so stays unread.
+    """
+
+    query = Notification.query.filter_by(user_id=user_id, unread=True)
+    if up_to is not None:
+        query = query.filter(Notification.seq <= up_to)
+    use_primary(db.session)
+    query.update({'unread': False}, synchronize_session=False)
+    db.session.commit()
+
+
+def init_notifications(app):
+    """Attach a notification buffer to `app`, and the unread count to
+    templates."""
+
+    app.config.setdefault('NOTIFICATION_FLUSH_SECONDS', 0.25)
+    app.config.setdefault('NOTIFICATION_BUCKET_SECONDS', 3600)
+    app.extensions['notifications'] = NotificationBuffer(
+        db.get_engine(app),
+        flush_seconds=app.config['NOTIFICATION_FLUSH_SECONDS'],
+        bucket_seconds=app.config['NOTIFICATION_BUCKET_SECONDS'])
+
+    @app.context_processor
+    def unread_notifications():
+        # a function, so pages that don't show the count don't query it
+        def count():
+            if 'unread_notifications' not in g:
+                g.unread_notifications = (
+                    unread_count(g.user.id) if g.get('user') else 0)
+            return g.unread_notifications
+        return {'unread_notifications': count}
+
+
+def get_notifications():
+    """Return the current app's notification buffer."""
+
+    return current_app.extensions['notifications']
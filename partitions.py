@@ -0,0 +1,271 @@
+"""Monthly range partitioning of the messages table.
+
+Run once to convert an existing database:
+
+    python partitions.py migrate
+
+Partitions are then kept created MONTHS_AHEAD ahead by every worker, from
+a background thread that checks every PARTITION_CHECK_SECONDS;
+`python partitions.py ensure` does the same check by hand. Should they
+still lapse, messages for missing months go to the default partition, and
+the next check moves them into the month's partition as it creates it.
+
+Postgres requires the partition key in every unique constraint, so on a
+partitioned table the primary key becomes (id, timestamp) and likes can no
+longer have a foreign key to messages; neither can message_tags. A trigger
+takes over their ON DELETE CASCADE.
+"""
+
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+
+from models import db
+
+MONTHS_AHEAD = 3
+
+DEFAULT_PARTITION = 'messages_default'
+
+# any constant, as long as it's only used here
+ENSURE_LOCK_KEY = 0x7061727473
+
+IS_PARTITIONED_SQL = text("""
+    SELECT EXISTS (
+        SELECT 1 FROM pg_partitioned_table
+        WHERE partrelid = 'messages'::regclass)
+""")
+
+MIGRATE_SQL = [
+    "ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_fkey",
+    "ALTER TABLE message_tags "
+    "DROP CONSTRAINT IF EXISTS message_tags_message_id_fkey",
+    "ALTER TABLE messages RENAME TO messages_unpartitioned",
+    """CREATE TABLE messages (
+        id BIGINT NOT NULL,
+        text VARCHAR(140) NOT NULL,
+        timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL
+            DEFAULT (now() at time zone 'utc'),
+        user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+        like_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (id, timestamp)
+    ) PARTITION BY RANGE (timestamp)""",
+    f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF messages DEFAULT",
+]
+
+# Deletes a message's likes and tags, except while rows are being moved
+# between partitions, which deletes and reinserts them.
+DELETE_ROWS_FUNCTION_SQL = """
+    CREATE OR REPLACE FUNCTION delete_message_rows() RETURNS trigger AS $$
+    BEGIN
+        IF current_setting('warbler.moving_messages', true) = 'on' THEN
+            RETURN OLD;
+        END IF;
+        DELETE FROM likes WHERE message_id = OLD.id;
+        DELETE FROM message_tags WHERE message_id = OLD.id;
+        RETURN OLD;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+COPY_SQL = [
+    """INSERT INTO messages (id, text, timestamp, user_id, like_count)
+       SELECT id, text, timestamp, user_id, like_count
+       FROM messages_unpartitioned""",
+    "DROP TABLE messages_unpartitioned",
+    "CREATE INDEX ix_messages_user_id_id ON messages (user_id, id DESC)",
+    DELETE_ROWS_FUNCTION_SQL,
+    """CREATE TRIGGER messages_delete_rows AFTER DELETE ON messages
+       FOR EACH ROW EXECUTE PROCEDURE delete_message_rows()""",
+]
+
+
+def month_start(dt):
+    """Return midnight on the first of `dt`'s month."""
+
+    return datetime(dt.year, dt.month, 1)
+
+
+def next_month(dt):
+    """Return the first of the month after `dt`'s month."""
+
+    if dt.month == 12:
+        return datetime(dt.year + 1, 1, 1)
+    return datetime(dt.year, dt.month + 1, 1)
+
+
+def partition_name(start):
+    return f"messages_p{start.year:04d}_{start.month:02d}"
+
+
+def is_partitioned(conn):
+    """Has the messages table been converted already?"""
+
+    return conn.execute(IS_PARTITIONED_SQL).scalar()
+
+
+def create_partition(conn, start):
+    """Create the partition for the month starting `start`, moving its rows
+    out of the default partition. Returns False if it already existed."""
+
+    name = partition_name(start)
+    if conn.execute(text("SELECT to_regclass(:name)"), name=name).scalar():
+        return False
+
+    bounds = {'start': start, 'end': next_month(start)}
+    stray = conn.execute(text(
+        f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION}"
+        f" WHERE timestamp >= :start AND timestamp < :end)"), bounds).scalar()
+    if stray:
+        # created apart and attached once filled, as the new partition's
+        # range can't overlap rows still in the default one; and with the
+        # default partition locked, so no more arrive meanwhile
+        conn.execute(text(f"LOCK TABLE {DEFAULT_PARTITION}"))
+        conn.execute(text(DELETE_ROWS_FUNCTION_SQL))
+        conn.execute(text("SET LOCAL warbler.moving_messages = 'on'"))
+        conn.execute(text(
+            f"CREATE TABLE {name}"
+            f" (LIKE messages INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+        conn.execute(text(
+            f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION}"
+            f" WHERE timestamp >= :start AND timestamp < :end RETURNING *)"
+            f" INSERT INTO {name} SELECT * FROM moved"), bounds)
+        conn.execute(text(
+            f"ALTER TABLE messages ATTACH PARTITION {name}"
+            f" FOR VALUES FROM ('{start.isoformat()}')"
+            f" TO ('{bounds['end'].isoformat()}')"))
+        conn.execute(text("SET LOCAL warbler.moving_messages = 'off'"))
+    else:
+        conn.execute(text(
+            f"CREATE TABLE {name} PARTITION OF messages"
+            f" FOR VALUES FROM ('{start.isoformat()}')"
+            f" TO ('{bounds['end'].isoformat()}')"))
+    return True
+
+
+def create_partitions(conn, first, last):
+    """Create monthly partitions covering `first` through `last`.
+
+    Returns the number created.
+    """
+
+    created = 0
+    start = month_start(first)
+    while start <= last:
+        created += create_partition(conn, start)
+        start = next_month(start)
+    return created
+
+
+def ensure_partitions(conn, months_ahead=MONTHS_AHEAD, now=None):
+    """Make sure partitions exist from this month to `months_ahead` out,
+    and for any month with messages in the default partition.
+
+    Returns the number created. Concurrent calls take turns.
+    """
+
+    conn.execute(text("SELECT pg_advisory_xact_lock(:key)"),
+                 key=ENSURE_LOCK_KEY)
+    now = now or datetime.utcnow()
+    first = conn.execute(text(
+        f"SELECT min(timestamp) FROM {DEFAULT_PARTITION}")).scalar()
+    last = now
+    for _ in range(months_ahead):
+        last = next_month(last)
+    return create_partitions(conn, min(first or now, now), last)
+
+
+def migrate(conn, months_ahead=MONTHS_AHEAD):
+    """Convert messages to a partitioned table, keeping every row."""
+
+    if is_partitioned(conn):
+        return
+
+    first, last = conn.execute(text(
+        "SELECT min(timestamp), max(timestamp) FROM messages")).first()
+
+    for statement in MIGRATE_SQL:
+        conn.execute(text(statement))
+
+    if first is not None:
+        create_partitions(conn, first, last)
+    ensure_partitions(conn, months_ahead)
+
+    for statement in COPY_SQL:
+        conn.execute(text(statement))
+
+
+def ensure_if_partitioned(engine, months_ahead=MONTHS_AHEAD):
+    """Run ensure_partitions if messages is partitioned. Returns the
+    number of partitions created."""
+
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            return 0
+        return ensure_partitions(conn, months_ahead)
+
+
+class PartitionKeeper:
+    """Run ensure_partitions every `check_seconds` from a background
+    thread."""
+
+    def __init__(self, engine, check_seconds=3600, months_ahead=MONTHS_AHEAD,
+                 logger=None):
+        self.engine = engine
+        self.check_seconds = check_seconds
+        self.months_ahead = months_ahead
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._thread_pid = None
+
+    def start(self):
+        # one thread per process; a forked worker needs its own
+        if self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                ensure_if_partitioned(self.engine, self.months_ahead)
+            except Exception:
+                if self.logger:
+                    self.logger.exception("couldn't create partitions")
+            time.sleep(self.check_seconds)
+
+
+def init_partitions(app):
+    """Keep message partitions created ahead of time while `app` serves.
+
+    The check starts with the first request a worker handles, so it runs
+    in each worker rather than in a pre-forking parent.
+    """
+
+    app.config.setdefault('PARTITION_CHECK_SECONDS', 3600)
+    keeper = PartitionKeeper(db.get_engine(app),
+                             app.config['PARTITION_CHECK_SECONDS'],
+                             logger=app.logger)
+    app.extensions['partitions'] = keeper
+    if keeper.check_seconds:
+        app.before_request(keeper.start)
+
+
+if __name__ == '__main__':
+    from app import app
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'ensure'
+
+    with app.app_context(), db.engine.begin() as conn:
+        if command == 'migrate':
+            migrate(conn)
+        elif command == 'ensure':
+            print(f"created {ensure_partitions(conn)} partitions")
+        else:
+            sys.exit(f"usage: {sys.argv[0]} [migrate|ensure]")
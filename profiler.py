@@ -0,0 +1,283 @@
+"""Sampling profiler for individual requests, with flame graph output.
+
+A sampled request has its thread's stack read every PROFILE_INTERVAL
+seconds by a background thread, and the stacks are counted in collapsed
+form ("outer;inner;innermost count"), the input format of flamegraph.pl
+and speedscope. Frames are labelled with their function and file, and
+Jinja template code shows up under the template's own file, so time in
+SQL, ORM loading and rendering home.html can be told apart.
+
+Requests are sampled at random (PROFILE_SAMPLE_RATE, a fraction), or on
+demand by sending the PROFILE_TOKEN secret in the X-Warbler-Profile
+header. Each profile is written to
+
+    PROFILE_DIR/<endpoint>/<time>-<pid>-<n>.folded
+
+Merge the profiles of an endpoint into one collapsed file and an SVG
+flame graph with:
+
+    python profiler.py warbler.homepage
+
+Only sampled requests pay for profiling; the sampler thread idles when
+none are running. Stacks are read with sys._current_frames, so under
+serve.py's gevent workers only the greenlet running at sample time is
+seen.
+"""
+
+import hmac
+import html
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import datetime
+
+from flask import current_app, request, g
+
+PROFILE_HEADER = 'X-Warbler-Profile'
+
+_BASE = os.path.dirname(os.path.abspath(__file__))
+_LIBS = [path for path in sys.path if path.endswith('-packages')]
+
+
+def frame_label(code):
+    """Return "function (file)" for a code object, with short paths."""
+
+    filename = code.co_filename
+    for prefix in _LIBS + [_BASE]:
+        if filename.startswith(prefix + os.sep):
+            filename = filename[len(prefix) + 1:]
+            break
+    return f"{code.co_name} ({filename})"
+
+
+def collapse(frame):
+    """Return the stack ending at `frame`, outermost first, ;-joined."""
+
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class Sampler:
+    """Count the stacks of the threads being profiled, at intervals."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._profiles = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def start(self, thread_id=None):
+        """Start counting stacks of `thread_id` (default: this thread)."""
+
+        if thread_id is None:
+            thread_id = threading.get_ident()
+        with self._lock:
+            self._profiles[thread_id] = Counter()
+            self._ensure_thread()
+        self._wake.set()
+
+    def stop(self, thread_id=None):
+        """Stop profiling `thread_id`; return its stack counts."""
+
+        if thread_id is None:
+            thread_id = threading.get_ident()
+        with self._lock:
+            return self._profiles.pop(thread_id, Counter())
+
+    def sample(self):
+        """Count the current stack of every thread being profiled."""
+
+        frames = sys._current_frames()
+        with self._lock:
+            for thread_id, counts in self._profiles.items():
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    counts[collapse(frame)] += 1
+
+    def _ensure_thread(self):
+        # forked workers don't inherit the parent's thread
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name='profiler', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                idle = not self._profiles
+            if idle:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            time.sleep(self.interval)
+            self.sample()
+
+
+class RequestProfiler:
+    """Decide which requests to profile, and write their profiles."""
+
+    def __init__(self, directory, sample_rate=0.0, token=None,
+                 interval=0.005):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.token = token
+        self.sampler = Sampler(interval)
+        self._names = itertools.count()
+
+    def wants(self, req):
+        """Should request `req` be profiled?"""
+
+        sent = req.headers.get(PROFILE_HEADER)
+        if sent and self.token and hmac.compare_digest(sent, self.token):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def write(self, endpoint, counts):
+        """Write `counts` for one request of `endpoint`; return the path."""
+
+        directory = os.path.join(self.directory, endpoint or 'unknown')
+        os.makedirs(directory, exist_ok=True)
+        name = (f"{datetime.utcnow():%Y%m%dT%H%M%S}-{os.getpid()}-"
+                f"{next(self._names)}.folded")
+        path = os.path.join(directory, name)
+
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            write_folded(f, counts)
+        os.replace(tmp, path)
+        return path
+
+
+def write_folded(f, counts):
+    for stack, count in sorted(counts.items()):
+        f.write(f"{stack} {count}\n")
+
+
+def read_folded(path):
+    counts = Counter()
+    with open(path) as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack:
+                counts[stack] += int(count)
+    return counts
+
+
+def merge(directory, endpoint):
+    """Return the summed stack counts of every profile of `endpoint`."""
+
+    total = Counter()
+    endpoint_dir = os.path.join(directory, endpoint)
+    for name in sorted(os.listdir(endpoint_dir)):
+        if name.endswith('.folded'):
+            total.update(read_folded(os.path.join(endpoint_dir, name)))
+    return total
+
+
+def flame_graph_svg(counts, title="", width=1200, row=16):
+    """Return an SVG flame graph of collapsed stack `counts`."""
+
+    # tree of {label: [count, children]}
+    root = [0, {}]
+    for stack, count in counts.items():
+        node = root
+        node[0] += count
+        for label in stack.split(';'):
+            node = node[1].setdefault(label, [0, {}])
+            node[0] += count
+
+    def depth(node):
+        return 1 + max((depth(child) for child in node[1].values()),
+                       default=0)
+
+    height = (depth(root) + 1) * row
+    scale = width / root[0] if root[0] else 0
+    rects = []
+
+    def draw(node, x, level):
+        for label, child in sorted(node[1].items()):
+            w = child[0] * scale
+            y = height - (level + 1) * row
+            hue = 20 + zlib.crc32(label.encode()) % 40
+            text = html.escape(label)
+            rects.append(
+                f'<g><title>{text} ({child[0]} samples, '
+                f'{child[0] / root[0]:.1%})</title>'
+                f'<rect x="{x:.1f}" y="{y}" width="{max(w - 0.5, 0.1):.1f}" '
+                f'height="{row - 1}" fill="hsl({hue},90%,55%)"/>'
+                + (f'<text x="{x + 3:.1f}" y="{y + row - 4}">'
+                   f'{html.escape(label[:int(w / 7)])}</text>'
+                   if w > 35 else '')
+                + '</g>')
+            draw(child, x, level + 1)
+            x += w
+
+    draw(root, 0, 0)
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" '
+            f'height="{height}" font-family="monospace" font-size="11">'
+            f'<text x="4" y="12">{html.escape(title)} '
+            f'({root[0]} samples)</text>'
+            + "".join(rects) + '</svg>')
+
+
+def init_profiler(app):
+    """Profile sampled requests to `app`, writing to PROFILE_DIR."""
+
+    app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+    app.config.setdefault('PROFILE_TOKEN', None)
+    app.config.setdefault('PROFILE_INTERVAL', 0.005)
+    app.config.setdefault(
+        'PROFILE_DIR',
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles'))
+
+    app.extensions['profiler'] = RequestProfiler(
+        app.config['PROFILE_DIR'],
+        app.config['PROFILE_SAMPLE_RATE'],
+        app.config['PROFILE_TOKEN'],
+        app.config['PROFILE_INTERVAL'])
+
+    @app.before_request
+    def start_profile():
+        profiler = get_profiler()
+        if profiler.wants(request):
+            g.profiling = True
+            profiler.sampler.start()
+
+    @app.teardown_request
+    def finish_profile(exc):
+        if g.pop('profiling', False):
+            profiler = get_profiler()
+            # written even when empty, so the files count profiled requests
+            profiler.write(request.endpoint, profiler.sampler.stop())
+
+
+def get_profiler():
+    """Return the current app's request profiler."""
+
+    return current_app.extensions['profiler']
+
+
+if __name__ == '__main__':
+    from app import app
+
+    endpoint = sys.argv[1] if len(sys.argv) > 1 else 'warbler.homepage'
+    directory = app.config['PROFILE_DIR']
+
+    counts = merge(directory, endpoint)
+    with open(os.path.join(directory, f"{endpoint}.folded"), 'w') as f:
+        write_folded(f, counts)
+    with open(os.path.join(directory, f"{endpoint}.svg"), 'w') as f:
+        f.write(flame_graph_svg(counts, endpoint))
+    print(f"merged {sum(counts.values())} samples into "
+          f"{directory}/{endpoint}.folded and .svg")
@@ -0,0 +1,118 @@
+"""Read-only rows for rendering message lists.
+
+Timelines used to render full Message entities, each with its lazily
+loaded User, and check likes with `msg in g.user.likes`, which loads
+every message the viewer ever liked. For a 100-message page most of the
+time went on identity-map and instrumentation work for objects that are
+only read.
+
+These queries fetch just the columns a list shows, author included, in
+one joined query per page, into MessageRow tuples: immutable, no
+per-instance dict, nothing for the session to track. Likes are checked
+against `liked_ids`, the page's messages the viewer has liked.
+
+`python bench_projections.py` compares them with the ORM path.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy import bindparam
+
+from models import (db, User, Message, Follows, Likes, ID_CLOCK_SKEW,
+                    _since, _after_id, _newest_first)
+from queries import bakery
+from snowflake import id_time
+
+ROW_COLUMNS = (Message.id, Message.text, Message.timestamp,
+               Message.like_count, Message.user_id, User.username,
+               User.image_url)
+
+
+class MessageRow(namedtuple('MessageRow', [c.key for c in ROW_COLUMNS])):
+    """A message as lists show it, with its author's name and avatar."""
+
+    __slots__ = ()
+
+    # archived messages (archive.ArchivedMessage) can share lists with these
+    archived = False
+
+
+def _rows(query, **params):
+    return [MessageRow._make(row)
+            for row in query(db.session()).params(**params).all()]
+
+
+def _most_recent(baked_query, limit, **params):
+    def run(since):
+        return _rows(baked_query + _since + _newest_first,
+                     since=since, limit=limit, **params)
+
+    return Message._widening(run, limit)
+
+
+def user_timeline(user_id, limit=100):
+    """Return `user_id`'s newest messages."""
+
+    return _most_recent(USER_ROWS, limit, user_id=user_id)
+
+
+def home_timeline(user_ids, limit=100):
+    """Return the newest messages by any of `user_ids`."""
+
+    return _most_recent(HOME_ROWS, limit, user_ids=list(user_ids))
+
+
+def home_timeline_since(user_ids, since_id, limit=100):
+    """Return the newest messages by any of `user_ids` after `since_id`.
+
+    The timestamp bound, implied by the id, lets partitions be pruned.
+    """
+
+    return _rows(HOME_ROWS + _after_id + _newest_first,
+                 user_ids=list(user_ids),
+                 since_id=since_id,
+                 since=id_time(since_id) - ID_CLOCK_SKEW,
+                 limit=limit)
+
+
+def liked_messages(user_id):
+    """Return the messages `user_id` has liked, most recently liked first."""
+
+    return _rows(LIKED_ROWS, user_id=user_id)
+
+
+def liked_ids(user_id, messages):
+    """Return the ids of those of `messages` that `user_id` has liked."""
+
+    message_ids = [msg.id for msg in messages]
+    if not message_ids:
+        return set()
+    return {message_id for (message_id,) in
+            LIKED_IDS(db.session()).params(user_id=user_id,
+                                           message_ids=message_ids)}
+
+
+USER_ROWS = bakery(lambda s: s.query(*ROW_COLUMNS)
+                   .join(Message.user)
+                   .filter(Message.user_id == bindparam('user_id')))
+
+# like Message.home_timeline, only authors who follow someone are shown;
+# EXISTS rather than a join, as a column query isn't made unique by
+# identity the way an entity query is
+HOME_ROWS = bakery(lambda s: s.query(*ROW_COLUMNS)
+                   .join(Message.user)
+                   .filter(Message.user_id.in_(
+                       bindparam('user_ids', expanding=True)))
+                   .filter(db.exists().where(
+                       Follows.user_following_id == Message.user_id)))
+
+LIKED_ROWS = bakery(lambda s: s.query(*ROW_COLUMNS)
+                    .join(Message.user)
+                    .join(Likes, Likes.message_id == Message.id)
+                    .filter(Likes.user_id == bindparam('user_id'))
+                    .order_by(Likes.id.desc()))
+
+LIKED_IDS = bakery(lambda s: s.query(Likes.message_id)
+                   .filter(Likes.user_id == bindparam('user_id'),
+                           Likes.message_id.in_(
+                               bindparam('message_ids', expanding=True))))
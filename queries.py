@@ -0,0 +1,104 @@
+"""Registry of precompiled queries for the hottest lookups.
+
+`bakery` caches compiled SQL for baked queries, so a lookup built from the
+same lambdas skips SQLAlchemy's query construction and compilation after
+its first run.
+
+Single-row lookups can also be registered as server-side prepared
+statements. They are PREPAREd on every new Postgres connection and run
+with EXECUTE, so Postgres also skips parsing and planning:
+
+    register('warbler_users_by_username', User, 'username = $1')
+    rows = fetch(session, 'warbler_users_by_username', 'alice')
+
+On connections where preparing failed (e.g. before the tables exist), or
+when PREPARED_STATEMENTS is off, the same lookup runs as a baked query
+instead. Prepared statements don't survive transaction-mode poolers such
+as PgBouncer; turn PREPARED_STATEMENTS off behind one.
+"""
+
+import re
+
+from sqlalchemy import event, text
+from sqlalchemy.ext import baked
+
+PREPARED_KEY = 'warbler_prepared'
+
+bakery = baked.bakery(size=500)
+
+# name: (PREPARE body, baked EXECUTE query, baked fallback query)
+_statements = {}
+
+
+def register(name, model, where):
+    """Register a lookup of `model` rows matching `where` ($1, $2, ...)."""
+
+    table = model.__table__
+    columns = ", ".join(f'"{column.name}"' for column in table.columns)
+    params = sorted(set(re.findall(r'\$(\d+)', where)), key=int)
+
+    prepare_sql = f"SELECT {columns} FROM {table.name} WHERE {where}"
+
+    execute = text(
+        f"EXECUTE {name}({', '.join(f':p{n}' for n in params)})"
+    ).columns(*table.columns)
+    fallback = text(re.sub(r'\$(\d+)', r':p\1', where))
+
+    _statements[name] = (
+        prepare_sql,
+        bakery(lambda s: s.query(model).from_statement(execute), name),
+        bakery(lambda s: s.query(model).filter(fallback), name),
+    )
+
+
+def registered(name):
+    """Is `name` a registered lookup?"""
+
+    return name in _statements
+
+
+def prepare_all(dbapi_connection, connection_record):
+    """Pool 'connect' listener: PREPARE every registered statement."""
+
+    prepared = set()
+    cursor = dbapi_connection.cursor()
+    for name, (prepare_sql, _, _) in _statements.items():
+        try:
+            cursor.execute(f"PREPARE {name} AS {prepare_sql}")
+            dbapi_connection.commit()
+            prepared.add(name)
+        except Exception:
+            dbapi_connection.rollback()
+    cursor.close()
+    connection_record.info[PREPARED_KEY] = prepared
+
+
+def fetch(session, name, *params):
+    """Return the rows of registered lookup `name` as a list."""
+
+    _, execute, fallback = _statements[name]
+    values = {f"p{n}": value for n, value in enumerate(params, 1)}
+
+    connection = session.connection()
+    query = execute if name in connection.info.get(PREPARED_KEY, ()) \
+        else fallback
+    return query(session).params(**values).all()
+
+
+def init_queries(app):
+    """Prepare registered statements on `app`'s Postgres connections."""
+
+    from models import db
+
+    app.config.setdefault('PREPARED_STATEMENTS', True)
+    if not app.config['PREPARED_STATEMENTS']:
+        return
+
+    engines = [db.get_engine(app)]
+    router = app.extensions.get('replica_router')
+    if router is not None:
+        engines.extend(router.engines)
+
+    for engine in engines:
+        if engine.dialect.name == 'postgresql':
+            event.listen(engine, 'connect', prepare_all)
@@ -0,0 +1,195 @@
+"""Token-bucket rate limiting for write and login endpoints.
+
+Each limit is a bucket of `burst` tokens refilled evenly over `seconds`;
+a request takes one token and is refused with 429 and Retry-After when the
+bucket is empty. Limits are set per endpoint in RATE_LIMITS:
+
+    RATE_LIMITS = {'warbler.login': [('ip', 10, 60)]}
+
+allows 10 logins a minute per client IP, in bursts of up to 10. The 'user'
+scope counts per logged-in user (and per IP for anonymous requests).
+Behind a load balancer, set PROXY_COUNT so the client IP is taken from
+X-Forwarded-For; otherwise every client shares the balancer's bucket.
+Only writes are limited, and GETs of the same endpoints are not, except
+for the endpoints in LIMITED_READS.
+
+Buckets live in a memory-mapped file (under /dev/shm by default), so every
+worker on the machine shares them. Checking one costs a byte-range lock
+and a few reads and writes of shared memory, with no network round trip.
+"""
+
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from flask import current_app, request, session
+from werkzeug.exceptions import TooManyRequests
+
+from views import CURR_USER_KEY
+
+LIMITED_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+# reads limited too: availability would otherwise tell anyone, as fast as
+# they can ask, which emails have accounts, and an export reads everything
+# a user has
+LIMITED_READS = {'warbler.users_available', 'warbler.export_data'}
+
+DEFAULT_LIMITS = {
+    'warbler.login': [('ip', 10, 60)],
+    'warbler.signup': [('ip', 10, 3600)],
+    'warbler.users_available': [('ip', 60, 60)],
+    'warbler.messages_add': [('user', 30, 60)],
+    'warbler.add_like': [('user', 120, 60)],
+    'warbler.add_follow': [('user', 60, 60)],
+    'warbler.stop_following': [('user', 60, 60)],
+    'warbler.export_data': [('user', 5, 3600)],
+    'warbler.export_data_later': [('user', 5, 3600)],
+}
+
+# slot: key hash, tokens left, last update time (0 = unused)
+SLOT = struct.Struct('<Qdd')
+
+# a key lives in one group of this many slots, all locked together
+GROUP_SLOTS = 8
+
+
+def refill(tokens, updated, now, rate, burst):
+    """Return the tokens in a bucket last at `tokens` at time `updated`."""
+
+    if not updated:
+        return burst
+    return min(burst, tokens + max(0.0, now - updated) * rate)
+
+
+def take(tokens, rate):
+    """Take one token; return (allowed, tokens left, seconds to wait)."""
+
+    if tokens >= 1:
+        return True, tokens - 1, 0.0
+    return False, tokens, (1 - tokens) / rate
+
+
+def _key_hash(key):
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+
+class SharedBuckets:
+    """Buckets in a memory-mapped file shared between processes.
+
+    The file is a fixed-size hash table. When a key's slot group is full,
+    the least recently used bucket in it is replaced, which can only ever
+    hand that client a fresh (full) bucket.
+    """
+
+    def __init__(self, path, slots=65536):
+        self.groups = max(1, slots // GROUP_SLOTS)
+        size = self.groups * GROUP_SLOTS * SLOT.size
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+        # record locks are per process; threads also need a lock
+        self._lock = threading.Lock()
+
+    def hit(self, key, rate, burst, now=None):
+        """Take a token from `key`'s bucket; return (allowed, retry after)."""
+
+        now = time.time() if now is None else now
+        key_hash = _key_hash(key)
+        start = (key_hash % self.groups) * GROUP_SLOTS * SLOT.size
+        length = GROUP_SLOTS * SLOT.size
+
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, start)
+            try:
+                offset, tokens, updated = self._find(key_hash, start)
+                allowed, tokens, wait = take(
+                    refill(tokens, updated, now, rate, burst), rate)
+                SLOT.pack_into(self._map, offset, key_hash, tokens, now)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+
+        return allowed, wait
+
+    def _find(self, key_hash, start):
+        """Return (offset, tokens, updated) of `key_hash`'s slot.
+
+        A new key gets an unused slot, else the least recently used one.
+        """
+
+        victim = None
+        for offset in range(start, start + GROUP_SLOTS * SLOT.size,
+                            SLOT.size):
+            slot_hash, tokens, updated = SLOT.unpack_from(self._map, offset)
+            if slot_hash == key_hash:
+                return offset, tokens, updated
+            if victim is None or updated < victim[1]:
+                victim = (offset, updated)
+        return victim[0], 0.0, 0.0
+
+
+class RateLimiter:
+    """Check requests against per-endpoint limits."""
+
+    def __init__(self, buckets, limits):
+        self.buckets = buckets
+        self.limits = limits
+
+    def check(self):
+        """Raise TooManyRequests if this request is over a limit."""
+
+        if not current_app.config['RATELIMIT_ENABLED']:
+            return
+        if (request.method not in LIMITED_METHODS
+                and request.endpoint not in LIMITED_READS):
+            return
+
+        for scope, burst, seconds in self.limits.get(request.endpoint, ()):
+            who = self._identify(scope)
+            allowed, wait = self.buckets.hit(
+                f"{request.endpoint}:{who}", burst / seconds, burst)
+            if not allowed:
+                raise TooManyRequests(retry_after=math.ceil(wait))
+
+    @staticmethod
+    def _identify(scope):
+        if scope == 'user' and session.get(CURR_USER_KEY) is not None:
+            return f"user:{session[CURR_USER_KEY]}"
+        return f"ip:{request.remote_addr}"
+
+
+def _default_path():
+    shm = '/dev/shm'
+    root = shm if os.path.isdir(shm) else tempfile.gettempdir()
+    return os.path.join(root, 'warbler-ratelimit')
+
+
+def init_ratelimit(app):
+    """Attach a rate limiter to `app`, checked before every request."""
+
+    app.config.setdefault('RATELIMIT_ENABLED', True)
+    app.config.setdefault('RATELIMIT_PATH', _default_path())
+    app.config.setdefault('RATE_LIMITS', DEFAULT_LIMITS)
+
+    app.extensions['ratelimit'] = RateLimiter(
+        SharedBuckets(app.config['RATELIMIT_PATH']),
+        app.config['RATE_LIMITS'])
+
+    @app.before_request
+    def check_rate_limit():
+        get_ratelimit().check()
+
+
+def get_ratelimit():
+    """Return the current app's rate limiter."""
+
+    return current_app.extensions['ratelimit']
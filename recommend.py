@@ -0,0 +1,172 @@
+"""Offline "who to follow" recommendations.
+
+Loads follows as a sparse adjacency matrix A (A[u, v] = 1 when u follows v)
+and scores friends-of-friends: (A @ A)[u, c] is how many accounts u follows
+that follow c. Rows are processed in chunks across a process pool; chunks
+are sized so the product for one chunk stays under a fixed number of
+entries, which bounds memory however large the graph is. The top
+candidates per user replace that user's rows in the recommendations table.
+
+    python recommend.py [workers]
+"""
+
+import io
+import os
+import sys
+import multiprocessing
+
+import numpy as np
+from scipy import sparse
+
+from follow_graph import load_follow_edges
+
+TOP_K = 10
+
+# Upper bound on nonzeros in one chunk's A[rows] @ A, about 16 bytes each.
+MAX_CHUNK_ENTRIES = 20_000_000
+
+# Set in the parent before the pool forks, so workers share it copy-on-write
+# instead of each receiving a pickled copy.
+_graph = None
+
+
+def load_follow_graph(conn):
+    """Return follows as a CSR matrix, indexed by user id."""
+
+    follower, followed, max_id = load_follow_edges(conn)
+    n = max_id + 1
+    return sparse.csr_matrix(
+        (np.ones(len(follower), dtype=np.float32), (follower, followed)),
+        shape=(n, n))
+
+
+def plan_chunks(graph, max_entries=MAX_CHUNK_ENTRIES):
+    """Split rows into (start, stop) ranges whose products fit the budget.
+
+    A row's friends-of-friends can't outnumber the summed out-degrees of the
+    accounts it follows, which is cheap to compute for every row at once.
+    """
+
+    out_degree = np.diff(graph.indptr).astype(np.int64)
+    bound = graph @ out_degree
+    cumulative = np.cumsum(bound)
+
+    chunks = []
+    start = 0
+    n = graph.shape[0]
+    while start < n:
+        base = cumulative[start - 1] if start else 0
+        stop = int(np.searchsorted(cumulative, base + max_entries,
+                                   side='right'))
+        stop = min(max(stop, start + 1), n)
+        chunks.append((start, stop))
+        start = stop
+    return chunks
+
+
+def score_chunk(bounds, k=TOP_K):
+    """Score rows start..stop; return (bounds, users, candidates, scores).
+
+    The arrays are grouped by user, best candidate first.
+    """
+
+    start, stop = bounds
+    rows = _graph[start:stop]
+    scores = (rows @ _graph).tocsr()
+
+    # drop accounts already followed, and the user themself
+    scores = scores - scores.multiply(rows)
+    own = sparse.csr_matrix(
+        (np.ones(stop - start, dtype=np.float32),
+         (np.arange(stop - start), np.arange(start, stop))),
+        shape=scores.shape)
+    scores = scores - scores.multiply(own)
+    scores.eliminate_zeros()
+
+    users, candidates, values = [], [], []
+    for i in range(stop - start):
+        lo, hi = scores.indptr[i], scores.indptr[i + 1]
+        if lo == hi:
+            continue
+        data = scores.data[lo:hi]
+        cols = scores.indices[lo:hi]
+        if hi - lo > k:
+            best = np.argpartition(-data, k)[:k]
+            data, cols = data[best], cols[best]
+        order = np.lexsort((cols, -data))
+        users.append(np.full(len(order), start + i, dtype=np.int32))
+        candidates.append(cols[order])
+        values.append(data[order])
+
+    if not users:
+        empty = np.empty(0, dtype=np.int32)
+        return bounds, empty, empty, np.empty(0, dtype=np.float32)
+    return (bounds, np.concatenate(users), np.concatenate(candidates),
+            np.concatenate(values))
+
+
+def write_chunk(engine, bounds, users, candidates, scores):
+    """Replace recommendations for users in `bounds` in one transaction."""
+
+    start, stop = bounds
+    ranks = np.zeros(len(users), dtype=np.int32)
+    if len(users):
+        # rank = position within each user's (already sorted) run
+        first = np.r_[0, np.flatnonzero(np.diff(users)) + 1]
+        counts = np.diff(np.r_[first, len(users)])
+        ranks = np.arange(len(users)) - np.repeat(first, counts)
+
+    buf = io.StringIO()
+    for row in zip(users, ranks, candidates, scores):
+        buf.write("%d\t%d\t%d\t%r\n" % tuple(map(_py, row)))
+    buf.seek(0)
+
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM recommendations "
+                "WHERE user_id >= %s AND user_id < %s", (start, stop))
+            cursor.copy_expert(
+                "COPY recommendations (user_id, rank, candidate_id, score) "
+                "FROM STDIN", buf)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _py(value):
+    return value.item() if hasattr(value, 'item') else value
+
+
+def recommend(engine, workers=None, max_entries=MAX_CHUNK_ENTRIES):
+    """Recompute every user's recommendations. Returns rows written."""
+
+    global _graph
+
+    with engine.connect() as conn:
+        _graph = load_follow_graph(conn)
+
+    chunks = plan_chunks(_graph, max_entries)
+    written = 0
+
+    context = multiprocessing.get_context('fork')
+    with context.Pool(workers or os.cpu_count()) as pool:
+        for bounds, users, candidates, scores in pool.imap_unordered(
+                score_chunk, chunks):
+            write_chunk(engine, bounds, users, candidates, scores)
+            written += len(users)
+
+    _graph = None
+    return written
+
+
+if __name__ == '__main__':
+    from app import app
+    from models import db
+
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else None
+
+    with app.app_context():
+        count = recommend(db.engine, workers)
+    print(f"wrote {count} recommendations")
@@ -0,0 +1,187 @@
+"""Read-replica routing for Warbler.
+
+Reads made while handling a GET/HEAD request go to a healthy replica, the
+same one for the whole transaction, so its reads agree with each other.
+Writes, anything in a session that has already flushed, and every request
+from a user who wrote in the last few seconds go to the primary, so people
+always see their own warbles.
+"""
+
+import itertools
+import threading
+import time
+
+import flask
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm, text
+
+PRIMARY_UNTIL_KEY = "primary_until"
+
+READ_ONLY_METHODS = frozenset(["GET", "HEAD"])
+
+# Seconds a replica is behind its primary; 0 when it has replayed all WAL it
+# received (an idle primary makes pg_last_xact_replay_timestamp() look stale)
+# and also 0 when the "replica" is really a primary.
+LAG_SQL = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(
+            EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+
+class ReplicaRouter:
+    """Pick a healthy replica engine, round-robin.
+
+    Health is checked lazily, at most once per `health_interval` seconds per
+    replica; a replica that errors or lags more than `max_lag` seconds is
+    skipped until its next check.
+    """
+
+    def __init__(self, urls, max_lag=2.0, health_interval=5.0):
+        self.engines = [create_engine(url, pool_pre_ping=True)
+                        for url in urls]
+        self.max_lag = max_lag
+        self.health_interval = health_interval
+        self._health = {}
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+
+    def lag(self, engine):
+        """Return replication lag of `engine` in seconds."""
+
+        with engine.connect() as conn:
+            return float(conn.execute(LAG_SQL).scalar())
+
+    def is_healthy(self, engine):
+        """Is `engine` reachable and within the lag threshold?"""
+
+        now = time.monotonic()
+        checked_at, healthy = self._health.get(engine, (None, False))
+
+        if checked_at is not None and now - checked_at < self.health_interval:
+            return healthy
+
+        try:
+            healthy = self.lag(engine) <= self.max_lag
+        except Exception:
+            healthy = False
+
+        with self._lock:
+            self._health[engine] = (now, healthy)
+
+        return healthy
+
+    def pick(self):
+        """Return a healthy replica engine, or None to use the primary."""
+
+        healthy = [e for e in self.engines if self.is_healthy(e)]
+        if not healthy:
+            return None
+        return healthy[next(self._counter) % len(healthy)]
+
+
+def _wants_replica():
+    """Can the current request be served from a replica?"""
+
+    if not flask.has_request_context():
+        return False
+    if flask.request.method not in READ_ONLY_METHODS:
+        return False
+    return flask.session.get(PRIMARY_UNTIL_KEY, 0) < time.time()
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends read-only request traffic to a replica."""
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        event.listen(self, 'before_flush', _mark_written)
+        event.listen(self, 'after_commit', _stick_after_write)
+        event.listen(self, 'after_rollback', _forget_written)
+
+    def get_bind(self, mapper=None, clause=None):
+        router = self.app.extensions.get('replica_router')
+
+        if router and not self.info.get('wrote') and _wants_replica():
+            engine = self.info.get('replica')
+            if engine is None:
+                engine = self.info['replica'] = router.pick()
+            if engine is not None:
+                return engine
+
+        return super().get_bind(mapper, clause)
+
+
+def use_primary(session):
+    """Send the rest of `session`'s transaction to the primary, and stick to
+    it after the commit, as a flush would.
+
+    For writes the session can't see coming: bulk Query.update() and
+    .delete() don't flush, so would otherwise go to a replica in a GET.
+    """
+
+    session.info['wrote'] = True
+
+
+def _mark_written(session, flush_context, instances):
+    """Once a transaction writes, keep the rest of it on the primary."""
+
+    session.info['wrote'] = True
+
+
+def stick_to_primary():
+    """Pin this user's requests to the primary for REPLICA_STICKY_SECONDS.
+
+    Sessions do this when they commit a write; call it for writes made
+    outside db.session, on a connection of their own.
+    """
+
+    if flask.has_request_context():
+        window = flask.current_app.config['REPLICA_STICKY_SECONDS']
+        flask.session[PRIMARY_UNTIL_KEY] = time.time() + window
+
+
+def _stick_after_write(session):
+    """After a write, pin this user's requests to the primary for a while."""
+
+    session.info.pop('replica', None)
+    if session.info.pop('wrote', False):
+        stick_to_primary()
+
+
+def _forget_written(session):
+    """A rolled back transaction wrote nothing."""
+
+    session.info.pop('replica', None)
+    session.info.pop('wrote', None)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy whose sessions are replica-aware."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def init_replicas(app):
+    """Set up replica routing for `app` from its config.
+
+    Reads REPLICA_DATABASE_URLS (a list of URLs); with none configured every
+    query goes to the primary as before.
+    """
+
+    app.config.setdefault('REPLICA_DATABASE_URLS', [])
+    app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+    app.config.setdefault('REPLICA_MAX_LAG_SECONDS', 2)
+    app.config.setdefault('REPLICA_HEALTH_INTERVAL', 5)
+
+    urls = app.config['REPLICA_DATABASE_URLS']
+    if urls:
+        app.extensions['replica_router'] = ReplicaRouter(
+            urls,
+            max_lag=app.config['REPLICA_MAX_LAG_SECONDS'],
+            health_interval=app.config['REPLICA_HEALTH_INTERVAL'],
+        )
@@ -1,8 +1,10 @@
 
 
 from csv import DictReader
-from app import db
+from datetime import datetime
+from app import app, db
 from models import User, Message, Follows
+from snowflake import make_id, millis, MAX_SEQUENCE
 
 
 db.drop_all()
@@ -11,8 +13,14 @@ db.create_all()
 with open('generator/users.csv') as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
 
+# give historic messages ids from their own timestamps, so id order is
+# time order as it is for new messages
 with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    rows = sorted(DictReader(messages), key=lambda row: row['timestamp'])
+    for sequence, row in enumerate(rows):
+        row['id'] = make_id(millis(datetime.fromisoformat(row['timestamp'])),
+                            sequence=sequence & MAX_SEQUENCE)
+    db.session.bulk_insert_mappings(Message, rows)
 
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
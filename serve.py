@@ -0,0 +1,29 @@
+"""Serve Warbler with gevent, for many concurrent event streams.
+
+Every connection gets a greenlet rather than a thread, so thousands of
+idle /messages/stream connections cost a few KB each. psycopg2 is made
+cooperative too, so one slow query doesn't block other connections.
+
+    python serve.py [port]
+"""
+
+# must run before anything imports socket, threading or psycopg2
+from gevent import monkey
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
+import os
+import sys
+
+from gevent.pywsgi import WSGIServer
+
+from app import app
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else int(
+        os.environ.get('PORT', 5000))
+
+    print(f"serving on port {port}")
+    WSGIServer(('0.0.0.0', port), app).serve_forever()
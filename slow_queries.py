@@ -0,0 +1,265 @@
+"""Log slow SQL statements with the code that issued them.
+
+Statements taking longer than SLOW_QUERY_MS are written, one JSON object
+per line, to the rotating log SLOW_QUERY_LOG:
+
+    {"ms": 230.4, "endpoint": "warbler.homepage",
+     "template": "templates/home.html:51",
+     "stack": ["views.py:541 in homepage", ...],
+     "statement": "SELECT ...", "parameters": {"username": "str[7]"}}
+
+"template" is the template line being rendered when the statement was
+issued, e.g. a lazy load of msg.user, and "stack" the innermost frames of
+Warbler's own code, so a query can be traced back without reproducing it.
+
+Parameters are bound to emails, password hashes and the like, so only
+their types and lengths are logged, unless SLOW_QUERY_LOG_PARAMETERS is
+set (e.g. on a development machine). The log's directory is created when
+the first statement is logged.
+
+A fraction SLOW_QUERY_EXPLAIN_RATE of slow SELECTs (and EXECUTEs) are
+explained on the same connection, and the plan is added to the record.
+Plain SELECTs and EXECUTEs of registered lookups are run again under
+EXPLAIN (ANALYZE, BUFFERS), so keep the rate low in production. Anything
+else is only planned, with plain EXPLAIN: re-running a SELECT ... FOR UPDATE
+would take its locks again, and one calling nextval() or an advisory lock
+function would have effects a rollback can't undo.
+"""
+
+import json
+import logging
+import os
+import random
+import re
+import sys
+import time
+from logging.handlers import RotatingFileHandler
+
+from flask import has_request_context, request
+from sqlalchemy import event
+
+from queries import registered
+
+STACK_FRAMES = 8
+MAX_PARAMETER_CHARS = 200
+EXPLAINABLE = ('SELECT', 'EXECUTE')
+
+# SELECTs that lock rows, make tables or call functions with side effects
+UNSAFE_TO_ANALYZE = re.compile(
+    r"\bFOR\s+(NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)\b"
+    r"|\bINTO\b"
+    r"|\b(nextval|setval|pg_(try_)?advisory\w*|pg_notify|set_config"
+    r"|txid_current|pg_current_xact_id|lo_\w+|dblink\w*"
+    r"|pg_cancel_backend|pg_terminate_backend)\s*\(",
+    re.IGNORECASE)
+EXECUTE_NAME = re.compile(r"\s*EXECUTE\s+(\w+)", re.IGNORECASE)
+
+_BASE = os.path.dirname(os.path.abspath(__file__))
+_HERE = os.path.abspath(__file__)
+_START_KEY = 'warbler_query_start'
+
+
+def issuing_code(frame):
+    """Return (template line, app stack) for the code that ran `frame`.
+
+    The template line is "templates/x.html:N" for the innermost frame of
+    compiled template code, or None. The stack is the innermost
+    STACK_FRAMES frames of Warbler's own Python files.
+    """
+
+    template = None
+    stack = []
+    while frame is not None and len(stack) < STACK_FRAMES:
+        filename = frame.f_code.co_filename
+        jinja_template = frame.f_globals.get('__jinja_template__')
+        if jinja_template is not None and template is None:
+            line = jinja_template.get_corresponding_lineno(frame.f_lineno)
+            template = f"{os.path.relpath(filename, _BASE)}:{line}"
+        elif (filename.startswith(_BASE + os.sep)
+              and filename != _HERE
+              and os.sep + 'venv' + os.sep not in filename
+              and filename.endswith('.py')):
+            stack.append(f"{os.path.relpath(filename, _BASE)}:"
+                         f"{frame.f_lineno} in {frame.f_code.co_name}")
+        frame = frame.f_back
+    return template, stack
+
+
+def analyzable(statement):
+    """Can `statement` safely be run again under EXPLAIN ANALYZE?
+
+    Only plain SELECTs and EXECUTEs of registered lookups, which are read
+    only; errs towards no, which just means a plan without timings.
+    """
+
+    execute = EXECUTE_NAME.match(statement)
+    if execute:
+        return registered(execute.group(1))
+    return not UNSAFE_TO_ANALYZE.search(statement)
+
+
+def short(value):
+    """Return `value`, or its truncated repr if that would be long."""
+
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    text = value if isinstance(value, str) else repr(value)
+    if len(text) > MAX_PARAMETER_CHARS:
+        text = text[:MAX_PARAMETER_CHARS] + "..."
+    return text
+
+
+def describe(value):
+    """Return `value`'s type, and its length if it has one."""
+
+    name = type(value).__name__
+    try:
+        return f"{name}[{len(value)}]"
+    except TypeError:
+        return name
+
+
+def log_parameters(parameters, show):
+    """Return `parameters` as logged: shortened values if `show`, else
+    their descriptions."""
+
+    log = short if show else describe
+    if isinstance(parameters, dict):
+        return {key: log(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [log(value) for value in parameters]
+    return log(parameters)
+
+
+class SlowQueryLog:
+    """Time statements on engines and log the slow ones."""
+
+    def __init__(self, logger, threshold_ms=100, explain_rate=0.0,
+                 show_parameters=False):
+        self.logger = logger
+        self.threshold_ms = threshold_ms
+        self.explain_rate = explain_rate
+        self.show_parameters = show_parameters
+
+    def listen(self, engine):
+        event.listen(engine, 'before_cursor_execute', self.before_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_execute)
+        event.listen(engine, 'handle_error', self.failed)
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        conn.info.setdefault(_START_KEY, []).append(time.perf_counter())
+
+    def failed(self, exception_context):
+        conn = exception_context.connection
+        starts = conn.info.get(_START_KEY) if conn is not None else None
+        if starts:
+            starts.pop()
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        ms = (time.perf_counter() - conn.info[_START_KEY].pop()) * 1000
+        if ms < self.threshold_ms:
+            return
+
+        template, stack = issuing_code(sys._getframe(1))
+        record = {
+            'ms': round(ms, 1),
+            'endpoint': request.endpoint if has_request_context() else None,
+            'template': template,
+            'stack': stack,
+            'statement': statement,
+            'parameters': log_parameters(parameters, self.show_parameters),
+        }
+
+        if (not executemany
+                and statement.lstrip().upper().startswith(EXPLAINABLE)
+                and not (context and context.execution_options.get(
+                    'stream_results'))
+                and random.random() < self.explain_rate):
+            record['plan'] = self.explain(cursor, statement, parameters,
+                                          analyze=analyzable(statement))
+
+        self.logger.warning(json.dumps(record, default=str))
+
+    def explain(self, cursor, statement, parameters, analyze=True):
+        """Return the plan lines, or the error: run under EXPLAIN (ANALYZE,
+        BUFFERS) if `analyze`, else only planned with EXPLAIN.
+
+        Runs in a savepoint that's rolled back, so a failure doesn't abort
+        the transaction and the second run leaves nothing behind.
+        """
+
+        prefix = "EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN "
+        explain_cursor = cursor.connection.cursor()
+        try:
+            explain_cursor.execute("SAVEPOINT warbler_explain")
+            try:
+                explain_cursor.execute(prefix + statement, parameters)
+                plan = [line for line, in explain_cursor.fetchall()]
+            except Exception as exc:
+                plan = [f"EXPLAIN failed: {exc}"]
+            explain_cursor.execute("ROLLBACK TO SAVEPOINT warbler_explain")
+            explain_cursor.execute("RELEASE SAVEPOINT warbler_explain")
+            return plan
+        finally:
+            explain_cursor.close()
+
+
+class LazyRotatingFileHandler(RotatingFileHandler):
+    """A rotating file handler that makes its directory on first write."""
+
+    def __init__(self, path, **kwargs):
+        super().__init__(path, delay=True, **kwargs)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
+
+def make_logger(path, max_bytes, backups):
+    """Return a logger writing bare lines to a rotating file at `path`."""
+
+    logger = logging.getLogger(f'warbler.slow_queries.{path}')
+    if not logger.handlers:
+        handler = LazyRotatingFileHandler(path, maxBytes=max_bytes,
+                                          backupCount=backups)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.propagate = False
+    return logger
+
+
+def init_slow_queries(app):
+    """Log statements slower than SLOW_QUERY_MS on `app`'s engines."""
+
+    from models import db
+
+    app.config.setdefault('SLOW_QUERY_MS', 100)
+    app.config.setdefault('SLOW_QUERY_EXPLAIN_RATE', 0.0)
+    app.config.setdefault('SLOW_QUERY_LOG_PARAMETERS', False)
+    app.config.setdefault(
+        'SLOW_QUERY_LOG',
+        os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     'logs', 'slow_queries.log'))
+    app.config.setdefault('SLOW_QUERY_LOG_BYTES', 10 * 1024 * 1024)
+    app.config.setdefault('SLOW_QUERY_LOG_BACKUPS', 5)
+
+    if app.config['SLOW_QUERY_MS'] is None:
+        return
+
+    slow_log = SlowQueryLog(
+        make_logger(app.config['SLOW_QUERY_LOG'],
+                    app.config['SLOW_QUERY_LOG_BYTES'],
+                    app.config['SLOW_QUERY_LOG_BACKUPS']),
+        app.config['SLOW_QUERY_MS'],
+        app.config['SLOW_QUERY_EXPLAIN_RATE'],
+        app.config['SLOW_QUERY_LOG_PARAMETERS'])
+    app.extensions['slow_queries'] = slow_log
+
+    engines = [db.get_engine(app)]
+    router = app.extensions.get('replica_router')
+    if router is not None:
+        engines.extend(router.engines)
+    for engine in engines:
+        slow_log.listen(engine)
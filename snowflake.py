@@ -0,0 +1,164 @@
+"""Time-ordered 64-bit ids.
+
+An id is (milliseconds since EPOCH) << 22 | worker << 12 | sequence, so ids
+sort by creation time, are unique across up to 1024 workers, and each
+worker can make 4096 per millisecond. Ordering and paging by id is then
+ordering and paging by time.
+
+Set WARBLER_WORKER_ID (0-1023) per process, or call init_snowflake(app),
+and each process leases a free worker id from Postgres the first time it
+makes an id: it holds a session advisory lock on the id, on a connection
+of its own, until it exits. Two processes never share a worker id, on one
+machine or several.
+"""
+
+import os
+import random
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+
+# 2010-01-01 UTC, before any seeded message; 41 bits of milliseconds lasts
+# until 2079
+EPOCH_MS = 1262304000000
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# worker n is leased with pg_try_advisory_lock(LEASE_KEY, n)
+LEASE_KEY = 0x57617262
+
+
+def make_id(millis, worker=0, sequence=0):
+    """Return the id for Unix time `millis`, `worker` and `sequence`."""
+
+    return (((millis - EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS))
+            | (worker << SEQUENCE_BITS)
+            | sequence)
+
+
+def make_id_sql(timestamp, sequence):
+    """Return SQL computing an id from SQL expressions `timestamp` (naive
+    UTC) and `sequence`, for bulk loads that bypass the ORM.
+
+    The sequence fills the worker and sequence bits, so rows with the same
+    millisecond need distinct sequences modulo 2**22.
+    """
+
+    return (f"((((extract(epoch from {timestamp}) * 1000)::bigint"
+            f" - {EPOCH_MS}) << {WORKER_BITS + SEQUENCE_BITS})"
+            f" | (({sequence}) & {(1 << (WORKER_BITS + SEQUENCE_BITS)) - 1}))")
+
+
+def millis(dt):
+    """Return naive UTC datetime `dt` as Unix milliseconds."""
+
+    return int((dt - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def id_time(snowflake_id):
+    """Return the naive UTC datetime embedded in `snowflake_id`."""
+
+    ms = (snowflake_id >> (WORKER_BITS + SEQUENCE_BITS)) + EPOCH_MS
+    return datetime.utcfromtimestamp(ms / 1000)
+
+
+class SnowflakeGenerator:
+    """Hand out increasing ids for one worker."""
+
+    def __init__(self, worker):
+        if not 0 <= worker <= MAX_WORKER:
+            raise ValueError(f"worker id must be 0-{MAX_WORKER}")
+        self.worker = worker
+        self._last_ms = 0
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            now = int(time.time() * 1000)
+
+            # never go backwards, even if the clock does
+            if now <= self._last_ms:
+                now = self._last_ms
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    now += 1
+                    while int(time.time() * 1000) < now:
+                        time.sleep(0.0001)
+            else:
+                self._sequence = 0
+
+            self._last_ms = now
+            return make_id(now, self.worker, self._sequence)
+
+
+def lease_worker(engine):
+    """Lock a free worker id in `engine`'s database; return (connection,
+    worker id).
+
+    The lock lasts as long as the connection, so keep it open.
+    """
+
+    conn = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    # the connection is never returned to the pool, which would reuse it
+    conn.detach()
+
+    start = random.randrange(MAX_WORKER + 1)
+    for i in range(MAX_WORKER + 1):
+        worker = (start + i) % (MAX_WORKER + 1)
+        if conn.execute(text("SELECT pg_try_advisory_lock(:key, :worker)"),
+                        key=LEASE_KEY, worker=worker).scalar():
+            return conn, worker
+    conn.close()
+    raise RuntimeError(f"all {MAX_WORKER + 1} worker ids are leased")
+
+
+_engine = None
+_generator = None
+_generator_pid = None
+_generator_lock = threading.Lock()
+
+# lease connections by pid; a forked child keeps its parent's open, as
+# closing one would end the parent's session and release its lock
+_leases = {}
+
+
+def _worker_id():
+    if 'WARBLER_WORKER_ID' in os.environ:
+        return int(os.environ['WARBLER_WORKER_ID'])
+    if _engine is None:
+        raise RuntimeError("set WARBLER_WORKER_ID, or init_snowflake(app) "
+                           "to lease worker ids")
+    _leases[os.getpid()], worker = lease_worker(_engine)
+    return worker
+
+
+def next_id():
+    """Return a new id from this process's generator."""
+
+    global _generator, _generator_pid
+
+    # forked workers must not share the parent's generator
+    if _generator_pid != os.getpid():
+        with _generator_lock:
+            if _generator_pid != os.getpid():
+                _generator = SnowflakeGenerator(_worker_id())
+                _generator_pid = os.getpid()
+
+    return _generator.next_id()
+
+
+def init_snowflake(app):
+    """Lease worker ids from `app`'s database, unless WARBLER_WORKER_ID is
+    set."""
+
+    global _engine
+
+    from models import db
+
+    _engine = db.get_engine(app)
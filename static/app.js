@@ -0,0 +1,123 @@
+/* Live username/email availability on the signup form. */
+$(function () {
+  const $form = $("#user_form[data-availability-url]");
+  if (!$form.length) return;
+
+  const url = $form.data("availability-url");
+
+  for (const name of ["username", "email"]) {
+    const $input = $form.find(`[name=${name}]`);
+    const $note = $('<span class="text-danger availability"></span>');
+    $input.before($note);
+
+    $input.on("blur", async function () {
+      const value = $input.val().trim();
+      $note.text("");
+      if (!value) return;
+
+      const resp = await fetch(`${url}?${name}=${encodeURIComponent(value)}`);
+      const result = await resp.json();
+      if (result[name] === false) {
+        $note.text(name === "username"
+          ? "Username already taken"
+          : "Email already registered");
+      }
+    });
+  }
+});
+
+/* Live "N new warbles" on the home timeline.
+ *
+ * Ids are read with .attr, not .data: jQuery would turn them into numbers,
+ * and snowflake ids don't fit in one.
+ */
+$(function () {
+  const $messages = $("#messages[data-stream-url]");
+  if (!$messages.length || !window.EventSource) return;
+
+  const $banner = $("#new-messages");
+  const streamUrl = $messages.attr("data-stream-url");
+  const sinceUrl = $messages.attr("data-since-url");
+  let stream = null;
+
+  function listen() {
+    const since = $messages.attr("data-newest-id");
+    stream = new EventSource(`${streamUrl}?since_id=${since}`);
+    stream.addEventListener("count", function (evt) {
+      const count = JSON.parse(evt.data).count;
+      $banner
+        .text(`${count} new warble${count === 1 ? "" : "s"}`)
+        .removeClass("d-none");
+    });
+  }
+
+  $banner.on("click", async function () {
+    stream.close();
+    $banner.addClass("d-none");
+
+    const since = $messages.attr("data-newest-id");
+    const resp = await fetch(`${sinceUrl}?since_id=${since}`);
+    const result = await resp.json();
+    if (result.more) {
+      window.location.reload();
+      return;
+    }
+
+    if (result.messages.length) {
+      $messages.prepend(result.messages.map(m => m.html).join(""));
+      $messages.attr("data-newest-id", result.messages[0].id);
+    }
+    listen();
+  });
+
+  listen();
+});
+
+/* Username completions under the navbar search box.
+ *
+ * Asks once typing pauses, and drops answers to anything but the latest
+ * question, since they can arrive out of order.
+ */
+$(function () {
+  const $search = $("#search[data-complete-url]");
+  if (!$search.length) return;
+
+  const url = $search.data("complete-url");
+  const $menu = $("#search-completions");
+  let timer = null;
+  let asked = 0;
+
+  function hide() {
+    $menu.removeClass("show").empty();
+  }
+
+  $search.on("input", function () {
+    clearTimeout(timer);
+    const prefix = $search.val().trim();
+    if (!prefix) {
+      asked++;
+      hide();
+      return;
+    }
+
+    timer = setTimeout(async function () {
+      const question = ++asked;
+      const resp = await fetch(`${url}?q=${encodeURIComponent(prefix)}`);
+      const result = await resp.json();
+      if (question !== asked) return;
+
+      $menu.empty();
+      for (const user of result.users) {
+        $menu.append($('<a class="dropdown-item"></a>')
+          .attr("href", user.url)
+          .text(`@${user.username}`));
+      }
+      $menu.toggleClass("show", result.users.length > 0);
+    }, 150);
+  });
+
+  $search.on("blur", function () {
+    // late enough for a click on a completion to land
+    setTimeout(hide, 200);
+  });
+});
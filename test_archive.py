@@ -0,0 +1,249 @@
+"""Message archive tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_archive.py
+
+
+import gzip
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from models import db, User, Message, MessageTag, Likes
+import archive
+from archive import Archive, archive_messages
+
+from testing import app, DBTestCase
+
+
+class ArchiveTestCase(DBTestCase):
+    """Test moving messages to the archive and reading them back."""
+
+    def setUp(self):
+        """Create a user with one old and one new message."""
+
+        super().setUp()
+
+        user = User(username="testuser",
+                    email="test@test.com",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+        liker = User(username="liker",
+                     email="liker@test.com",
+                     password="HASHED_PASSWORD")
+        db.session.add(liker)
+        db.session.commit()
+        self.liker_id = liker.id
+
+        old = Message(text="Old warble #vintage",
+                      timestamp=datetime.utcnow() - timedelta(days=1000),
+                      user_id=user.id)
+        old.tags = MessageTag.extract(old.text)
+        new = Message(text="New warble",
+                      timestamp=datetime.utcnow(),
+                      user_id=user.id)
+        db.session.add_all([old, new])
+        db.session.commit()
+        self.old_id = old.id
+        self.new_id = new.id
+
+        db.session.add(Likes(user_id=liker.id, message_id=old.id))
+        db.session.commit()
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.archive = Archive(self.tmpdir.name)
+        self.app_archive = app.extensions['archive']
+        app.extensions['archive'] = self.archive
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        super().tearDown()
+        app.extensions['archive'] = self.app_archive
+        self.tmpdir.cleanup()
+
+    def archive_old(self):
+        return archive_messages(
+            self.archive, datetime.utcnow() - timedelta(days=365))
+
+    def test_archive_messages(self):
+        """Are only old messages moved out of the database?"""
+
+        self.assertIsNone(self.archive.cutoff)
+        self.assertEqual(self.archive_old(), 1)
+        self.assertAlmostEqual(self.archive.cutoff,
+                               datetime.utcnow() - timedelta(days=365),
+                               delta=timedelta(seconds=5))
+
+        self.assertIsNone(Message.query.get(self.old_id))
+        self.assertIsNotNone(Message.query.get(self.new_id))
+
+        archived = self.archive.get(self.old_id)
+        self.assertEqual(archived.text, "Old warble #vintage")
+        self.assertEqual(archived.user_id, self.user_id)
+        self.assertIsNone(self.archive.get(self.new_id))
+
+    def test_tags_and_likes_archived(self):
+        """Do a message's tags and likes move to the archive with it?"""
+
+        self.archive_old()
+
+        archived = self.archive.get(self.old_id)
+        self.assertEqual([(t.kind, t.tag) for t in archived.tags],
+                         [('#', 'vintage')])
+        self.assertEqual(archived.liked_by, [self.liker_id])
+        self.assertEqual(
+            [m.id for m in self.archive.iter_user_likes(self.liker_id)],
+            [self.old_id])
+        self.assertEqual(MessageTag.query.count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+
+    def test_many_segments(self):
+        """Are messages found across segments, by id and by author?"""
+
+        old = datetime.utcnow() - timedelta(days=900)
+        ids = []
+        for i in range(5):
+            msg = Message(text=f"older {i}", user_id=self.user_id,
+                          timestamp=old + timedelta(days=i))
+            db.session.add(msg)
+            db.session.commit()
+            ids.append(msg.id)
+
+        archive_messages(self.archive,
+                         datetime.utcnow() - timedelta(days=365),
+                         segment_size=2)
+
+        self.assertEqual(len(self.archive.indexes), 3)
+        for i, message_id in enumerate(ids):
+            self.assertEqual(self.archive.get(message_id).text, f"older {i}")
+        self.assertIsNone(self.archive.get(max(ids) + 1))
+        self.assertEqual(
+            [m.text for m in self.archive.user_messages(self.user_id, 3)],
+            ["older 4", "older 3", "older 2"])
+        self.assertEqual(
+            len(list(self.archive.iter_user_messages(self.user_id))), 6)
+
+    def test_blocks(self):
+        """Does a lookup decompress just its own block?"""
+
+        rows = [{'id': i, 'text': f"row {i}",
+                 'timestamp': "2015-01-01T00:00:00.000000",
+                 'user_id': self.user_id}
+                for i in range(1, 8)]
+        block_rows = archive.BLOCK_ROWS
+        archive.BLOCK_ROWS = 3
+        try:
+            self.archive.write_segment(rows)
+        finally:
+            archive.BLOCK_ROWS = block_rows
+
+        index = self.archive.indexes[0]
+        self.assertEqual(list(index.offsets)[0], 0)
+        self.assertEqual(len(index.offsets), 4)
+        block = gzip.decompress(
+            index._data[index.offsets[2]:index.offsets[3]])
+        self.assertEqual(json.loads(block)['text'], "row 7")
+
+        self.assertEqual(self.archive.get(5).text, "row 5")
+        self.assertEqual(
+            [m.id for m in self.archive.iter_user_messages(self.user_id)],
+            list(range(1, 8)))
+
+        # authors are loaded with the page, not per message
+        messages = self.archive.user_messages(self.user_id, 2)
+        self.assertEqual([m.id for m in messages], [1, 2])
+        statements = []
+        count = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            self.assertEqual([m.user.username for m in messages],
+                             ["testuser", "testuser"])
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(statements, [])
+
+    def test_single_stream_segment(self):
+        """Are segments written as one gzip stream, before blocks, read?"""
+
+        rows = [{'id': i, 'text': f"row {i}",
+                 'timestamp': "2015-01-01T00:00:00.000000",
+                 'user_id': self.user_id}
+                for i in range(1, 4)]
+        self.archive.write_segment(rows)
+        index = self.archive.indexes[0]
+        with open(os.path.join(self.tmpdir.name, index.segment), 'rb') as f:
+            data = f.read()
+        os.chmod(os.path.join(self.tmpdir.name, 'segment-000001.idx'),
+                 0o644)
+        with open(os.path.join(self.tmpdir.name, 'segment-000001.idx'),
+                  'r+b') as f:
+            f.truncate(f.seek(0, 2) - 8 * len(index.offsets))
+
+        old = Archive(self.tmpdir.name)
+        self.assertEqual(old.get(2).text, "row 2")
+        self.assertEqual(len(data), old.indexes[0].offsets[1])
+
+    def test_other_process_archives(self):
+        """Does a worker see segments written after it first looked?"""
+
+        resp = self.client.get(f"/messages/{self.old_id}")
+        self.assertEqual(resp.status_code, 200)
+
+        # as `python archive.py` would, with an Archive of its own
+        archive_messages(Archive(self.tmpdir.name),
+                         datetime.utcnow() - timedelta(days=365))
+
+        resp = self.client.get(f"/messages/{self.old_id}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Old warble", resp.get_data(as_text=True))
+        resp = self.client.get(f"/users/{self.user_id}")
+        self.assertIn("Old warble", resp.get_data(as_text=True))
+
+    def test_segments_reload(self):
+        """Can a fresh Archive read segments written by another?"""
+
+        self.archive_old()
+
+        archived = Archive(self.tmpdir.name).get(self.old_id)
+        self.assertEqual(archived.text, "Old warble #vintage")
+
+    def test_show_archived_message(self):
+        """Does the message page fall through to the archive?"""
+
+        self.archive_old()
+
+        resp = self.client.get(f"/messages/{self.old_id}")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Old warble", html)
+
+    def test_profile_includes_archive(self):
+        """Does a profile list hot messages followed by archived ones?"""
+
+        self.archive_old()
+
+        resp = self.client.get(f"/users/{self.user_id}")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("New warble", html)
+        self.assertIn("Old warble", html)
+        self.assertLess(html.index("New warble"), html.index("Old warble"))
+
+    def test_profile_before_archiving(self):
+        """Are messages older than HOT_HISTORY shown until they're archived?"""
+
+        resp = self.client.get(f"/users/{self.user_id}")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Old warble", html)
@@ -0,0 +1,129 @@
+"""Username/email availability tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_availability.py
+
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, bcrypt, User
+from availability import AvailabilityChecker, BloomFilter
+
+from testing import app, DBTestCase
+
+
+class BloomFilterTestCase(TestCase):
+    """Test the Bloom filter on its own."""
+
+    def test_no_false_negatives(self):
+        """Is everything added reported as present?"""
+
+        bloom = BloomFilter(1000)
+        names = [f"user{i}" for i in range(1000)]
+        for name in names:
+            bloom.add(name)
+
+        self.assertTrue(all(name in bloom for name in names))
+
+    def test_false_positive_rate(self):
+        """Are false positives close to the requested rate?"""
+
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(f"user{i}")
+
+        false_positives = sum(f"other{i}" in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class AvailabilityViewTestCase(DBTestCase):
+    """Test availability checks in signup and the JSON endpoint."""
+
+    def setUp(self):
+        """Create one existing user and rebuild the filter."""
+
+        super().setUp()
+
+        User.signup(username="testuser",
+                    email="test@test.com",
+                    password="testuser",
+                    image_url=None,
+                    header_image_url=None,
+                    bio=None)
+        db.session.commit()
+
+        with app.app_context():
+            app.extensions['availability'].rebuild()
+
+        self.client = app.test_client()
+
+    def test_available_endpoint(self):
+        """Does the endpoint tell taken and free values apart?"""
+
+        resp = self.client.get("/users/available",
+                               query_string={"username": "testuser",
+                                             "email": "new@test.com"})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json(),
+                         {"username": False, "email": True})
+
+    def test_duplicate_email_skips_hashing(self):
+        """Is a taken email reported without hashing the password?"""
+
+        with patch.object(bcrypt, 'generate_password_hash') as hash_password:
+            resp = self.client.post("/signup", data={
+                "username": "otheruser",
+                "email": "test@test.com",
+                "password": "password",
+            })
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Email already registered", html)
+            self.assertNotIn("Username already taken", html)
+            hash_password.assert_not_called()
+
+    def test_signup_updates_filter(self):
+        """Is a new signup's username known without a rebuild?"""
+
+        self.client.post("/signup", data={
+            "username": "newuser",
+            "email": "new@test.com",
+            "password": "password",
+        })
+
+        resp = self.client.get("/users/available",
+                               query_string={"username": "newuser"})
+        self.assertEqual(resp.get_json(), {"username": False})
+
+    def test_checks_database_until_built(self):
+        """Before its first build, does the checker ask the database?"""
+
+        checker = AvailabilityChecker(db.engine)
+        # not built yet, and not building
+        checker._thread_pid = os.getpid()
+
+        with app.app_context():
+            self.assertTrue(checker.username_taken("testuser"))
+            self.assertFalse(checker.username_taken("nobody"))
+
+    def test_added_during_rebuild(self):
+        """Is a name added while a rebuild reads users in the new filter?"""
+
+        checker = AvailabilityChecker(db.engine)
+        checker._thread_pid = os.getpid()
+
+        class AddingMidway(BloomFilter):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                checker.add("midway", "midway@test.com")
+
+        with patch('availability.BloomFilter', AddingMidway):
+            checker.rebuild()
+
+        self.assertIn("u:midway", checker.bloom)
+        self.assertIn("u:testuser", checker.bloom)
@@ -0,0 +1,165 @@
+"""Entity cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_entity_cache.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, Likes
+from entity_cache import EntityCache, LRUCache, dumps, loads
+from like_counts import LikeCounter
+
+from testing import app, DBTestCase
+
+
+class LRUCacheTestCase(TestCase):
+    """Test the LRU on its own."""
+
+    def test_evicts_least_recent(self):
+        cache = LRUCache(max_entries=2, ttl=10)
+        cache.set('a', 1, now=0)
+        cache.set('b', 2, now=0)
+        cache.get('a', now=1)
+        cache.set('c', 3, now=1)
+
+        self.assertEqual(cache.get('a', now=1), 1)
+        self.assertIsNone(cache.get('b', now=1))
+        self.assertEqual(cache.get('c', now=1), 3)
+
+    def test_expires(self):
+        cache = LRUCache(ttl=10)
+        cache.set('a', 1, now=0)
+
+        self.assertEqual(cache.get('a', now=9), 1)
+        self.assertIsNone(cache.get('a', now=10))
+
+
+class EntityCacheTestCase(DBTestCase):
+    """Test cached primary-key loads and their invalidation."""
+
+    def setUp(self):
+        super().setUp()
+
+        user = User(username="testuser",
+                    email="test@test.com",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        message = Message(text="hello", user_id=user.id)
+        db.session.add(message)
+        db.session.commit()
+        self.user_id = user.id
+        self.message_id = message.id
+
+        self.cache = EntityCache((User, Message), LRUCache())
+        self.app_cache = app.extensions['entity_cache']
+        app.extensions['entity_cache'] = self.cache
+
+        self.selects = []
+        event.listen(db.engine, 'before_cursor_execute', self._count)
+
+        db.session.remove()
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self._count)
+        super().tearDown()
+        app.extensions['entity_cache'] = self.app_cache
+
+    def _count(self, conn, cursor, statement, *args):
+        if statement.lstrip().startswith('SELECT'):
+            self.selects.append(statement)
+
+    def test_hit_skips_select(self):
+        """Is a second load, in a new session, served without a query?"""
+
+        first = self.cache.get(User, self.user_id)
+        self.assertEqual(first.username, "testuser")
+        db.session.remove()
+
+        self.selects.clear()
+        second = self.cache.get(User, self.user_id)
+
+        self.assertEqual(second.username, "testuser")
+        self.assertEqual(self.selects, [])
+        self.assertIs(second, db.session.query(User).get(self.user_id))
+        self.assertEqual(self.cache.stats()['users'],
+                         {'hits': 1, 'misses': 1, 'hit_ratio': 0.5})
+
+    def test_relationships_load(self):
+        """Do relationships of a cached instance still lazy-load?"""
+
+        self.cache.get(User, self.user_id)
+        db.session.remove()
+
+        user = self.cache.get(User, self.user_id)
+        self.assertEqual([m.text for m in user.messages], ["hello"])
+
+    def test_commit_invalidates(self):
+        """Does committing a change to a cached row drop it?"""
+
+        user = self.cache.get(User, self.user_id)
+        user.bio = "changed"
+        db.session.commit()
+        db.session.remove()
+
+        self.assertEqual(self.cache.get(User, self.user_id).bio, "changed")
+        self.assertEqual(self.cache.stats()['users']['misses'], 2)
+
+    def test_rollback_keeps(self):
+        """Is a rolled-back change left cached?"""
+
+        user = self.cache.get(User, self.user_id)
+        user.bio = "discarded"
+        db.session.flush()
+        db.session.rollback()
+        db.session.remove()
+
+        self.assertNotEqual(self.cache.get(User, self.user_id).bio,
+                            "discarded")
+        self.assertEqual(self.cache.stats()['users']['hits'], 1)
+
+    def test_bulk_delete_invalidates(self):
+        """Do bulk deletes drop the model's entries?"""
+
+        self.cache.get(User, self.user_id)
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.assertIsNone(self.cache.get(User, self.user_id))
+
+    def test_shared_encoding(self):
+        """Do rows survive the shared tier's JSON, datetimes included?"""
+
+        for model, pk in ((User, self.user_id), (Message, self.message_id)):
+            values = self.cache._values(model.query.get(pk))
+            self.assertEqual(loads(dumps(values)), values)
+
+    def test_recount_invalidates(self):
+        """Is a message dropped once its like count is recounted?"""
+
+        self.cache.get(Message, self.message_id)
+        counter = LikeCounter(db.engine, on_recount=lambda ids:
+                              self.cache.invalidate_ids(Message, ids))
+        counter._thread_pid = os.getpid()
+
+        db.session.add(Likes(user_id=self.user_id,
+                             message_id=self.message_id))
+        db.session.commit()
+        counter.add(self.message_id)
+        counter.flush()
+        db.session.remove()
+
+        self.assertEqual(
+            self.cache.get(Message, self.message_id).like_count, 1)
+
+    def test_stats_endpoint(self):
+        self.cache.get(User, self.user_id)
+
+        resp = app.test_client().get("/cache-stats")
+        self.assertEqual(resp.json['users']['misses'], 1)
@@ -0,0 +1,156 @@
+"""Explore firehose tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_explore.py
+
+
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message
+from explore import Firehose
+
+from testing import app, CURR_USER_KEY, DBTestCase
+
+
+def fake_message(id, user_id=1, username="alice"):
+    user = SimpleNamespace(id=user_id, username=username, image_url=None)
+    return SimpleNamespace(id=id, text=f"message {id}",
+                           timestamp=datetime(2021, 1, 1), like_count=0,
+                           user_id=user_id, user=user)
+
+
+class FirehoseTestCase(TestCase):
+    """Test the ring buffer on its own."""
+
+    def setUp(self):
+        self.now = 0
+        self.firehose = Firehose(size=3, refresh_seconds=30,
+                                 clock=lambda: self.now)
+        # as if loaded from an empty database
+        self.firehose._loaded_at = 0
+
+    def test_ring(self):
+        for id in range(1, 6):
+            self.firehose.append(fake_message(id))
+
+        self.assertEqual([m.id for m in self.firehose.latest()], [5, 4, 3])
+        self.assertEqual([m.id for m in self.firehose.latest(2)], [5, 4])
+
+    def test_tombstones(self):
+        for id in range(1, 4):
+            self.firehose.append(fake_message(id))
+        self.firehose.delete(2)
+
+        self.assertEqual([m.id for m in self.firehose.latest()], [3, 1])
+
+        # the tombstone goes when its message drops out
+        self.firehose.append(fake_message(4))
+        self.firehose.append(fake_message(5))
+        self.assertEqual([m.id for m in self.firehose.latest()], [5, 4, 3])
+        self.assertEqual(self.firehose._tombstones, set())
+
+    def test_authors(self):
+        self.firehose.append(fake_message(1, user_id=1))
+        self.firehose.append(fake_message(2, user_id=2, username="bob"))
+        self.firehose.append(fake_message(3, user_id=1))
+
+        self.firehose.update_author(
+            SimpleNamespace(id=1, username="alice2", image_url=None))
+        self.assertEqual([m.user.username for m in self.firehose.latest()],
+                         ["alice2", "bob", "alice2"])
+
+        self.firehose.delete_author(1)
+        self.assertEqual([m.id for m in self.firehose.latest()], [2])
+
+
+class ExploreViewsTestCase(DBTestCase):
+    """Test loading from the database and the pages using it."""
+
+    def setUp(self):
+        super().setUp()
+
+        user = User.signup("testuser", "test@test.com", "password",
+                           None, None, None)
+        db.session.commit()
+        for i in range(3):
+            db.session.add(Message(text=f"hello {i}", user_id=user.id))
+        db.session.commit()
+        self.user_id = user.id
+        db.session.remove()
+
+        self.now = 0
+        self.firehose = Firehose(size=10, refresh_seconds=30,
+                                 clock=lambda: self.now)
+        self.app_firehose = app.extensions['explore']
+        app.extensions['explore'] = self.firehose
+
+        self.selects = []
+        event.listen(db.engine, 'before_cursor_execute', self._count)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self._count)
+        super().tearDown()
+        app.extensions['explore'] = self.app_firehose
+
+    def _count(self, conn, cursor, statement, *args):
+        if statement.lstrip().startswith(('SELECT', 'EXECUTE')):
+            self.selects.append(statement)
+
+    def test_anonymous_home(self):
+        """Is the anonymous homepage served from memory once loaded?"""
+
+        resp = self.client.get("/")
+        self.assertIn("hello 2", resp.get_data(as_text=True))
+
+        self.selects.clear()
+        resp = self.client.get("/")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(self.selects, [])
+        self.assertLess(html.index("hello 2"), html.index("hello 0"))
+        self.assertIn("@testuser", html)
+
+    def test_explore_page(self):
+        self.client.get("/explore")
+        self.selects.clear()
+
+        resp = self.client.get("/explore")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("hello 1", resp.get_data(as_text=True))
+        self.assertEqual(self.selects, [])
+
+    def test_posts_and_deletes(self):
+        """Do this worker's posts and deletes show without a reload?"""
+
+        self.firehose.latest()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        self.client.post("/messages/new", data={"text": "brand new"})
+        newest = self.firehose.latest()[0]
+        self.assertEqual(newest.text, "brand new")
+
+        self.client.post(f"/messages/{newest.id}/delete")
+        self.assertEqual([m.text for m in self.firehose.latest()],
+                         ["hello 2", "hello 1", "hello 0"])
+
+    def test_reload(self):
+        """Are other workers' messages picked up after the refresh time?"""
+
+        self.firehose.latest()
+        db.session.add(Message(text="elsewhere", user_id=self.user_id))
+        db.session.commit()
+
+        self.now = 10
+        self.assertNotEqual(self.firehose.latest()[0].text, "elsewhere")
+
+        self.now = 31
+        self.assertEqual(self.firehose.latest()[0].text, "elsewhere")
@@ -0,0 +1,248 @@
+"""Personal data export tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_export.py
+
+
+import io
+import json
+import os
+import tempfile
+import time
+import zipfile
+
+from sqlalchemy import event
+
+from models import db, User, Message
+from archive import Archive
+import export
+from export import ExportJobs, export_zip
+
+from testing import app, CURR_USER_KEY, DBTestCase
+
+
+class ExportTestCase(DBTestCase):
+    """Test the streamed and background exports."""
+
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("testuser1", "test1@test.com", "password",
+                         None, None, "my bio")
+        u2 = User.signup("testuser2", "test2@test.com", "password",
+                         None, None, None)
+        db.session.commit()
+        u1.following.append(u2)
+        for i in range(5):
+            db.session.add(Message(text=f"mine {i}", user_id=u1.id))
+        theirs = Message(text="theirs", user_id=u2.id)
+        db.session.add(theirs)
+        db.session.commit()
+        u1.likes.append(theirs)
+        db.session.commit()
+
+        self.ids = (u1.id, u2.id)
+        self.theirs_id = theirs.id
+        db.session.remove()
+
+        self.tmp = tempfile.TemporaryDirectory()
+        archive = Archive(os.path.join(self.tmp.name, 'archive'))
+        archive.write_segment([{'id': 1, 'text': "archived",
+                                'timestamp': "2015-01-01T00:00:00.000000",
+                                'user_id': u1.id, 'like_count': 2},
+                               {'id': 2, 'text': "archived theirs",
+                                'timestamp': "2015-01-02T00:00:00.000000",
+                                'user_id': u2.id, 'like_count': 1,
+                                'liked_by': [u1.id]}])
+        self.jobs = ExportJobs(os.path.join(self.tmp.name, 'exports'),
+                               db.engine, archive)
+        self.app_jobs = app.extensions['export']
+        app.extensions['export'] = self.jobs
+
+        self.chunk = export.EXPORT_CHUNK
+        export.EXPORT_CHUNK = 2
+
+        self.client = app.test_client()
+        self.login(u1.id)
+
+    def tearDown(self):
+        super().tearDown()
+        export.EXPORT_CHUNK = self.chunk
+        app.extensions['export'] = self.app_jobs
+        self.tmp.cleanup()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def check_zip(self, data):
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            self.assertEqual(zf.namelist(), [
+                'profile.json', 'messages.jsonl', 'likes.jsonl',
+                'following.jsonl', 'followers.jsonl'])
+
+            profile = json.loads(zf.read('profile.json'))
+            messages = [json.loads(line) for line in
+                        zf.read('messages.jsonl').splitlines()]
+            likes = [json.loads(line) for line in
+                     zf.read('likes.jsonl').splitlines()]
+            following = [json.loads(line) for line in
+                         zf.read('following.jsonl').splitlines()]
+
+        self.assertEqual(profile['bio'], "my bio")
+        self.assertNotIn('password', profile)
+        self.assertEqual([m['text'] for m in messages],
+                         ["archived"] + [f"mine {i}" for i in range(5)])
+        self.assertIsInstance(messages[1]['id'], str)
+        self.assertEqual(likes, [{'message_id': "2",
+                                  'text': "archived theirs",
+                                  'author': "testuser2"},
+                                 {'message_id': str(self.theirs_id),
+                                  'text': "theirs",
+                                  'author': "testuser2"}])
+        self.assertEqual(following, [{'id': self.ids[1],
+                                      'username': "testuser2"}])
+
+    def test_streamed(self):
+        """Is the zip complete, and its transaction over before it's sent?"""
+
+        commits = []
+        record = lambda conn: commits.append(conn)
+        event.listen(db.engine, 'commit', record)
+        try:
+            resp = self.client.get("/users/export", buffered=False)
+            self.assertTrue(commits)
+        finally:
+            event.remove(db.engine, 'commit', record)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "application/zip")
+        self.assertIn('attachment; filename=warbler-testuser1.zip',
+                      resp.headers['Content-Disposition'])
+        self.check_zip(resp.get_data())
+        resp.close()
+
+    def test_large_account_in_background(self):
+        """Is a big account's export sent to a background job?"""
+
+        app.config['EXPORT_STREAM_MAX_ROWS'] = 3
+        try:
+            resp = self.client.get("/users/export")
+        finally:
+            app.config['EXPORT_STREAM_MAX_ROWS'] = 50000
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertRegex(resp.location, r"/users/export/[\w-]{22}$")
+
+    def test_archived_likes_batched(self):
+        """Are archived likes' authors looked up a chunk at a time?"""
+
+        statements = []
+        record = lambda conn, cursor, statement, *args: (
+            statements.append(statement))
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            data = b"".join(export.export_zip(db.engine, self.jobs.archive,
+                                              self.ids[0]))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.check_zip(data)
+        self.assertEqual(
+            len([s for s in statements if "IN (" in s or "= ANY" in s]), 1)
+
+    def test_background(self):
+        resp = self.client.post("/users/export")
+        self.assertEqual(resp.status_code, 302)
+        url = resp.location
+
+        deadline = time.time() + 10
+        resp = self.client.get(url)
+        while resp.status_code == 202 and time.time() < deadline:
+            time.sleep(0.05)
+            resp = self.client.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+        self.check_zip(resp.get_data())
+        resp.close()
+
+        # only its owner can download it
+        self.login(self.ids[1])
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_missing(self):
+        self.assertEqual(self.client.get("/users/export/nope").status_code,
+                         404)
+        self.assertEqual(self.client.get("/users/export/..").status_code,
+                         404)
+
+    def test_remove_expired(self):
+        token = self.jobs.start(self.ids[0])
+        self.wait_for(token, 'ready')
+
+        self.jobs.max_age = -1
+        self.jobs.remove_expired()
+
+        self.assertEqual(self.jobs.status(self.ids[0], token),
+                         ('missing', None))
+
+    def wait_for(self, token, state):
+        deadline = time.time() + 10
+        while (self.jobs.status(self.ids[0], token)[0] != state
+               and time.time() < deadline):
+            time.sleep(0.05)
+
+    def test_failed(self):
+        """Does a build that raises say so, rather than 404?"""
+
+        def broken(engine, archive, user_id):
+            raise RuntimeError("database went away")
+            yield
+
+        export.export_zip = broken
+        try:
+            token = self.jobs.start(self.ids[0])
+            self.wait_for(token, 'failed')
+        finally:
+            export.export_zip = export_zip
+
+        resp = self.client.get(f"/users/export/{token}")
+        self.assertEqual(resp.status_code, 500)
+        self.assertIn("couldn't be prepared", resp.get_data(as_text=True))
+
+    def stall(self, token, path):
+        """Leave `token`'s export as a dead worker would."""
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.part', 'wb') as f:
+            f.write(b"PK")
+        past = time.time() - self.jobs.stale_after - 1
+        os.utime(path + '.part', (past, past))
+
+    def test_stalled_retried(self):
+        """Is a build whose worker died started again?"""
+
+        token = "a" * 22
+        path = self.jobs._path(self.ids[0], token)
+        self.stall(token, path)
+
+        self.assertEqual(self.jobs.status(self.ids[0], token),
+                         ('pending', None))
+        self.wait_for(token, 'ready')
+        with open(path, 'rb') as f:
+            self.check_zip(f.read())
+
+    def test_stalled_twice(self):
+        """Is a build that stalls again marked failed?"""
+
+        token = "a" * 22
+        path = self.jobs._path(self.ids[0], token)
+        self.stall(token, path)
+        open(path + '.retried', 'wb').close()
+        past = time.time() - self.jobs.stale_after - 1
+        os.utime(path + '.retried', (past, past))
+
+        self.assertEqual(self.jobs.status(self.ids[0], token),
+                         ('failed', None))
+        self.assertFalse(os.path.exists(path + '.part'))
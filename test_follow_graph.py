@@ -0,0 +1,164 @@
+"""Follow graph snapshot tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follow_graph.py
+
+
+import os
+import tempfile
+import time
+
+from models import db, User, Follows
+from follow_graph import FollowGraph, build_snapshot, _remove_old_snapshots
+
+from testing import app, CURR_USER_KEY, DBTestCase
+
+
+class FollowGraphTestCase(DBTestCase):
+    """Test snapshot lookups, overlays and the profile hints."""
+
+    def setUp(self):
+        """u0 follows u1 and u2; u1 and u2 follow u3; u3 follows u0."""
+
+        super().setUp()
+
+        users = [User(username=f"user{i}",
+                      email=f"user{i}@test.com",
+                      password="HASHED_PASSWORD")
+                 for i in range(4)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        u0, u1, u2, u3 = users
+        u0.following = [u1, u2]
+        u1.following = [u3]
+        u2.following = [u3]
+        u3.following = [u0]
+        db.session.commit()
+        self.ids = [u.id for u in users]
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        with db.engine.connect() as conn:
+            build_snapshot(conn, self.tmpdir.name)
+        self.graph = FollowGraph(self.tmpdir.name, check_seconds=0)
+
+        self.app_graph = app.extensions['follow_graph']
+        app.extensions['follow_graph'] = self.graph
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        super().tearDown()
+        app.extensions['follow_graph'] = self.app_graph
+        self.tmpdir.cleanup()
+
+    def test_snapshot_lookups(self):
+        """Are both directions of the graph sorted and complete?"""
+
+        u0, u1, u2, u3 = self.ids
+
+        self.assertEqual(list(self.graph.following(u0)), sorted([u1, u2]))
+        self.assertEqual(list(self.graph.followers(u3)), sorted([u1, u2]))
+        self.assertEqual(list(self.graph.followers(u0)), [u3])
+        self.assertEqual(list(self.graph.following(u0 + 1000)), [])
+
+    def test_followed_by_followed(self):
+        u0, u1, u2, u3 = self.ids
+
+        self.assertEqual(list(self.graph.followed_by_followed(u0, u3)),
+                         sorted([u1, u2]))
+        self.assertTrue(self.graph.is_following(u3, u0))
+        self.assertFalse(self.graph.is_following(u0, u3))
+
+    def test_overlay(self):
+        """Are local follows and unfollows applied over the snapshot?"""
+
+        u0, u1, u2, u3 = self.ids
+
+        self.graph.follow(u0, u3)
+        self.graph.unfollow(u0, u1)
+
+        self.assertEqual(list(self.graph.following(u0)), sorted([u2, u3]))
+        self.assertNotIn(u0, self.graph.followers(u1))
+
+    def test_overlay_capped(self):
+        """Does a full overlay drop its oldest changes?"""
+
+        graph = FollowGraph(self.tmpdir.name, check_seconds=0, max_overlay=4)
+        for other_id in range(100, 105):
+            graph.follow(self.ids[0], other_id)
+
+        following = list(graph.following(self.ids[0]))
+        self.assertNotIn(100, following)
+        self.assertIn(104, following)
+        self.assertLessEqual(len(graph._outgoing[self.ids[0]]), 4)
+
+    def test_overlay_is_per_worker(self):
+        """Do other workers only see a follow once the snapshot is rebuilt?"""
+
+        u0, u1, u2, u3 = self.ids
+        other_worker = FollowGraph(self.tmpdir.name, check_seconds=0)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u0
+            c.post(f"/users/follow/{u3}")
+
+        self.assertIn(u3, self.graph.following(u0))
+        self.assertNotIn(u3, other_worker.following(u0))
+        self.assertNotIn(u0, other_worker.followers(u3))
+
+        with db.engine.connect() as conn:
+            build_snapshot(conn, self.tmpdir.name)
+
+        self.assertIn(u3, other_worker.following(u0))
+        self.assertIn(u0, other_worker.followers(u3))
+
+    def test_rebuild_swaps(self):
+        """Is a rebuilt snapshot picked up, replacing older overlay entries?"""
+
+        u0, u1, u2, u3 = self.ids
+        self.graph.following(u0)
+        self.graph.follow(u0, u3)
+
+        db.session.add(Follows(user_following_id=u0,
+                               user_being_followed_id=u3))
+        db.session.commit()
+        with db.engine.connect() as conn:
+            build_snapshot(conn, self.tmpdir.name)
+
+        self.assertIn(u3, self.graph.following(u0))
+        self.assertEqual(dict(self.graph._outgoing), {})
+
+    def test_profile_hints(self):
+        """Does a profile show who you follow that follows them?"""
+
+        u0, u1, u2, u3 = self.ids
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u0
+
+            html = c.get(f"/users/{u3}").get_data(as_text=True)
+
+        self.assertIn("Followed by", html)
+        self.assertIn("@user1", html)
+        self.assertIn("@user2", html)
+        self.assertIn("Follows you", html)
+
+    def test_grace_from_swap(self):
+        """Is a superseded snapshot kept for the grace period after the
+        swap, however old it is?"""
+
+        first = os.readlink(os.path.join(self.tmpdir.name, 'current'))
+        long_ago = time.time() - 3600
+        os.utime(os.path.join(self.tmpdir.name, first), (long_ago, long_ago))
+
+        with db.engine.connect() as conn:
+            build_snapshot(conn, self.tmpdir.name)
+        self.assertTrue(os.path.isdir(os.path.join(self.tmpdir.name, first)))
+
+        current = os.readlink(os.path.join(self.tmpdir.name, 'current'))
+        _remove_old_snapshots(self.tmpdir.name, keep=current, grace=-1)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir.name, first)))
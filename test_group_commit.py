@@ -0,0 +1,127 @@
+"""Group commit tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_group_commit.py
+
+
+import os
+
+from sqlalchemy import event
+
+from models import db, User, Message, MessageTag
+from group_commit import GroupCommitter
+
+from testing import app, CURR_USER_KEY, DBTestCase
+
+
+class GroupCommitTestCase(DBTestCase):
+    """Test batching, failures and the posting view."""
+
+    def setUp(self):
+        super().setUp()
+
+        user = User.signup("testuser", "test@test.com", "password",
+                           None, None, None)
+        db.session.commit()
+        self.user_id = user.id
+        db.session.remove()
+
+        self.committer = GroupCommitter(db.engine, max_batch=3, max_wait=0)
+        self.app_committer = app.extensions['group_commit']
+        app.extensions['group_commit'] = self.committer
+
+        self.commits = 0
+        event.listen(db.engine, 'commit', self._count)
+
+    def tearDown(self):
+        event.remove(db.engine, 'commit', self._count)
+        super().tearDown()
+        app.extensions['group_commit'] = self.app_committer
+        app.config['GROUP_COMMIT'] = False
+
+    def _count(self, conn):
+        self.commits += 1
+
+    def queue(self, *texts, user_id=None):
+        # queued, but written by hand
+        self.committer._thread_pid = os.getpid()
+        return [self.committer.submit(user_id or self.user_id, text)
+                for text in texts]
+
+    def test_batches(self):
+        """Are queued messages written max_batch at a time, one commit
+        each?"""
+
+        posts = self.queue(*(f"warble {i}" for i in range(5)))
+
+        batch = self.committer.next_batch()
+        self.assertEqual(batch, posts[:3])
+        self.committer.commit(batch)
+        self.committer.commit(self.committer.next_batch())
+
+        self.assertEqual(self.commits, 2)
+        for post in posts:
+            post.wait(0)
+            self.assertIsNotNone(post.timestamp)
+        self.assertEqual(Message.query.count(), 5)
+
+    def test_tags(self):
+        post, = self.queue("")
+        post.tags = [('#', 'fun'), ('@', 'testuser')]
+        self.committer.commit(self.committer.next_batch())
+
+        self.assertEqual(
+            {(t.kind, t.tag) for t in
+             MessageTag.query.filter_by(message_id=post.id)},
+            {('#', 'fun'), ('@', 'testuser')})
+
+    def test_failure(self):
+        """Does a bad message fail alone?"""
+
+        good, = self.queue("good")
+        bad, = self.queue("bad", user_id=-1)
+        self.committer.commit(self.committer.next_batch())
+
+        good.wait(0)
+        with self.assertRaises(Exception):
+            bad.wait(0)
+        self.assertEqual([m.text for m in Message.query], ["good"])
+
+    def test_view(self):
+        """Is a post durable when the view redirects?"""
+
+        app.config['GROUP_COMMIT'] = True
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        resp = client.post("/messages/new", data={"text": "hi #grouped"})
+
+        self.assertEqual(resp.status_code, 302)
+        msg = Message.query.one()
+        self.assertEqual(msg.text, "hi #grouped")
+        self.assertEqual([t.tag for t in msg.tags], ["grouped"])
+        self.assertEqual(app.extensions['explore'].latest(1)[0].id, msg.id)
+
+    def test_view_timeout(self):
+        """Is a post that's slow to commit redirected, not an error?"""
+
+        app.config['GROUP_COMMIT'] = True
+        self.committer._thread_pid = os.getpid()
+        self.committer.timeout = 0
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        resp = client.post("/messages/new", data={"text": "slow"})
+
+        self.assertEqual(resp.status_code, 302)
+        with client.session_transaction() as sess:
+            self.assertEqual(
+                sess['_flashes'],
+                [("warning", "Your warble is still being posted.")])
+
+        # it's still queued, and commits once the writer gets to it
+        self.committer.commit(self.committer.next_batch())
+        self.assertEqual([m.text for m in Message.query], ["slow"])
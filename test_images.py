@@ -0,0 +1,119 @@
+"""Uploaded image tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_images.py
+
+
+import io
+import os
+import tempfile
+
+from PIL import Image
+
+from models import User
+from images import ImageStore, InvalidImage, SIZES
+
+from testing import app, DBTestCase
+
+
+def image_bytes(color='red', size=(300, 200), fmt='PNG'):
+    buf = io.BytesIO()
+    Image.new('RGB', size, color).save(buf, fmt)
+    return buf.getvalue()
+
+
+class ImageStoreTestCase(DBTestCase):
+    """Test storage, deduplication and serving of uploads."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = ImageStore(self.tmpdir.name)
+
+        self.app_images = app.extensions['images']
+        app.extensions['images'] = self.store
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        super().tearDown()
+        app.extensions['images'] = self.app_images
+        self.tmpdir.cleanup()
+
+    def test_thumbnail_sizes(self):
+        """Is every size generated, cropped to its exact dimensions?"""
+
+        url = self.store.save('avatar', image_bytes())
+        path = os.path.join(self.tmpdir.name, url[len('/images/'):])
+
+        for name, size in SIZES['avatar'].items():
+            with Image.open(os.path.join(path, name + '.jpg')) as image:
+                self.assertEqual(image.size, size)
+                self.assertEqual(image.format, 'JPEG')
+
+    def test_deduplicated(self):
+        """Is the same upload stored once under one URL?"""
+
+        first = self.store.save('avatar', image_bytes())
+        second = self.store.save('avatar', image_bytes())
+        other = self.store.save('avatar', image_bytes('blue'))
+
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.tmpdir.name, 'avatar'))), 2)
+
+    def test_invalid(self):
+        with self.assertRaises(InvalidImage):
+            self.store.save('avatar', b"not an image")
+
+    def test_signup_upload(self):
+        """Does an uploaded avatar become the user's image?"""
+
+        resp = self.client.post("/signup", data={
+            "username": "uploader",
+            "email": "uploader@test.com",
+            "password": "password",
+            "image_file": (io.BytesIO(image_bytes()), "me.png"),
+        }, content_type="multipart/form-data")
+
+        self.assertEqual(resp.status_code, 302)
+
+        user = User.query.filter_by(username="uploader").one()
+        self.assertTrue(user.image_url.startswith("/images/avatar/"))
+
+        resp = self.client.get(user.image_url + "/timeline.jpg")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "image/jpeg")
+        self.assertIn("immutable", resp.headers["Cache-Control"])
+        self.assertIn("max-age=31536000", resp.headers["Cache-Control"])
+
+    def test_signup_bad_upload(self):
+        """Is an unreadable upload reported on the form?"""
+
+        resp = self.client.post("/signup", data={
+            "username": "uploader",
+            "email": "uploader@test.com",
+            "password": "password",
+            "image_file": (io.BytesIO(b"not an image"), "me.png"),
+        }, content_type="multipart/form-data")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Couldn&#39;t read image", resp.get_data(as_text=True))
+        self.assertIsNone(User.query.filter_by(username="uploader").first())
+
+    def test_unknown_thumbnail(self):
+        self.assertEqual(
+            self.client.get(f"/images/avatar/{'0' * 64}/huge.jpg").status_code,
+            404)
+        self.assertEqual(
+            self.client.get(f"/images/avatar/{'0' * 64}/card.jpg").status_code,
+            404)
+
+    def test_page_still_uncached(self):
+        """Do ordinary pages keep their no-cache headers?"""
+
+        resp = self.client.get("/signup")
+        self.assertNotIn("immutable", resp.headers["Cache-Control"])
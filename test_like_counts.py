@@ -0,0 +1,127 @@
+"""Like count tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_like_counts.py
+
+
+import os
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+
+from models import db, User, Message, Likes
+from like_counts import LikeCounter, reconcile
+
+from testing import app, CURR_USER_KEY, DBTestCase
+
+
+class LikeCountTestCase(DBTestCase):
+    """Test buffered like counts, reconciling and display."""
+
+    def setUp(self):
+        super().setUp()
+
+        author = User(username="author",
+                      email="author@test.com",
+                      password="HASHED_PASSWORD")
+        fan = User(username="fan",
+                   email="fan@test.com",
+                   password="HASHED_PASSWORD")
+        db.session.add_all([author, fan])
+        db.session.commit()
+
+        msg = Message(text="likeable", user_id=author.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.author_id = author.id
+        self.fan_id = fan.id
+        self.msg_id = msg.id
+
+        # flushed only when a test says so
+        self.counter = LikeCounter(db.engine, flush_seconds=3600)
+        self.counter._thread_pid = os.getpid()
+        self.app_counter = app.extensions['like_counts']
+        app.extensions['like_counts'] = self.counter
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        super().tearDown()
+        app.extensions['like_counts'] = self.app_counter
+
+    def like_count(self):
+        db.session.expire_all()
+        return Message.query.get(self.msg_id).like_count
+
+    def like(self, user_id):
+        db.session.add(Likes(user_id=user_id, message_id=self.msg_id))
+        db.session.commit()
+        self.counter.add(self.msg_id)
+
+    def test_coalesced(self):
+        """Are many likes of one message written as one row update?"""
+
+        self.like(self.fan_id)
+        self.like(self.author_id)
+        self.assertEqual(self.like_count(), 0)
+
+        self.assertEqual(self.counter.flush(), 1)
+        self.assertEqual(self.like_count(), 2)
+        self.assertEqual(self.counter.flush(), 0)
+
+    def test_reconcile_with_pending(self):
+        """Is a like counted once when reconciling runs before its worker
+        flushes?"""
+
+        self.like(self.fan_id)
+
+        with db.engine.begin() as conn:
+            self.assertEqual(reconcile(conn), 1)
+        self.counter.flush()
+        self.assertEqual(self.like_count(), 1)
+
+    def test_failed_flush_kept(self):
+        """Is a message recounted by the next flush if a write fails?"""
+
+        self.like(self.fan_id)
+        engine = self.counter.engine
+        self.counter.engine = create_engine("postgresql:///warbler-no-such-db")
+        with self.assertRaises(OperationalError):
+            self.counter.flush()
+
+        self.counter.engine = engine
+        self.assertEqual(self.counter.flush(), 1)
+        self.assertEqual(self.like_count(), 1)
+
+    def test_toggle_like(self):
+        """Do liking and unliking move the count once flushed?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.fan_id
+
+            c.post(f"/users/toggle_like/{self.msg_id}")
+            self.counter.flush()
+            self.assertEqual(self.like_count(), 1)
+
+            html = c.get(f"/users/{self.author_id}").get_data(as_text=True)
+            self.assertIn('<i class="fa fa-thumbs-up"></i> 1</span>', html)
+
+            c.post(f"/users/toggle_like/{self.msg_id}")
+            self.counter.flush()
+            self.assertEqual(self.like_count(), 0)
+
+    def test_reconcile(self):
+        """Does reconciling correct counts that drifted?"""
+
+        db.session.add(Likes(user_id=self.fan_id, message_id=self.msg_id))
+        Message.query.filter_by(id=self.msg_id).update({'like_count': 5})
+        db.session.commit()
+
+        with db.engine.begin() as conn:
+            self.assertEqual(reconcile(conn), 1)
+            self.assertEqual(reconcile(conn), 0)
+
+        self.assertEqual(self.like_count(), 1)
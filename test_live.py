@@ -0,0 +1,201 @@
+"""Live new-message tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_live.py
+
+
+import sys
+import threading
+from unittest import TestCase
+
+from models import db, User, Message
+from live import FeedBroker
+from views import LIVE_PAGE_SIZE
+
+from testing import app, CURR_USER_KEY, DBTestCase
+
+
+class FeedBrokerTestCase(TestCase):
+    """Test routing of published messages to subscriptions."""
+
+    def test_routes_by_author(self):
+        broker = FeedBroker()
+        sub1 = broker.subscribe([1, 2])
+        sub2 = broker.subscribe([2, 3])
+
+        broker.publish(1)
+        broker.publish(2)
+
+        self.assertEqual(sub1.count, 2)
+        self.assertEqual(sub2.count, 1)
+        self.assertTrue(sub1.wait(0))
+        self.assertFalse(sub1.wait(0))
+
+    def test_unsubscribe(self):
+        broker = FeedBroker()
+        sub = broker.subscribe([1, 2])
+        self.assertEqual(len(broker), 1)
+
+        broker.unsubscribe(sub)
+        broker.publish(1)
+
+        self.assertEqual(len(broker), 0)
+        self.assertEqual(sub.count, 0)
+
+    def test_initial_count_wakes(self):
+        """Is a stream that starts with a backlog woken straight away?"""
+
+        sub = FeedBroker().subscribe([1], count=3)
+        self.assertTrue(sub.wait(0))
+
+    def test_no_lost_wakeups(self):
+        """Is every publish counted, and woken for, with streams waking and
+        other workers publishing at the same time?"""
+
+        # switch threads as often as possible, to land publishes anywhere
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-6)
+
+        broker = FeedBroker()
+        sub = broker.subscribe([1])
+        publishers = [threading.Thread(
+                          target=lambda: [broker.publish(1)
+                                          for _ in range(500)])
+                      for _ in range(4)]
+        for publisher in publishers:
+            publisher.start()
+
+        seen = 0
+        while seen < 2000:
+            self.assertTrue(sub.wait(1), f"woken for {seen} of 2000")
+            seen = sub.count
+        for publisher in publishers:
+            publisher.join()
+
+        self.assertEqual(sub.count, 2000)
+        self.assertFalse(sub.wait(0))
+
+
+class LiveViewsTestCase(DBTestCase):
+    """Test the since-id and event stream endpoints."""
+
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("testuser1", "test1@test.com", "password",
+                         None, None, None)
+        u2 = User.signup("testuser2", "test2@test.com", "password",
+                         None, None, None)
+        u3 = User.signup("testuser3", "test3@test.com", "password",
+                         None, None, None)
+        db.session.commit()
+        u1.following.append(u2)
+        u2.following.append(u1)
+
+        old = Message(text="old", user_id=u2.id)
+        db.session.add(old)
+        db.session.commit()
+        self.since_id = old.id
+
+        for text, user in [("new 1", u2), ("stranger", u3), ("new 2", u1)]:
+            db.session.add(Message(text=text, user_id=user.id))
+        db.session.commit()
+
+        self.user_id = u1.id
+        self.ids = (u1.id, u2.id, u3.id)
+        db.session.remove()
+
+        self.broker = FeedBroker()
+        self.app_broker = app.extensions['live']
+        app.extensions['live'] = self.broker
+        self.app_stream_seconds = app.config['STREAM_SECONDS']
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def tearDown(self):
+        super().tearDown()
+        app.extensions['live'] = self.app_broker
+        app.config['STREAM_SECONDS'] = self.app_stream_seconds
+
+    def test_since(self):
+        """Are only newer feed messages returned, with string ids?"""
+
+        resp = self.client.get(f"/messages/since?since_id={self.since_id}")
+        messages = resp.json['messages']
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(resp.json['more'])
+        self.assertEqual(len(messages), 2)
+        self.assertIsInstance(messages[0]['id'], str)
+        self.assertGreater(int(messages[1]['id']), self.since_id)
+        self.assertIn("new 2", messages[0]['html'])
+        self.assertIn("new 1", messages[1]['html'])
+
+    def test_since_more(self):
+        """Is a client more than a page behind told to reload?"""
+
+        db.session.add_all(Message(text=f"more {i}", user_id=self.ids[1])
+                           for i in range(LIVE_PAGE_SIZE + 1))
+        db.session.commit()
+
+        resp = self.client.get(f"/messages/since?since_id={self.since_id}")
+
+        self.assertTrue(resp.json['more'])
+        self.assertEqual(len(resp.json['messages']), LIVE_PAGE_SIZE)
+        self.assertIn(f"more {LIVE_PAGE_SIZE}",
+                      resp.json['messages'][0]['html'])
+
+    def test_since_requires_login(self):
+        with self.client.session_transaction() as sess:
+            del sess[CURR_USER_KEY]
+
+        resp = self.client.get("/messages/since")
+        self.assertEqual(resp.status_code, 302)
+
+    def test_stream_counts(self):
+        """Does a stream count what's new, then what's published?"""
+
+        app.config['STREAM_SECONDS'] = 5
+        resp = self.client.get(f"/messages/stream?since_id={self.since_id}")
+        chunks = iter(resp.response)
+
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        self.assertEqual(next(chunks), b"retry: 5000\n\n")
+        self.assertEqual(next(chunks),
+                         b'event: count\ndata: {"count": 2}\n\n')
+
+        self.broker.publish(self.ids[1])
+        self.assertEqual(next(chunks),
+                         b'event: count\ndata: {"count": 3}\n\n')
+
+        resp.close()
+        self.assertEqual(len(self.broker), 0)
+
+    def test_stream_ignores_others(self):
+        """Is a post by someone outside the feed left out?"""
+
+        app.config['STREAM_SECONDS'] = 0.2
+        app.config['STREAM_HEARTBEAT_SECONDS'], saved = (
+            0.05, app.config['STREAM_HEARTBEAT_SECONDS'])
+        try:
+            resp = self.client.get("/messages/stream")
+            self.broker.publish(self.ids[2])
+            body = resp.get_data(as_text=True)
+        finally:
+            app.config['STREAM_HEARTBEAT_SECONDS'] = saved
+
+        self.assertIn(": keepalive", body)
+        self.assertNotIn("event: count", body)
+
+    def test_add_publishes(self):
+        """Does posting a message wake its author's followers' streams?"""
+
+        sub = self.broker.subscribe([self.user_id])
+
+        resp = self.client.post("/messages/new", data={"text": "Hello"})
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(sub.count, 1)
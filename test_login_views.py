@@ -2,57 +2,26 @@
 
 # run these tests like:
 #
-#    FLASK_ENV=production python -m unittest test_login_views.py
+#    python -m unittest test_login_views.py
 
 
-import os
-from unittest import TestCase
-
-from models import db, connect_db, Message, User
+from models import db, Message, User
 from datetime import datetime
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-
-# Now we can import app
-
-from app import app, CURR_USER_KEY
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
-
-# Don't have WTForms use CSRF at all, since it's a pain to test
+from testing import app, CURR_USER_KEY, DBTestCase
 
-app.config['WTF_CSRF_ENABLED'] = False
 
-
-class LoginViewTestCase(TestCase):
+class LoginViewTestCase(DBTestCase):
     """Test views for login."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
+        super().setUp()
+
         self.client = app.test_client()
 
         #Seed initial users
-        all_messages = Message.query.all()
-        for test_message in all_messages:
-            db.session.delete(test_message)
-        db.session.commit()
-
-        all_users = User.query.all()
-        for test_user in all_users:
-            db.session.delete(test_user)
-        db.session.commit()
-
         testuser1 = User.signup(username="testuser1",
                                     email="test@test.com",
                                     password="testuser",
@@ -83,10 +52,6 @@ class LoginViewTestCase(TestCase):
             db.session.add(msg)
         db.session.commit()
 
-    def tearDown(self):
-        """Tear down"""
-        db.session.rollback()
-
     def test_signup_form(self):
         """Can a new user see the sign up form? """
         with self.client as c:
@@ -1,38 +1,21 @@
 """Message View tests."""
 
-import os
-from unittest import TestCase
-
-from models import db, connect_db, Message, User
+from models import db, Message, User
 from datetime import datetime
 
+from testing import app, CURR_USER_KEY, DBTestCase
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-
-from app import app, CURR_USER_KEY
-
-db.create_all()
-
-app.config['WTF_CSRF_ENABLED'] = False
 
-
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(DBTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
+        super().setUp()
+
         self.client = app.test_client()
 
-        all_messages = Message.query.all()
-        for test_message in all_messages:
-            db.session.delete(test_message)
-        db.session.commit()
-        all_users = User.query.all()
-        for test_user in all_users:
-            db.session.delete(test_user)
-        db.session.commit()
         testuser1 = User.signup(username="testuser1",
                                     email="test@test.com",
                                     password="testuser",
@@ -62,10 +45,6 @@ class MessageViewTestCase(TestCase):
             db.session.add(msg)
         db.session.commit()
 
-    def tearDown(self):
-        """Tear down"""
-        db.session.rollback()
-
     def test_add_message(self):
         """Can user add a message?"""
 
@@ -78,7 +57,7 @@ class MessageViewTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 302)
 
-            msg = Message.query.order_by(Message.timestamp.asc()).first()
+            msg = Message.query.order_by(Message.id.desc()).first()
             self.assertEqual(msg.text, "Hello")
     
     def test_show_own_message(self):
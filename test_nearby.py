@@ -0,0 +1,152 @@
+"""Users-near-me tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_nearby.py
+
+
+import random
+from unittest import TestCase
+
+from models import db, User
+from nearby import (Gazetteer, GeohashIndex, KDTreeIndex, geohash_encode,
+                    geohash_block, distance_km)
+
+from testing import app, CURR_USER_KEY, DBTestCase
+
+
+class GeohashTestCase(TestCase):
+    """Test geohashes and the gazetteer on their own."""
+
+    def test_encode(self):
+        self.assertEqual(geohash_encode(57.64911, 10.40744, 11),
+                         "u4pruydqqvj")
+        self.assertEqual(geohash_encode(-33.8679, 151.2073, 5), "r3gx2")
+
+    def test_block(self):
+        block = geohash_block(57.64911, 10.40744, 5)
+
+        self.assertEqual(len(block), 9)
+        self.assertIn("u4pru", block)
+
+        # wraps around at 180 degrees
+        self.assertEqual(len(geohash_block(0.01, 179.99, 3)), 9)
+
+    def test_resolve(self):
+        gazetteer = Gazetteer.load()
+
+        self.assertEqual(gazetteer.resolve("Paris"), (48.8534, 2.3488))
+        self.assertEqual(gazetteer.resolve(" são   PAULO, Brazil"),
+                         gazetteer.resolve("Sao Paulo"))
+        self.assertEqual(gazetteer.resolve("NYC"),
+                         gazetteer.resolve("New York, NY"))
+        # the bigger one, unless qualified
+        self.assertEqual(gazetteer.resolve("Birmingham"),
+                         (52.4814, -1.8998))
+        self.assertEqual(gazetteer.resolve("Birmingham, AL"),
+                         (33.5207, -86.8025))
+        self.assertIsNone(gazetteer.resolve("East Jessicaside"))
+        self.assertIsNone(gazetteer.resolve(None))
+
+
+class NearbyTestCase(DBTestCase):
+    """Test the indexes against brute force, and the pages."""
+
+    def setUp(self):
+        super().setUp()
+
+        # clustered around a few cities, with some far away
+        rng = random.Random(49)
+        centres = [(42.36, -71.06), (40.71, -74.01), (51.51, -0.13)]
+        for i in range(200):
+            if i % 10 == 9:
+                lat, lon = rng.uniform(-60, 70), rng.uniform(-180, 180)
+            else:
+                lat, lon = rng.choice(centres)
+                lat += rng.gauss(0, 0.3)
+                lon += rng.gauss(0, 0.3)
+            # one bcrypt hash for them all, which is much quicker
+            if i == 0:
+                user = User.signup(f"user{i}", f"user{i}@test.com",
+                                   "password", None, None, None)
+                password = user.password
+            else:
+                user = User(username=f"user{i}", email=f"user{i}@test.com",
+                            password=password)
+            user.latitude, user.longitude = lat, lon
+            user.geohash = geohash_encode(lat, lon)
+            db.session.add(user)
+        db.session.commit()
+        self.points = {u.id: (u.latitude, u.longitude)
+                       for u in User.query}
+        db.session.remove()
+
+    def brute_force(self, lat, lon, k, exclude_id=None):
+        distances = sorted(
+            (distance_km(lat, lon, *point), user_id)
+            for user_id, point in self.points.items()
+            if user_id != exclude_id)
+        return [user_id for _, user_id in distances[:k]]
+
+    def check(self, index, points):
+        for lat, lon in points:
+            for k in (1, 5, 25):
+                found = index.nearest(lat, lon, k)
+                self.assertEqual([user_id for user_id, _ in found],
+                                 self.brute_force(lat, lon, k))
+                self.assertAlmostEqual(
+                    found[-1][1],
+                    distance_km(lat, lon, *self.points[found[-1][0]]),
+                    places=3)
+
+        user_id, point = next(iter(self.points.items()))
+        found = index.nearest(*point, 3, exclude_id=user_id)
+        self.assertEqual([user_id for user_id, _ in found],
+                         self.brute_force(*point, 3, exclude_id=user_id))
+
+    def test_geohash_index(self):
+        self.check(GeohashIndex(), [(42.36, -71.06), (41.5, -72.5),
+                                    (51.0, 0.0)])
+
+        # far from everyone, it stops widening with what it found
+        found = GeohashIndex().nearest(-20.0, 40.0, 25)
+        self.assertLess(len(found), 25)
+
+    def test_kdtree_index(self):
+        self.check(KDTreeIndex(), [(42.36, -71.06), (41.5, -72.5),
+                                   (51.0, 0.0), (-20.0, 40.0)])
+
+    def test_geocoded_in_background(self):
+        """Does a location edit place the user, off the request?"""
+
+        user_id = User.query.filter_by(username="user0").one().id
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        user = User.query.get(user_id)
+        resp = client.post("/users/profile", data={
+            'username': user.username, 'email': user.email,
+            'password': "password", 'location': "Boston, MA"})
+        self.assertEqual(resp.status_code, 302)
+
+        app.extensions['geocoder'].join()
+        db.session.expire_all()
+        user = User.query.get(user_id)
+        self.assertEqual((user.latitude, user.longitude),
+                         (42.3584, -71.0598))
+        self.assertEqual(user.geohash, geohash_encode(42.3584, -71.0598))
+
+        resp = client.get("/users/nearby?k=3")
+        html = resp.get_data(as_text=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(html.count('class="list-group-item"'), 3)
+        self.assertNotIn(f"@{user.username}<", html)
+
+        # somewhere unknown means nowhere
+        client.post("/users/profile", data={
+            'username': user.username, 'email': user.email,
+            'password': "password", 'location': "Atlantis"})
+        app.extensions['geocoder'].join()
+        resp = client.get("/users/nearby")
+        self.assertIn("couldn't place your location", resp.get_data(as_text=True))
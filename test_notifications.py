@@ -0,0 +1,171 @@
+"""Notification tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_notifications.py
+
+
+from datetime import datetime
+
+from sqlalchemy import event
+
+from models import db, User, Message, Notification
+from notifications import (NotificationBuffer, inbox_page, mark_read,
+                           unread_count)
+from replicas import ReplicaRouter
+
+from testing import app, CURR_USER_KEY, DBTestCase
+
+
+class NotificationTestCase(DBTestCase):
+    """Test the buffer, the inbox and the pages using them."""
+
+    def setUp(self):
+        super().setUp()
+
+        users = [User.signup(f"testuser{i}", f"test{i}@test.com", "password",
+                             None, None, None)
+                 for i in range(5)]
+        db.session.commit()
+        msg = Message(text="going viral", user_id=users[0].id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.ids = [user.id for user in users]
+        self.msg_id = msg.id
+        db.session.remove()
+
+        self.now = datetime(2021, 1, 1, 12, 10)
+        self.buffer = NotificationBuffer(db.engine, clock=lambda: self.now)
+        # flushed by hand
+        self.buffer._start_flusher = lambda: None
+        self.app_buffer = app.extensions['notifications']
+        app.extensions['notifications'] = self.buffer
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        super().tearDown()
+        app.extensions['notifications'] = self.app_buffer
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_aggregation(self):
+        """Do likes of one message in one hour make one row?"""
+
+        owner, *likers = self.ids
+        for liker in likers:
+            self.buffer.add(owner, 'like', liker, self.msg_id)
+        self.buffer.add(owner, 'like', owner, self.msg_id)
+        self.assertEqual(self.buffer.flush(), 1)
+
+        self.buffer.add(owner, 'like', likers[0], self.msg_id)
+        self.buffer.flush()
+
+        row = Notification.query.one()
+        self.assertEqual(row.count, 5)
+        self.assertEqual(row.bucket, datetime(2021, 1, 1, 12))
+        self.assertEqual(row.actor_ids, [likers[0], likers[3], likers[2]])
+
+        # the next hour starts a new row
+        self.now = datetime(2021, 1, 1, 13, 5)
+        self.buffer.add(owner, 'like', likers[1], self.msg_id)
+        self.buffer.flush()
+        self.assertEqual(Notification.query.count(), 2)
+
+    def test_unread(self):
+        owner = self.ids[0]
+        self.buffer.add(owner, 'follow', self.ids[1])
+        self.buffer.add(owner, 'like', self.ids[1], self.msg_id)
+        self.buffer.flush()
+        self.assertEqual(unread_count(owner), 2)
+
+        mark_read(owner)
+        self.assertEqual(unread_count(owner), 0)
+
+        # a new like on a read row makes it unread again
+        self.buffer.add(owner, 'like', self.ids[2], self.msg_id)
+        self.buffer.flush()
+        self.assertEqual(unread_count(owner), 1)
+
+    def test_pages(self):
+        owner = self.ids[0]
+        for hour in range(5):
+            self.now = datetime(2021, 1, 1, hour)
+            self.buffer.add(owner, 'follow', self.ids[1])
+            self.buffer.flush()
+
+        rows, before = inbox_page(owner, limit=2)
+        seen = [row.bucket.hour for row in rows]
+        while before:
+            rows, before = inbox_page(owner, before, limit=2)
+            seen += [row.bucket.hour for row in rows]
+
+        self.assertEqual(seen, [4, 3, 2, 1, 0])
+
+    def test_views(self):
+        """Do likes and follows reach the inbox, to be marked read by a
+        POST?"""
+
+        owner, *others = self.ids
+        for other in others:
+            self.login(other)
+            self.client.post(f"/users/toggle_like/{self.msg_id}")
+        self.login(others[0])
+        self.client.post(f"/users/follow/{owner}")
+        self.buffer.flush()
+
+        self.login(owner)
+        resp = self.client.get("/")
+        self.assertIn('badge-pill badge-primary">2<', resp.get_data(as_text=True))
+
+        resp = self.client.get("/notifications")
+        html = resp.get_data(as_text=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("@testuser4</a>, <a", html)
+        self.assertIn("and 2 others", html)
+        self.assertIn("liked your warble", html)
+        self.assertIn("followed you", html)
+        # viewing changes nothing
+        self.assertEqual(unread_count(owner), 2)
+
+        seq = db.session.query(db.func.max(Notification.seq)).scalar()
+        self.assertIn(f'name="seq" value="{seq}"', html)
+
+        # a follow since the page was shown stays unread
+        self.login(others[1])
+        self.client.post(f"/users/follow/{owner}")
+        self.buffer.flush()
+
+        self.login(owner)
+        resp = self.client.post("/notifications/read", data={"seq": seq})
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(unread_count(owner), 1)
+
+    def test_mark_read_on_primary(self):
+        """Does marking read in a GET write to the primary, with replicas?"""
+
+        self.buffer.add(self.ids[0], 'follow', self.ids[1])
+        self.buffer.flush()
+
+        router = ReplicaRouter([str(db.engine.url)])
+        replica_statements = []
+        event.listen(router.engines[0], 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args:
+                     replica_statements.append(statement))
+        app.extensions['replica_router'] = router
+        try:
+            with app.test_request_context("/notifications"):
+                mark_read(self.ids[0])
+        finally:
+            app.extensions.pop('replica_router')
+
+        self.assertFalse([s for s in replica_statements
+                          if s.startswith("UPDATE")])
+        self.assertEqual(unread_count(self.ids[0]), 0)
+
+    def test_logged_out(self):
+        resp = self.client.get("/notifications")
+        self.assertEqual(resp.status_code, 302)
@@ -0,0 +1,190 @@
+"""Message partitioning tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_partitions.py
+#
+# Each test converts a copy of the schema, in a Postgres schema of its own
+# that's rolled back afterwards, so the test database itself isn't changed.
+
+
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import text
+
+from archive import Archive
+from models import db, Message, RECENT_WINDOW
+from partitions import (migrate, ensure_partitions, ensure_if_partitioned,
+                        partition_name, next_month, MONTHS_AHEAD)
+
+from testing import app, DBTestCase
+
+
+class PartitionTestCase(TestCase):
+    """Test converting messages and keeping partitions ahead."""
+
+    def setUp(self):
+        """Make a schema with one user, a like and a message in each of
+        January and March 2020."""
+
+        self.conn = db.engine.connect()
+        self.transaction = self.conn.begin()
+        self.conn.execute(text("CREATE SCHEMA partition_test"))
+        self.conn.execute(text("SET LOCAL search_path TO partition_test"))
+        db.metadata.create_all(self.conn)
+
+        self.conn.execute(text(
+            "INSERT INTO users (id, email, username, password)"
+            " VALUES (1, 'test@test.com', 'testuser', 'x')"))
+        for message_id, timestamp in ((1, datetime(2020, 1, 15)),
+                                      (2, datetime(2020, 3, 15))):
+            self.insert_message(message_id, timestamp)
+        self.conn.execute(text(
+            "INSERT INTO likes (user_id, message_id) VALUES (1, 1)"))
+
+    def tearDown(self):
+        self.transaction.rollback()
+        self.conn.close()
+
+    def insert_message(self, message_id, timestamp):
+        self.conn.execute(text(
+            "INSERT INTO messages (id, text, timestamp, user_id)"
+            " VALUES (:id, 'warble', :timestamp, 1)"),
+            id=message_id, timestamp=timestamp)
+
+    def partition_of(self, message_id):
+        return self.conn.execute(text(
+            "SELECT tableoid::regclass::text FROM messages WHERE id = :id"),
+            id=message_id).scalar()
+
+    def partitions(self):
+        return {name for name, in self.conn.execute(text(
+            "SELECT inhrelid::regclass::text FROM pg_inherits"
+            " WHERE inhparent = 'messages'::regclass"))}
+
+    def test_migrate(self):
+        """Does every month from the oldest message on get a partition, with
+        each message in its own?"""
+
+        migrate(self.conn)
+
+        partitions = self.partitions()
+        for month in (1, 2, 3):
+            self.assertIn(partition_name(datetime(2020, month, 1)),
+                          partitions)
+        self.assertIn(partition_name(datetime.utcnow()), partitions)
+        self.assertIn("messages_default", partitions)
+
+        self.assertEqual(self.partition_of(1), "messages_p2020_01")
+        self.assertEqual(self.partition_of(2), "messages_p2020_03")
+
+    def test_ensure_rolls_over(self):
+        """Are the next months created as time passes, and only once?"""
+
+        migrate(self.conn)
+        later = datetime.utcnow() + timedelta(days=365)
+
+        created = ensure_partitions(self.conn, now=later)
+
+        self.assertGreater(created, 0)
+        last = later
+        for _ in range(MONTHS_AHEAD):
+            last = next_month(last)
+        self.assertIn(partition_name(last), self.partitions())
+        self.assertEqual(ensure_partitions(self.conn, now=later), 0)
+
+    def test_moves_rows_out_of_default(self):
+        """Are messages written while their month had no partition moved to
+        it, keeping their likes?"""
+
+        migrate(self.conn)
+        future = datetime.utcnow() + timedelta(days=365)
+        self.insert_message(3, future)
+        self.conn.execute(text(
+            "INSERT INTO likes (user_id, message_id) VALUES (1, 3)"))
+        self.assertEqual(self.partition_of(3), "messages_default")
+
+        ensure_partitions(self.conn, now=future)
+
+        self.assertEqual(self.partition_of(3), partition_name(future))
+        self.assertEqual(self.conn.execute(text(
+            "SELECT count(*) FROM messages_default")).scalar(), 0)
+        self.assertEqual(self.conn.execute(text(
+            "SELECT count(*) FROM likes WHERE message_id = 3")).scalar(), 1)
+
+        # deleting still takes the likes with it
+        self.conn.execute(text("DELETE FROM messages WHERE id = 3"))
+        self.assertEqual(self.conn.execute(text(
+            "SELECT count(*) FROM likes WHERE message_id = 3")).scalar(), 0)
+
+    def test_unpartitioned_untouched(self):
+        """Does the workers' check leave an unpartitioned database alone?"""
+
+        self.assertEqual(ensure_if_partitioned(db.engine), 0)
+
+
+class WideningTestCase(DBTestCase):
+    """Test how far back timeline queries search."""
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.app_archive = app.extensions['archive']
+        app.extensions['archive'] = Archive(self.tmpdir.name)
+
+    def tearDown(self):
+        super().tearDown()
+        app.extensions['archive'] = self.app_archive
+        self.tmpdir.cleanup()
+
+    def widening(self):
+        searched = []
+
+        def run(since):
+            searched.append(since)
+            return []
+
+        with app.app_context():
+            Message._widening(run, 10)
+        return searched
+
+    def test_bounded_queries(self):
+        """Are sparse feeds searched in at most two queries, the second
+        back to the archive's cutoff?"""
+
+        cutoff = datetime(2019, 1, 1)
+        app.extensions['archive'].advance_cutoff(cutoff)
+
+        searched = self.widening()
+
+        self.assertEqual(len(searched), 2)
+        self.assertAlmostEqual(searched[0], datetime.utcnow() - RECENT_WINDOW,
+                               delta=timedelta(seconds=5))
+        self.assertEqual(searched[1], cutoff)
+
+    def test_unarchived_unbounded(self):
+        """With nothing archived, is all of history searched?"""
+
+        self.assertEqual(self.widening()[1], datetime.min)
+
+    def test_most_recent_widens(self):
+        """Does a timeline find messages older than the first window?"""
+
+        with db.engine.begin() as conn:
+            conn.execute(text(
+                "INSERT INTO users (id, email, username, password)"
+                " VALUES (1, 'test@test.com', 'testuser', 'x')"))
+            for message_id, days in ((1, 1000), (2, 100), (3, 1)):
+                conn.execute(text(
+                    "INSERT INTO messages (id, text, timestamp, user_id)"
+                    " VALUES (:id, 'warble', :timestamp, 1)"),
+                    id=message_id,
+                    timestamp=datetime.utcnow() - timedelta(days=days))
+
+        with app.app_context():
+            self.assertEqual([m.id for m in Message.user_timeline(1, 2)],
+                             [3, 2])
+            self.assertEqual([m.id for m in Message.user_timeline(1, 10)],
+                             [3, 2, 1])
@@ -0,0 +1,127 @@
+"""Request profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiler.py
+
+
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from flask import g, render_template
+
+from profiler import (Sampler, RequestProfiler, PROFILE_HEADER, merge,
+                      flame_graph_svg)
+
+from testing import app, DBTestCase
+
+
+def spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class SamplerTestCase(TestCase):
+    """Test stack sampling on its own."""
+
+    def test_counts_stacks(self):
+        sampler = Sampler(interval=0.001)
+        sampler.start()
+        spin(0.05)
+        counts = sampler.stop()
+
+        self.assertGreater(sum(counts.values()), 5)
+        self.assertTrue(any(stack.endswith(f"spin ({os.path.basename(__file__)})")
+                            for stack in counts))
+
+    def test_only_profiled_threads(self):
+        sampler = Sampler(interval=0.001)
+        other = threading.Thread(target=spin, args=(0.05,))
+        other.start()
+        sampler.start()
+        time.sleep(0.05)
+        counts = sampler.stop()
+        other.join()
+
+        self.assertFalse(any("spin" in stack for stack in counts))
+
+    def test_template_frames(self):
+        """Are frames of template code labelled with the template?"""
+
+        sampler = Sampler(interval=0.001)
+        with app.test_request_context():
+            g.user = None
+            sampler.start()
+            end = time.perf_counter() + 0.1
+            while time.perf_counter() < end:
+                render_template('home-anon.html')
+            counts = sampler.stop()
+
+        self.assertTrue(any("(templates/home-anon.html)" in stack
+                            or "(templates/base.html)" in stack
+                            for stack in counts))
+
+    def test_flame_graph(self):
+        svg = flame_graph_svg({"a;b": 3, "a;c": 1}, "test")
+
+        self.assertTrue(svg.startswith("<svg"))
+        self.assertIn("b (3 samples, 75.0%)", svg)
+
+
+class RequestProfilerTestCase(DBTestCase):
+    """Test which requests are profiled and what is written."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.profiler = RequestProfiler(self.tmp.name, token="secret",
+                                        interval=0.001)
+        self.app_profiler = app.extensions['profiler']
+        app.extensions['profiler'] = self.profiler
+        self.client = app.test_client()
+
+    def tearDown(self):
+        super().tearDown()
+        app.extensions['profiler'] = self.app_profiler
+        self.tmp.cleanup()
+
+    def profiles(self, endpoint):
+        directory = os.path.join(self.tmp.name, endpoint)
+        return os.listdir(directory) if os.path.isdir(directory) else []
+
+    def test_header_profiles(self):
+        """Does the header with the right token profile the request?"""
+
+        for _ in range(3):
+            self.client.get("/signup", headers={PROFILE_HEADER: "secret"})
+
+        self.assertEqual(len(self.profiles('warbler.signup')), 3)
+
+    def test_not_profiled(self):
+        """Are requests without the token (and a zero rate) left alone?"""
+
+        self.client.get("/signup")
+        self.client.get("/signup", headers={PROFILE_HEADER: "wrong"})
+
+        self.assertEqual(self.profiles('warbler.signup'), [])
+
+    def test_sample_rate(self):
+        self.profiler.sample_rate = 1.0
+        self.client.get("/signup")
+
+        self.assertEqual(len(self.profiles('warbler.signup')), 1)
+
+    def test_merge(self):
+        """Are samples summed across an endpoint's profiles?"""
+
+        self.profiler.write('warbler.homepage', {"a;b": 2, "a;c": 1})
+        self.profiler.write('warbler.homepage', {"a;b": 3})
+        self.profiler.write('warbler.users_show', {"a;d": 5})
+
+        self.assertEqual(merge(self.tmp.name, 'warbler.homepage'),
+                         {"a;b": 5, "a;c": 1})
@@ -0,0 +1,94 @@
+"""Read-model projection tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_projections.py
+
+
+from models import db, User, Message, Likes
+import projections
+
+from testing import app, CURR_USER_KEY, DBTestCase
+
+
+class ProjectionsTestCase(DBTestCase):
+    """Test that the rows match the ORM timelines, and the pages using
+    them."""
+
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("testuser1", "test1@test.com", "password",
+                         None, None, None)
+        u2 = User.signup("testuser2", "test2@test.com", "password",
+                         None, None, None)
+        u3 = User.signup("testuser3", "test3@test.com", "password",
+                         None, None, None)
+        db.session.commit()
+        # u1 follows two people, which the home join mustn't duplicate
+        u1.following.extend([u2, u3])
+        u2.following.append(u1)
+        for i in range(3):
+            db.session.add(Message(text=f"one {i}", user_id=u1.id))
+            db.session.add(Message(text=f"two {i}", user_id=u2.id))
+        db.session.commit()
+
+        self.ids = (u1.id, u2.id, u3.id)
+        db.session.remove()
+
+    def as_rows(self, messages):
+        return [(m.id, m.text, m.timestamp, m.like_count, m.user_id,
+                 m.user.username, m.user.image_url) for m in messages]
+
+    def test_timelines(self):
+        u1, u2, u3 = self.ids
+
+        self.assertEqual(projections.user_timeline(u1, limit=2),
+                         self.as_rows(Message.user_timeline(u1, limit=2)))
+        self.assertEqual(projections.home_timeline([u1, u2, u3]),
+                         self.as_rows(Message.home_timeline([u1, u2, u3])))
+        self.assertEqual([m.text for m in projections.home_timeline([u1],
+                                                                    limit=2)],
+                         ["one 2", "one 1"])
+
+        newest = projections.home_timeline([u1, u2])
+        self.assertEqual(
+            projections.home_timeline_since([u1, u2], newest[2].id),
+            newest[:2])
+
+    def test_rows(self):
+        """Are rows read-only, and free of the session?"""
+
+        row, = projections.user_timeline(self.ids[0], limit=1)
+
+        with self.assertRaises(AttributeError):
+            row.text = "changed"
+        with self.assertRaises(AttributeError):
+            row.__dict__
+        self.assertFalse(row.archived)
+        self.assertEqual(len(db.session.identity_map), 0)
+
+    def test_likes(self):
+        u1, u2, u3 = self.ids
+        messages = projections.user_timeline(u2)
+        for msg in messages[1:]:
+            db.session.add(Likes(user_id=u1, message_id=msg.id))
+        db.session.commit()
+
+        self.assertEqual(projections.liked_ids(u1, messages),
+                         {msg.id for msg in messages[1:]})
+        self.assertEqual(projections.liked_ids(u1, []), set())
+        self.assertEqual([m.id for m in projections.liked_messages(u1)],
+                         [msg.id for msg in reversed(messages[1:])])
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = u1
+
+        html = client.get("/").get_data(as_text=True)
+        self.assertEqual(html.count("btn-primary"), 2)
+        self.assertIn("@testuser2", html)
+
+        html = client.get(f"/users/{u1}/likes").get_data(as_text=True)
+        self.assertEqual(html.count("btn-primary"), 2)
+        self.assertIn("two 1", html)
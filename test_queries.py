@@ -0,0 +1,100 @@
+"""Baked and prepared query tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_queries.py
+
+
+from sqlalchemy import text
+
+from models import db, User, Message, Follows, get_by_id
+from queries import PREPARED_KEY, fetch
+
+from testing import app, DBTestCase
+
+
+class QueriesTestCase(DBTestCase):
+    """Test that precompiled lookups match their ORM equivalents."""
+
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("testuser1", "test1@test.com", "password",
+                         None, None, None)
+        u2 = User.signup("testuser2", "test2@test.com", "password",
+                         None, None, None)
+        db.session.commit()
+        u1.following.append(u2)
+        for i in range(3):
+            db.session.add(Message(text=f"one {i}", user_id=u1.id))
+            db.session.add(Message(text=f"two {i}", user_id=u2.id))
+        db.session.commit()
+
+        self.ids = (u1.id, u2.id)
+        db.session.remove()
+
+    def test_prepared_on_connect(self):
+        """Are the lookups prepared on the app's connections?"""
+
+        conn = db.session.connection()
+        names = {name for name, in conn.execute(text(
+            "SELECT name FROM pg_prepared_statements"))}
+
+        self.assertIn('warbler_users_by_username', names)
+        self.assertIn('warbler_users_by_username',
+                      conn.info[PREPARED_KEY])
+
+    def test_prepared_and_fallback_agree(self):
+        """Does a connection without prepared statements get the same rows?"""
+
+        prepared = fetch(db.session(), 'warbler_users_by_username',
+                         "testuser1")
+        db.session.remove()
+
+        info = db.session.connection().info
+        saved = info[PREPARED_KEY]
+        info[PREPARED_KEY] = set()
+        try:
+            baked = fetch(db.session(), 'warbler_users_by_username',
+                          "testuser1")
+        finally:
+            info[PREPARED_KEY] = saved
+
+        self.assertEqual([u.id for u in prepared], [self.ids[0]])
+        self.assertEqual([u.id for u in baked], [self.ids[0]])
+        self.assertEqual(fetch(db.session(), 'warbler_users_by_username',
+                               "nobody"), [])
+
+    def test_authenticate(self):
+        self.assertEqual(User.authenticate("testuser1", "password").id,
+                         self.ids[0])
+        self.assertFalse(User.authenticate("testuser1", "wrong"))
+        self.assertFalse(User.authenticate("nobody", "password"))
+
+    def test_get_by_id(self):
+        """Does get_by_id load once, then use the identity map?"""
+
+        user = get_by_id(User, self.ids[1])
+
+        self.assertEqual(user.username, "testuser2")
+        self.assertIs(get_by_id(User, self.ids[1]), user)
+        self.assertIsNone(get_by_id(User, self.ids[1] + 1000))
+
+    def test_timelines(self):
+        """Do the baked timelines match the ORM queries?"""
+
+        u1, u2 = self.ids
+
+        self.assertEqual(
+            Message.user_timeline(u1, limit=2),
+            Message.most_recent(Message.query.filter_by(user_id=u1),
+                                limit=2))
+
+        expected = Message.most_recent(
+            Message.query
+            .join(User)
+            .join(Follows, User.id == Follows.user_following_id)
+            .filter(Message.user_id.in_([u1, u2])))
+        self.assertEqual(Message.home_timeline([u1, u2]), expected)
+        self.assertEqual([m.text for m in Message.home_timeline([u1])],
+                         ["one 2", "one 1", "one 0"])
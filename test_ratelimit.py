@@ -0,0 +1,218 @@
+"""Rate limiting tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+
+
+import os
+import multiprocessing
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from flask import request
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+from app import create_app
+from config import TestConfig
+from models import db, User, Message
+from ratelimit import RateLimiter, SharedBuckets, refill, take
+
+from testing import app, CURR_USER_KEY, DBTestCase
+
+
+class ProxiedConfig(TestConfig):
+    PROXY_COUNT = 1
+
+
+class MemoryBuckets:
+    """Buckets in a dict, for a single process: the tests' limiter."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key, rate, burst, now=None):
+        """Take a token from `key`'s bucket; return (allowed, retry after)."""
+
+        now = time.time() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (0.0, 0.0))
+            allowed, tokens, wait = take(
+                refill(tokens, updated, now, rate, burst), rate)
+            self._buckets[key] = (tokens, now)
+        return allowed, wait
+
+
+def _hit_many(path, count, results):
+    buckets = SharedBuckets(path, slots=64)
+    results.put(sum(buckets.hit("shared", 0.001, 50)[0]
+                    for _ in range(count)))
+
+
+class BucketsTestCase(TestCase):
+    """Test the token buckets on their own."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'buckets')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_burst_then_refill(self):
+        """Is a full burst allowed, then one request per refilled token?"""
+
+        for buckets in (MemoryBuckets(), SharedBuckets(self.path)):
+            results = [buckets.hit("k", 1.0, 3, now=100.0)[0]
+                       for _ in range(4)]
+            self.assertEqual(results, [True, True, True, False])
+
+            allowed, wait = buckets.hit("k", 1.0, 3, now=100.0)
+            self.assertFalse(allowed)
+            self.assertAlmostEqual(wait, 1.0)
+
+            self.assertTrue(buckets.hit("k", 1.0, 3, now=101.0)[0])
+            self.assertTrue(buckets.hit("other", 1.0, 3, now=101.0)[0])
+
+    def test_eviction(self):
+        """Does a full table still serve new keys?"""
+
+        buckets = SharedBuckets(self.path, slots=8)
+        for i in range(100):
+            self.assertTrue(buckets.hit(f"k{i}", 1.0, 1, now=i + 1.0)[0])
+
+    def test_shared_between_processes(self):
+        """Do workers draw from the same buckets?"""
+
+        SharedBuckets(self.path, slots=64)
+        results = multiprocessing.get_context('fork').Queue()
+        workers = [multiprocessing.get_context('fork').Process(
+                       target=_hit_many, args=(self.path, 40, results))
+                   for _ in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(sum(results.get() for _ in workers), 50)
+
+
+class RateLimitViewTestCase(DBTestCase):
+    """Test limits on app endpoints."""
+
+    def setUp(self):
+        super().setUp()
+
+        user = User(username="testuser",
+                    email="test@test.com",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.app_ratelimit = app.extensions['ratelimit']
+        app.extensions['ratelimit'] = RateLimiter(MemoryBuckets(), {
+            'warbler.login': [('ip', 2, 60)],
+            'warbler.messages_add': [('user', 1, 60)],
+            'warbler.users_available': [('ip', 2, 60)],
+        })
+        app.config['RATELIMIT_ENABLED'] = True
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        super().tearDown()
+        app.extensions['ratelimit'] = self.app_ratelimit
+        app.config['RATELIMIT_ENABLED'] = False
+
+    def test_login_throttled(self):
+        """Are logins past the limit refused with Retry-After?"""
+
+        data = {"username": "nobody", "password": "wrongpassword"}
+        codes = [self.client.post("/login", data=data).status_code
+                 for _ in range(3)]
+
+        self.assertEqual(codes, [200, 200, 429])
+
+        resp = self.client.post("/login", data=data)
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers["Retry-After"], "30")
+
+        # reading the form isn't limited
+        self.assertEqual(self.client.get("/login").status_code, 200)
+
+    def test_per_user(self):
+        """Are user limits counted per logged-in user?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            first = c.post("/messages/new", data={"text": "one"})
+            second = c.post("/messages/new", data={"text": "two"})
+
+        self.assertEqual(first.status_code, 302)
+        self.assertEqual(second.status_code, 429)
+        self.assertEqual(Message.query.count(), 1)
+
+    def test_available_throttled(self):
+        """Are availability checks limited, though they're GETs?"""
+
+        codes = [self.client.get("/users/available",
+                                 query_string={"email": f"{i}@test.com"})
+                 .status_code
+                 for i in range(3)]
+
+        self.assertEqual(codes, [200, 200, 429])
+
+    def test_export_throttled(self):
+        """Is the streamed export limited, though it's a GET?"""
+
+        app.extensions['ratelimit'].limits['warbler.export_data'] = [
+            ('user', 1, 3600)]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            first = c.get("/users/export")
+            first.close()
+            second = c.get("/users/export")
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 429)
+
+
+class ProxyTestCase(TestCase):
+    """Test which address clients are limited by."""
+
+    def setUp(self):
+        # creating an app rebinds db to it
+        self.addCleanup(setattr, db, 'app', db.app)
+
+    def remote_addr(self, app, forwarded_for):
+        @app.route('/addr')
+        def addr():
+            return request.remote_addr
+
+        environ = EnvironBuilder(
+            "/addr", headers={'X-Forwarded-For': forwarded_for}).get_environ()
+        environ['REMOTE_ADDR'] = "10.0.0.1"
+        body, _, _ = run_wsgi_app(app, environ, buffered=True)
+        return b"".join(body).decode()
+
+    def test_behind_proxy(self):
+        """Is the client's address taken from the balancer's header?"""
+
+        self.assertEqual(
+            self.remote_addr(create_app(ProxiedConfig), "1.2.3.4, 5.6.7.8"),
+            "5.6.7.8")
+
+    def test_no_proxy(self):
+        """Without a proxy, is a client's own X-Forwarded-For ignored?"""
+
+        self.assertEqual(
+            self.remote_addr(create_app(TestConfig), "1.2.3.4"), "10.0.0.1")
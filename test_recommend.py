@@ -0,0 +1,82 @@
+"""Who-to-follow recommendation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommend.py
+
+
+from models import db, User, Follows, Recommendation
+from recommend import recommend
+
+from testing import app, CURR_USER_KEY, DBTestCase
+
+
+class RecommendTestCase(DBTestCase):
+    """Test the recommender job and the homepage widget."""
+
+    def setUp(self):
+        """Create users: u0 follows u1 and u2, who both follow u3."""
+
+        super().setUp()
+
+        self.users = [User(username=f"user{i}",
+                           email=f"user{i}@test.com",
+                           password="HASHED_PASSWORD")
+                      for i in range(5)]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+        u0, u1, u2, u3, u4 = self.users
+        u0.following = [u1, u2]
+        u1.following = [u3, u0]
+        u2.following = [u3, u4]
+        db.session.commit()
+
+        self.ids = [u.id for u in self.users]
+
+        self.client = app.test_client()
+
+    def test_friends_of_friends(self):
+        """Are candidates ranked by how many followed accounts follow them?"""
+
+        u0, u1, u2, u3, u4 = self.ids
+
+        recommend(db.engine, workers=2, max_entries=1)
+
+        recs = (Recommendation.query
+                .filter_by(user_id=u0)
+                .order_by(Recommendation.rank)
+                .all())
+
+        self.assertEqual([(r.candidate_id, r.score) for r in recs],
+                         [(u3, 2), (u4, 1)])
+
+    def test_rerun_replaces(self):
+        """Does a second run replace rather than add rows?"""
+
+        recommend(db.engine, workers=1)
+        first = Recommendation.query.count()
+        recommend(db.engine, workers=1)
+
+        self.assertEqual(Recommendation.query.count(), first)
+
+    def test_home_widget(self):
+        """Does the homepage suggest accounts not already followed?"""
+
+        u0, u1, u2, u3, u4 = self.ids
+
+        recommend(db.engine, workers=1)
+
+        db.session.add(Follows(user_following_id=u0,
+                               user_being_followed_id=u4))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u0
+
+            html = c.get("/").get_data(as_text=True)
+
+        self.assertIn("Who to follow", html)
+        self.assertIn("@user3", html)
+        self.assertNotIn("@user4", html)
@@ -0,0 +1,159 @@
+"""Read-replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+#
+# By default the "replica" is the test database itself; to exercise real
+# replication point TEST_REPLICA_URL at a second local Postgres instance
+# that streams from warbler-test.
+
+
+import os
+
+from sqlalchemy import event
+
+from models import db, User
+from replicas import ReplicaRouter, PRIMARY_UNTIL_KEY
+from group_commit import GroupCommitter
+
+from testing import app, CURR_USER_KEY, DBTestCase
+
+REPLICA_URL = os.environ.get('TEST_REPLICA_URL',
+                             app.config['SQLALCHEMY_DATABASE_URI'])
+
+
+class ReplicaRoutingTestCase(DBTestCase):
+    """Test which database reads and writes are sent to."""
+
+    def setUp(self):
+        """Create test client, sample user and a router with one replica."""
+
+        super().setUp()
+
+        user = User.signup(username="testuser",
+                           email="test@test.com",
+                           password="testuser",
+                           image_url=None,
+                           header_image_url=None,
+                           bio=None)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.router = ReplicaRouter([REPLICA_URL])
+        app.extensions['replica_router'] = self.router
+
+        self.replica_statements = []
+        event.listen(self.router.engines[0], 'before_cursor_execute',
+                     self.record_statement)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Remove the router so other tests use the primary only."""
+
+        super().tearDown()
+        app.extensions.pop('replica_router', None)
+
+    def record_statement(self, conn, cursor, statement, *args):
+        if 'pg_is_in_recovery' not in statement:
+            self.replica_statements.append(statement)
+
+    def test_get_reads_from_replica(self):
+        """Do read-only requests use the replica?"""
+
+        resp = self.client.get(f"/users/{self.user_id}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(self.replica_statements)
+
+    def test_one_replica_per_request(self):
+        """Do a request's reads all go to the same replica?"""
+
+        router = ReplicaRouter([REPLICA_URL, REPLICA_URL])
+        app.extensions['replica_router'] = router
+        used = set()
+
+        def record(conn, cursor, statement, *args):
+            if 'pg_is_in_recovery' not in statement:
+                used.add(conn.engine)
+
+        for engine in router.engines:
+            event.listen(engine, 'before_cursor_execute', record)
+
+        resp = self.client.get(f"/users/{self.user_id}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(used), 1)
+
+    def test_write_sticks_to_primary(self):
+        """After a write, do the user's reads stay on the primary?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.post("/messages/new", data={"text": "Hello"})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(self.replica_statements, [])
+
+            with c.session_transaction() as sess:
+                self.assertIn(PRIMARY_UNTIL_KEY, sess)
+
+            c.get(f"/users/{self.user_id}")
+            self.assertEqual(self.replica_statements, [])
+
+    def test_group_commit_sticks_to_primary(self):
+        """Is a post written by the group committer read back from the
+        primary?"""
+
+        app_committer = app.extensions['group_commit']
+        app.extensions['group_commit'] = GroupCommitter(db.engine)
+        app.config['GROUP_COMMIT'] = True
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+
+                resp = c.post("/messages/new", data={"text": "Hello"})
+                self.assertEqual(resp.status_code, 302)
+
+                with c.session_transaction() as sess:
+                    self.assertIn(PRIMARY_UNTIL_KEY, sess)
+
+                c.get(f"/users/{self.user_id}")
+                self.assertEqual(self.replica_statements, [])
+        finally:
+            app.extensions['group_commit'] = app_committer
+            app.config['GROUP_COMMIT'] = False
+
+    def test_sticky_window_expires(self):
+        """Once the sticky window has passed, are reads routed again?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[PRIMARY_UNTIL_KEY] = 0
+
+            c.get(f"/users/{self.user_id}")
+            self.assertTrue(self.replica_statements)
+
+    def test_unreachable_replica_falls_back(self):
+        """Is a replica that can't be reached skipped?"""
+
+        router = ReplicaRouter(["postgresql:///warbler-no-such-db"])
+        app.extensions['replica_router'] = router
+
+        resp = self.client.get(f"/users/{self.user_id}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIsNone(router.pick())
+
+    def test_lagging_replica_falls_back(self):
+        """Is a replica over the lag threshold skipped?"""
+
+        self.router.max_lag = -1
+
+        resp = self.client.get(f"/users/{self.user_id}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.replica_statements, [])
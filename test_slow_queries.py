@@ -0,0 +1,163 @@
+"""Slow-query log tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_slow_queries.py
+
+
+import json
+import logging
+import os
+import tempfile
+
+from sqlalchemy import event, text
+from sqlalchemy.exc import ProgrammingError
+
+from models import db, User, Message
+from slow_queries import SlowQueryLog, analyzable, make_logger
+
+from testing import app, CURR_USER_KEY, DBTestCase
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(json.loads(record.getMessage()))
+
+
+class SlowQueryLogTestCase(DBTestCase):
+    """Test what is logged about slow statements."""
+
+    def setUp(self):
+        super().setUp()
+
+        user = User(username="testuser",
+                    email="test@test.com",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        db.session.add(Message(text="hello", user_id=user.id))
+        db.session.commit()
+        self.user_id = user.id
+        db.session.remove()
+
+        self.handler = ListHandler()
+        logger = logging.getLogger('test_slow_queries')
+        logger.addHandler(self.handler)
+        logger.propagate = False
+
+        # everything is slow at 0 ms
+        self.slow_log = SlowQueryLog(logger, threshold_ms=0)
+        self.slow_log.listen(db.engine)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute',
+                     self.slow_log.before_execute)
+        event.remove(db.engine, 'after_cursor_execute',
+                     self.slow_log.after_execute)
+        event.remove(db.engine, 'handle_error', self.slow_log.failed)
+        logging.getLogger('test_slow_queries').removeHandler(self.handler)
+        super().tearDown()
+
+    def test_endpoint_and_template(self):
+        """Are lazy loads from templates traced to the template line?"""
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+        resp = client.get(f"/users/{self.user_id}/following")
+
+        self.assertEqual(resp.status_code, 200)
+        records = self.handler.records
+        self.assertTrue(records)
+        self.assertTrue(all(r['endpoint'] == 'warbler.show_following'
+                            for r in records))
+        from_template = [r for r in records if r['template']]
+        self.assertTrue(from_template)
+        self.assertRegex(from_template[0]['template'],
+                         r'^templates/.+\.html:\d+$')
+        self.assertTrue(any(line.startswith("views.py:")
+                            for r in records for line in r['stack']))
+
+    def test_parameters_redacted(self):
+        """Are only parameters' types and lengths logged by default?"""
+
+        db.session.execute(text("SELECT :email, :id"),
+                           {'email': "secret@test.com", 'id': 5})
+
+        record = self.handler.records[-1]
+        self.assertIsNone(record['endpoint'])
+        self.assertEqual(record['parameters'],
+                         {'email': "str[15]", 'id': "int"})
+
+    def test_parameters_shown(self):
+        self.slow_log.show_parameters = True
+        db.session.execute(text("SELECT :value"), {'value': "x" * 500})
+
+        record = self.handler.records[-1]
+        self.assertEqual(len(record['parameters']['value']), 203)
+
+    def test_log_directory_made_on_write(self):
+        """Is the log's directory only made when something is logged?"""
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'logs', 'slow.log')
+            logger = make_logger(path, 1024, 1)
+            self.assertFalse(os.path.exists(os.path.dirname(path)))
+
+            logger.warning("slow")
+            self.assertTrue(os.path.exists(path))
+            for handler in logger.handlers:
+                handler.close()
+
+    def test_explain(self):
+        """Are sampled SELECTs explained, leaving the transaction usable?"""
+
+        self.slow_log.explain_rate = 1.0
+        db.session.query(User).filter_by(username="testuser").all()
+
+        plan = self.handler.records[-1]['plan']
+        self.assertTrue(any("actual time" in line for line in plan))
+
+        db.session.execute(text("SELECT 1"))
+
+    def test_explain_without_analyze(self):
+        """Are locking and side-effecting SELECTs only planned, not run
+        again?"""
+
+        db.session.execute(text("CREATE TEMPORARY SEQUENCE test_explain"))
+        self.slow_log.explain_rate = 1.0
+
+        db.session.execute(text("SELECT * FROM users FOR UPDATE"))
+        plan = self.handler.records[-1]['plan']
+        self.assertTrue(plan)
+        self.assertFalse(any("actual time" in line for line in plan))
+
+        self.assertEqual(db.session.execute(
+            text("SELECT nextval('test_explain')")).scalar(), 1)
+        self.assertFalse(any("actual time" in line
+                             for line in self.handler.records[-1]['plan']))
+        self.slow_log.explain_rate = 0.0
+        self.assertEqual(db.session.execute(
+            text("SELECT nextval('test_explain')")).scalar(), 2)
+
+    def test_analyzable(self):
+        self.assertTrue(analyzable("SELECT * FROM users WHERE id = 1"))
+        self.assertTrue(analyzable("EXECUTE warbler_users_by_id(1)"))
+        self.assertFalse(analyzable("EXECUTE other_statement(1)"))
+        self.assertFalse(analyzable("SELECT * FROM likes FOR NO KEY UPDATE"))
+        self.assertFalse(analyzable("SELECT * INTO copy FROM users"))
+        self.assertFalse(analyzable("SELECT pg_try_advisory_lock(1, 2)"))
+
+    def test_failed_statement(self):
+        """Does a failing statement leave the timings in step?"""
+
+        with self.assertRaises(ProgrammingError):
+            db.session.execute(text("SELECT * FROM no_such_table"))
+        db.session.rollback()
+
+        db.session.execute(text("SELECT 1"))
+        self.assertEqual(self.handler.records[-1]['statement'], "SELECT 1")
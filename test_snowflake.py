@@ -0,0 +1,95 @@
+"""Snowflake id tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_snowflake.py
+
+
+from datetime import datetime, timedelta
+
+from models import db, User, Message
+from sqlalchemy import text
+
+from snowflake import (SnowflakeGenerator, lease_worker, make_id,
+                       make_id_sql, millis, id_time)
+
+from testing import app, DBTestCase
+
+
+class SnowflakeTestCase(DBTestCase):
+    """Test id generation and message ids and timestamps."""
+
+    def setUp(self):
+        super().setUp()
+
+        user = User(username="testuser",
+                    email="test@test.com",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+    def test_generator_increasing(self):
+        """Are ids unique and increasing, even within one millisecond?"""
+
+        generator = SnowflakeGenerator(3)
+        ids = [generator.next_id() for _ in range(10000)]
+
+        self.assertEqual(ids, sorted(set(ids)))
+
+    def test_id_time(self):
+        dt = datetime(2017, 1, 21, 11, 4, 53, 522000)
+
+        self.assertEqual(id_time(make_id(millis(dt), 5, 7)), dt)
+        self.assertGreater(make_id(millis(dt)), 0)
+
+    def test_bad_worker(self):
+        with self.assertRaises(ValueError):
+            SnowflakeGenerator(1024)
+
+    def test_leased_workers_unique(self):
+        """Does each lease get a worker id no other process holds, until
+        its connection closes?"""
+
+        leases = [lease_worker(db.engine) for _ in range(20)]
+        workers = [worker for _, worker in leases]
+        self.assertEqual(len(set(workers)), 20)
+
+        conn, worker = leases[0]
+        held = conn.execute(text(
+            "SELECT count(*) FROM pg_locks WHERE locktype = 'advisory'"
+            " AND objid = :worker AND pid = pg_backend_pid()"),
+            worker=worker).scalar()
+        self.assertEqual(held, 1)
+
+        for conn, _ in leases:
+            conn.close()
+
+    def test_message_ids_and_timestamps(self):
+        """Do new messages get increasing ids and their own timestamps?"""
+
+        first = Message(text="first", user_id=self.user_id)
+        db.session.add(first)
+        db.session.commit()
+
+        second = Message(text="second", user_id=self.user_id)
+        db.session.add(second)
+        db.session.commit()
+
+        self.assertLess(first.id, second.id)
+        self.assertLessEqual(first.timestamp, second.timestamp)
+        self.assertLess(abs(id_time(second.id) - second.timestamp),
+                        timedelta(minutes=1))
+
+        newest = Message.most_recent(Message.query, limit=2)
+        self.assertEqual([m.text for m in newest], ["second", "first"])
+
+    def test_make_id_sql(self):
+        """Does the SQL version agree with make_id?"""
+
+        ts = datetime(2021, 3, 4, 5, 6, 7, 890000)
+        made = db.session.execute(
+            text(f"SELECT {make_id_sql(':ts', ':seq')}"),
+            {'ts': ts, 'seq': 5 + (1 << 22)}).scalar()
+
+        self.assertEqual(made, make_id(millis(ts), sequence=5))
@@ -0,0 +1,153 @@
+"""Hashtag and trending tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_tags.py
+
+
+import os
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+
+from models import db, User, Message, MessageTag
+from trending import CountMinSketch, TrendingTracker
+
+from testing import app, CURR_USER_KEY, DBTestCase
+
+
+class MessageTagModelTestCase(TestCase):
+    """Test parsing tags out of message text."""
+
+    def test_extract(self):
+        """Are hashtags lowercased, mentions kept, and duplicates dropped?"""
+
+        tags = MessageTag.extract("#Flask and #flask with @Alice, not a#b")
+
+        self.assertEqual([(t.kind, t.tag) for t in tags],
+                         [('#', 'flask'), ('@', 'Alice')])
+
+
+class CountMinSketchTestCase(TestCase):
+    """Test the count-min sketch."""
+
+    def test_never_undercounts(self):
+        sketch = CountMinSketch(width=64, depth=4)
+        for i in range(500):
+            sketch.add(f"tag{i % 50}")
+
+        for i in range(50):
+            self.assertGreaterEqual(sketch.estimate(f"tag{i}"), 10)
+
+
+class TagViewTestCase(DBTestCase):
+    """Test tagging messages, tag feeds and trending."""
+
+    def setUp(self):
+        """Create test client and a logged-in user."""
+
+        super().setUp()
+
+        user = User(username="testuser",
+                    email="test@test.com",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def test_add_message_stores_tags(self):
+        """Does posting a message record its tags?"""
+
+        self.client.post("/messages/new",
+                         data={"text": "Hello #Warbler @friend"})
+
+        tags = {(t.kind, t.tag) for t in MessageTag.query.all()}
+        self.assertEqual(tags, {('#', 'warbler'), ('@', 'friend')})
+
+    def test_tag_feed_pages(self):
+        """Does the tag feed page backwards by message id?"""
+
+        for i in range(3):
+            self.client.post("/messages/new", data={"text": f"#paged {i}"})
+        self.client.post("/messages/new", data={"text": "untagged"})
+
+        with patch('views.TAG_PAGE_SIZE', 2):
+            html = self.client.get("/tags/PAGED").get_data(as_text=True)
+            self.assertIn("#paged 2", html)
+            self.assertIn("#paged 1", html)
+            self.assertNotIn("#paged 0", html)
+            self.assertNotIn("untagged", html)
+
+            oldest_shown = (Message.query
+                            .filter_by(text="#paged 1")
+                            .one()
+                            .id)
+            html = (self.client
+                    .get(f"/tags/paged?before={oldest_shown}")
+                    .get_data(as_text=True))
+            self.assertIn("#paged 0", html)
+            self.assertNotIn("#paged 1", html)
+
+    def test_delete_message_deletes_tags(self):
+        """Are a message's tags deleted with it?"""
+
+        self.client.post("/messages/new", data={"text": "#gone soon"})
+        msg_id = Message.query.one().id
+
+        self.client.post(f"/messages/{msg_id}/delete")
+
+        self.assertEqual(MessageTag.query.count(), 0)
+
+    def tracker(self, now):
+        tracker = TrendingTracker(db.engine, flush_seconds=60,
+                                  clock=lambda: now)
+        # flushed by hand
+        tracker._thread_pid = os.getpid()
+        return tracker
+
+    def test_trending(self):
+        """Are flushed counts summed over the window?"""
+
+        now = time.time()
+        tracker = self.tracker(now + 60)
+
+        for _ in range(3):
+            tracker.record(["popular"], now)
+        tracker.record(["rare"], now)
+        tracker.record(["popular"], now + 60)
+        self.assertEqual(tracker.flush(), 3)
+        self.assertEqual(tracker.flush(), 0)
+
+        self.assertEqual(tracker.top(10, now + 60),
+                         [("popular", 4), ("rare", 1)])
+
+    def test_failed_flush_kept(self):
+        """Are counts from a write that failed written by the next flush?"""
+
+        now = time.time()
+        tracker = self.tracker(now)
+        tracker.record(["retried"], now)
+
+        tracker.engine = create_engine("postgresql:///warbler-no-such-db")
+        with self.assertRaises(OperationalError):
+            tracker.flush()
+
+        tracker.engine = db.engine
+        self.assertEqual(tracker.flush(), 1)
+        self.assertEqual(tracker.top(10, now), [("retried", 1)])
+
+    def test_trending_page(self):
+        """Does posting make a tag show up on the trending page?"""
+
+        self.client.post("/messages/new", data={"text": "#hot take"})
+        app.extensions['trending'].flush()
+
+        html = self.client.get("/tags").get_data(as_text=True)
+        self.assertIn("#hot", html)
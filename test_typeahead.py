@@ -0,0 +1,155 @@
+"""Username typeahead tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_typeahead.py
+
+
+import os
+import random
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Follows
+from typeahead import PrefixIndex, UsernameCompleter
+
+from testing import app, CURR_USER_KEY, DBTestCase
+
+
+class PrefixIndexTestCase(TestCase):
+    """Test the prefix index on its own."""
+
+    def test_top_matches_brute_force(self):
+        """Is top() every match, heaviest first, then alphabetical?"""
+
+        rng = random.Random(50)
+        entries = [(i, ''.join(rng.choice("abC")
+                               for _ in range(rng.randint(1, 5))),
+                    rng.randint(0, 5))
+                   for i in range(500)]
+        index = PrefixIndex(entries)
+        skip = frozenset(range(0, 500, 7))
+
+        for prefix in ["", "a", "ab", "c", "cab", "bbbbb", "x"]:
+            expected = sorted(
+                (-weight, name.lower(), user_id)
+                for user_id, name, weight in entries
+                if name.lower().startswith(prefix) and user_id not in skip)
+            found = [(-weight, key, user_id)
+                     for weight, key, user_id, _ in index.top(prefix, skip)]
+            self.assertEqual(found, expected)
+
+    def test_empty(self):
+        self.assertEqual(list(PrefixIndex([]).top("a")), [])
+
+
+class TypeaheadViewTestCase(DBTestCase):
+    """Test completions through the endpoint, and keeping them current."""
+
+    def setUp(self):
+        super().setUp()
+
+        # one bcrypt hash for them all, which is much quicker
+        alice = User.signup("alice", "alice@test.com", "password",
+                            None, None, None)
+        names = ["alex", "Alfred", "bob", "albert"]
+        users = [User(username=name, email=f"{name}@test.com",
+                      password=alice.password) for name in names]
+        db.session.add_all(users)
+        db.session.commit()
+        self.ids = {user.username: user.id for user in [alice] + users}
+
+        # alfred has two followers, alex one
+        for follower, followed in [("bob", "Alfred"), ("alice", "Alfred"),
+                                   ("bob", "alex")]:
+            db.session.add(Follows(
+                user_following_id=self.ids[follower],
+                user_being_followed_id=self.ids[followed]))
+        db.session.commit()
+
+        self.saved = app.extensions['typeahead']
+        self.completer = UsernameCompleter(db.engine)
+        # rebuilt by hand
+        self.completer._thread_pid = os.getpid()
+        app.extensions['typeahead'] = self.completer
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.extensions['typeahead'] = self.saved
+        super().tearDown()
+
+    def complete(self, prefix):
+        resp = self.client.get("/users/complete", query_string={"q": prefix})
+        self.assertEqual(resp.status_code, 200)
+        return [user['username'] for user in resp.get_json()['users']]
+
+    def test_complete(self):
+        """Are matches most followed first, case-insensitively, both from
+        the database before the first build and from the index after?"""
+
+        for built in [False, True]:
+            if built:
+                self.completer.rebuild()
+            self.assertEqual(self.complete("AL"),
+                             ["Alfred", "alex", "albert", "alice"])
+            self.assertEqual(self.complete("@ali"), ["alice"])
+            self.assertEqual(self.complete("z"), [])
+            self.assertEqual(self.complete("a%"), [])
+            self.assertEqual(self.complete(""), [])
+
+        resp = self.client.get("/users/complete?q=bob")
+        self.assertEqual(resp.get_json(), {"users": [{
+            "id": self.ids["bob"], "username": "bob",
+            "url": f"/users/{self.ids['bob']}"}]})
+
+    def test_changes_before_rebuild(self):
+        """Do signups, renames and deletes show before the next rebuild?"""
+
+        self.completer.rebuild()
+
+        self.client.post("/signup", data={
+            "username": "alvin", "email": "alvin@test.com",
+            "password": "password"})
+        self.assertEqual(self.complete("alv"), ["alvin"])
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.ids["Alfred"]
+        resp = self.client.post("/users/profile", data={
+            "username": "fred", "email": "alfred@test.com",
+            "password": "password"})
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.complete("alf"), [])
+        self.assertEqual(self.complete("al"),
+                         ["alex", "albert", "alice", "alvin"])
+        # keeping its followers, so ahead of a new name
+        app.extensions['typeahead'].add(0, "fran")
+        self.assertEqual(self.complete("f"), ["fred", "fran"])
+        app.extensions['typeahead'].remove(0)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.ids["alex"]
+        self.client.post("/users/delete")
+        self.assertEqual(self.complete("al"), ["albert", "alice", "alvin"])
+
+        self.completer.rebuild()
+        self.assertEqual(self.complete("al"), ["albert", "alice", "alvin"])
+        self.assertEqual(self.complete("fr"), ["fred"])
+
+    def test_changes_during_rebuild(self):
+        """Are changes made while a rebuild reads users kept past it?"""
+
+        self.completer.rebuild()
+
+        def change(*args):
+            self.completer.add(0, "alvin")
+            self.completer.remove(self.ids["alice"])
+
+        event.listen(db.engine, 'before_cursor_execute', change)
+        try:
+            self.completer.rebuild()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', change)
+
+        self.assertEqual(self.complete("al"),
+                         ["Alfred", "alex", "albert", "alvin"])
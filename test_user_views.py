@@ -2,67 +2,26 @@
 
 # run these tests like:
 #
-#    FLASK_ENV=production python -m unittest test_user_views.py
+#    python -m unittest test_user_views.py
 
 
-import os
-from unittest import TestCase
-
-from models import db, connect_db, Message, User, Follows, Likes
+from models import db, Message, User, Follows, Likes
 from datetime import datetime
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-
-# Now we can import app
-
-from app import app, CURR_USER_KEY
+from testing import app, CURR_USER_KEY, DBTestCase
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
 
-db.create_all()
-
-# Don't have WTForms use CSRF at all, since it's a pain to test
-
-app.config['WTF_CSRF_ENABLED'] = False
-
-
-class UserViewTestCase(TestCase):
+class UserViewTestCase(DBTestCase):
     """Test views for users."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
+        super().setUp()
+
         self.client = app.test_client()
 
         #Seed initial users
-        all_messages = Message.query.all()
-        for test_message in all_messages:
-            db.session.delete(test_message)
-        db.session.commit()
-
-        all_follows = Follows.query.all()
-        for test_follow in all_follows:
-            db.session.delete(test_follow)
-        db.session.commit()
-
-        all_likes = Likes.query.all()
-        for test_like in all_likes:
-            db.session.delete(test_like)
-        db.session.commit()
-
-        all_users = User.query.all()
-        for test_user in all_users:
-            db.session.delete(test_user)
-        db.session.commit()
-
         testuser1 = User.signup(username="testuser1",
                                     email="test@test.com",
                                     password="testuser",
@@ -100,10 +59,6 @@ class UserViewTestCase(TestCase):
             db.session.add(msg)
         db.session.commit()
 
-    def tearDown(self):
-        """Tear down"""
-        db.session.rollback()
-
     def test_list_users(self):
         """ Are users listed """
         with self.client as c:
@@ -280,7 +235,8 @@ class UserViewTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Access unauthorized",html)
-            self.assertNotIn(message3.text,html)
+            # the anonymous homepage shows recent messages, but not as likes
+            self.assertNotIn('id="sidebar-username"',html)
 
     def test_follow(self):
         """Can a user follow another user"""
@@ -0,0 +1,41 @@
+"""Shared setup for the tests.
+
+Importing this builds an app from config.TestConfig, against the test
+database (TEST_DATABASE_URL, else postgresql:///warbler-test), and creates
+any missing tables:
+
+    from testing import app, CURR_USER_KEY, DBTestCase
+
+Test cases that use the database subclass DBTestCase, which empties every
+table before each test.
+"""
+
+from unittest import TestCase
+
+from app import create_app
+from config import TestConfig
+from models import db
+from views import CURR_USER_KEY
+
+app = create_app(TestConfig)
+
+db.create_all()
+
+
+def clear_tables():
+    """Delete every row from every table, children before parents."""
+
+    db.session.rollback()
+    for table in reversed(db.metadata.sorted_tables):
+        db.session.execute(table.delete())
+    db.session.commit()
+
+
+class DBTestCase(TestCase):
+    """A test case that starts from empty tables."""
+
+    def setUp(self):
+        clear_tables()
+
+    def tearDown(self):
+        db.session.rollback()
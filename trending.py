@@ -0,0 +1,180 @@
+"""Trending hashtags over a sliding time window.
+
+Each worker counts hashtag uses in memory, in fixed time buckets. A bucket
+holds a count-min sketch (constant memory however many distinct tags are
+used) plus its heaviest tags. Every few seconds a background thread (see
+buffered.py) writes the growth of those heavy hitters to tag_counts in one
+upsert; trending lookups sum tag_counts over the window, so every worker
+sees the same list and nothing ever scans messages. Growth is only marked
+written once the upsert commits, so a failed write is retried.
+"""
+
+import hashlib
+import time
+from array import array
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy.dialects.postgresql import insert
+
+from buffered import BufferedWriter
+from models import db, TagCount
+
+
+class CountMinSketch:
+    """Approximate counts of strings in `depth` x `width` counters.
+
+    Estimates never undercount; they overcount by a small fraction of the
+    total with high probability.
+    """
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('L', [0]) * width for _ in range(depth)]
+
+    def _indexes(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'),
+                                 digest_size=8 * self.depth).digest()
+        return [int.from_bytes(digest[8 * i:8 * i + 8], 'little') % self.width
+                for i in range(self.depth)]
+
+    def add(self, item, count=1):
+        """Count `item` and return its new estimate."""
+
+        estimate = None
+        for row, i in zip(self.rows, self._indexes(item)):
+            row[i] += count
+            if estimate is None or row[i] < estimate:
+                estimate = row[i]
+        return estimate
+
+    def estimate(self, item):
+        return min(row[i] for row, i in zip(self.rows, self._indexes(item)))
+
+
+class _Bucket:
+    """Counts for one time bucket."""
+
+    __slots__ = ('sketch', 'heavy', 'flushed')
+
+    def __init__(self):
+        self.sketch = CountMinSketch()
+        self.heavy = {}
+        self.flushed = {}
+
+
+class TrendingTracker(BufferedWriter):
+    """Count hashtags per time bucket and report the top ones."""
+
+    def __init__(self, engine, bucket_seconds=60, window_seconds=3600,
+                 top_k=50, flush_seconds=5, retention_seconds=86400,
+                 clock=time.time):
+        super().__init__(engine, flush_seconds)
+        self.bucket_seconds = bucket_seconds
+        self.window_seconds = window_seconds
+        self.top_k = top_k
+        self.retention_seconds = retention_seconds
+        self.clock = clock
+        self._buckets = {}
+        self._cache = {}
+
+    def bucket_start(self, now):
+        return int(now // self.bucket_seconds * self.bucket_seconds)
+
+    def record(self, tags, now=None):
+        """Count one use of each hashtag in `tags`."""
+
+        now = self.clock() if now is None else now
+
+        with self._lock:
+            bucket = self._buckets.setdefault(self.bucket_start(now),
+                                              _Bucket())
+            for tag in tags:
+                bucket.heavy[tag] = bucket.sketch.add(tag)
+
+            if len(bucket.heavy) > 2 * self.top_k:
+                keep = sorted(bucket.heavy.items(),
+                              key=lambda item: item[1],
+                              reverse=True)[:self.top_k]
+                bucket.heavy = dict(keep)
+
+        self._start_flusher()
+
+    def _take(self):
+        # [(bucket start, tag, estimate, growth since last written)]
+        return [(start, tag, estimate, estimate - bucket.flushed.get(tag, 0))
+                for start, bucket in self._buckets.items()
+                for tag, estimate in bucket.heavy.items()
+                if estimate > bucket.flushed.get(tag, 0)]
+
+    def _write(self, conn, pending):
+        stmt = insert(TagCount.__table__).values([
+            {'tag': tag,
+             'bucket': datetime.utcfromtimestamp(start),
+             'count': delta}
+            for start, tag, _, delta in pending])
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=['tag', 'bucket'],
+            set_={'count': TagCount.count + stmt.excluded.count}))
+        conn.execute(TagCount.__table__.delete().where(
+            TagCount.bucket < datetime.utcfromtimestamp(
+                self.clock() - self.retention_seconds)))
+        return len(pending)
+
+    def _restore(self, pending):
+        # nothing was marked written, so the next flush writes it again
+        pass
+
+    def _written(self, pending):
+        for start, tag, estimate, _ in pending:
+            bucket = self._buckets.get(start)
+            if bucket is not None:
+                bucket.flushed[tag] = max(bucket.flushed.get(tag, 0),
+                                          estimate)
+
+        oldest = self.bucket_start(self.clock() - self.window_seconds)
+        for start in [s for s in self._buckets if s < oldest]:
+            del self._buckets[start]
+
+    def top(self, limit=10, now=None):
+        """Return [(tag, count), ...] for the window, most used first.
+
+        Results are cached for `flush_seconds`, as they can't change faster.
+        """
+
+        now = self.clock() if now is None else now
+        cached = self._cache.get(limit)
+        if cached and now - cached[0] < self.flush_seconds:
+            return cached[1]
+
+        since = datetime.utcfromtimestamp(
+            self.bucket_start(now - self.window_seconds))
+        total = db.func.sum(TagCount.count)
+        result = (db.session
+                  .query(TagCount.tag, total)
+                  .filter(TagCount.bucket >= since)
+                  .group_by(TagCount.tag)
+                  .order_by(total.desc(), TagCount.tag)
+                  .limit(limit)
+                  .all())
+
+        self._cache[limit] = (now, result)
+        return result
+
+
+def init_trending(app):
+    """Attach a trending tracker to `app`."""
+
+    app.config.setdefault('TRENDING_WINDOW_SECONDS', 3600)
+    app.config.setdefault('TRENDING_FLUSH_SECONDS', 5)
+    app.extensions['trending'] = TrendingTracker(
+        db.get_engine(app),
+        window_seconds=app.config['TRENDING_WINDOW_SECONDS'],
+        flush_seconds=app.config['TRENDING_FLUSH_SECONDS'])
+
+
+def get_trending():
+    """Return the current app's trending tracker."""
+
+    return current_app.extensions['trending']
@@ -0,0 +1,265 @@
+"""Username completion for the navbar search box.
+
+Each worker keeps every username, lowercased, in one sorted array, so
+the names starting with a prefix are the contiguous range bisect finds.
+Alongside it is a max-tree of popularity (follower count) over the
+array. The most popular names in a range are found best-first: the
+range splits into O(log n) subtrees, and a heap keyed on each subtree's
+best weight expands only the subtrees that can still hold a top-k name.
+Ten completions take about 10 log n steps however common the prefix,
+e.g. "a" among a million names.
+
+A background thread in each worker rebuilds the arrays from the database
+every TYPEAHEAD_REBUILD_SECONDS, which also refreshes the weights, so no
+request waits on the scan of users; until the first build finishes,
+completions come from the database. In between, this worker's signups and
+renames go into a small overlay and deletes into tombstones, merged into
+every answer; ones made while a rebuild is reading users are kept past it.
+Other workers' changes show after the next rebuild.
+"""
+
+import heapq
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from flask import current_app
+from sqlalchemy import text
+
+from models import db
+
+POPULARITY_SQL = text("""
+    SELECT u.id, u.username, count(f.user_following_id)
+    FROM users AS u
+    LEFT JOIN follows AS f ON f.user_being_followed_id = u.id
+    GROUP BY u.id
+""")
+
+# the most followed names starting with a prefix, before the first build
+PREFIX_SQL = text("""
+    SELECT u.id, u.username
+    FROM users AS u
+    LEFT JOIN follows AS f ON f.user_being_followed_id = u.id
+    WHERE lower(u.username) LIKE :pattern
+    GROUP BY u.id
+    ORDER BY count(f.user_following_id) DESC, lower(u.username), u.id
+    LIMIT :limit
+""")
+
+
+class PrefixIndex:
+    """Sorted (key, id, name, weight) entries with top-k prefix lookups."""
+
+    def __init__(self, entries):
+        """`entries` are (user id, username, weight) triples."""
+
+        entries = sorted((name.lower(), user_id, name, weight)
+                         for user_id, name, weight in entries)
+        self.keys = [key for key, _, _, _ in entries]
+        self.names = [name for _, _, name, _ in entries]
+        self.ids = array('q', (user_id for _, user_id, _, _ in entries))
+
+        # tree[size + i] is entry i's weight; tree[n] is the larger of
+        # tree[2n] and tree[2n + 1]; -1 pads past the last entry
+        size = 1
+        while size < len(entries):
+            size *= 2
+        tree = array('q', [-1]) * (2 * size)
+        for i, (_, _, _, weight) in enumerate(entries):
+            tree[size + i] = weight
+        for node in range(size - 1, 0, -1):
+            tree[node] = max(tree[2 * node], tree[2 * node + 1])
+        self.size = size
+        self.tree = tree
+
+    def __len__(self):
+        return len(self.keys)
+
+    def prefix_range(self, prefix):
+        """Return [start, end) of the keys starting with `prefix`."""
+
+        start = bisect_left(self.keys, prefix)
+        # U+10FFFF sorts after any character that can follow the prefix
+        end = bisect_left(self.keys, prefix + '\U0010ffff', start)
+        return start, end
+
+    def top(self, prefix, skip=frozenset()):
+        """Yield (weight, key, id, name) for keys starting with `prefix`,
+        heaviest first, ties alphabetically; ids in `skip` are left out."""
+
+        start, end = self.prefix_range(prefix)
+        tree, size = self.tree, self.size
+
+        # the subtrees exactly covering [start, end)
+        heap = []
+        lo, hi = start + size, end + size
+        while lo < hi:
+            if lo & 1:
+                heap.append((-tree[lo], lo))
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                heap.append((-tree[hi], hi))
+            lo //= 2
+            hi //= 2
+        heapq.heapify(heap)
+
+        while heap:
+            weight, node = heapq.heappop(heap)
+            if node >= size:
+                i = node - size
+                if self.ids[i] not in skip:
+                    yield -weight, self.keys[i], self.ids[i], self.names[i]
+            else:
+                heapq.heappush(heap, (-tree[2 * node], 2 * node))
+                heapq.heappush(heap, (-tree[2 * node + 1], 2 * node + 1))
+
+
+class UsernameCompleter:
+    """Complete username prefixes, most followed first."""
+
+    def __init__(self, engine, rebuild_seconds=600, logger=None):
+        self.engine = engine
+        self.rebuild_seconds = rebuild_seconds
+        self.logger = logger
+        self._index = None
+        # changes since the build: id -> (key, name, weight), and ids
+        # whose entry in the index is out of date
+        self._overlay = {}
+        self._tombstones = set()
+        # ids changed while a rebuild is reading users, or None
+        self._changed_during_rebuild = None
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._thread_pid = None
+
+    def rebuild(self):
+        """Reload every username and follower count."""
+
+        with self._rebuild_lock:
+            with self._lock:
+                self._changed_during_rebuild = set()
+
+            with self.engine.connect() as conn:
+                index = PrefixIndex(conn.execute(POPULARITY_SQL))
+
+            with self._lock:
+                # the new index may or may not have these changes; keep
+                # their tombstones and overlay entries, which win either way
+                changed = self._changed_during_rebuild
+                self._overlay = {user_id: entry for user_id, entry
+                                 in self._overlay.items() if user_id in changed}
+                self._tombstones &= changed
+                self._changed_during_rebuild = None
+                self._index = index
+
+    @property
+    def index(self):
+        """The prefix index, or None until it's first built."""
+
+        self._start_rebuilder()
+        return self._index
+
+    def _weight(self, user_id, username):
+        """Return the weight of `user_id`, last called `username`, or 0 if
+        it's new."""
+
+        if user_id in self._overlay:
+            return self._overlay[user_id][2]
+        if username is None or self._index is None:
+            return 0
+        index, key = self._index, username.lower()
+        i = bisect_left(index.keys, key)
+        while i < len(index) and index.keys[i] == key:
+            if index.ids[i] == user_id:
+                return index.tree[index.size + i]
+            i += 1
+        return 0
+
+    def add(self, user_id, username, old_username=None):
+        """Record a signup, or a rename from `old_username`."""
+
+        with self._lock:
+            weight = self._weight(user_id, old_username)
+            # hides the old name, if it's in the index
+            self._tombstones.add(user_id)
+            self._overlay[user_id] = (username.lower(), username, weight)
+            if self._changed_during_rebuild is not None:
+                self._changed_during_rebuild.add(user_id)
+
+    def remove(self, user_id):
+        """Record a deleted user."""
+
+        with self._lock:
+            self._overlay.pop(user_id, None)
+            self._tombstones.add(user_id)
+            if self._changed_during_rebuild is not None:
+                self._changed_during_rebuild.add(user_id)
+
+    def complete(self, prefix, limit=10):
+        """Return up to `limit` (user id, username) starting with `prefix`,
+        case-insensitively, most followed first."""
+
+        prefix = prefix.lower()
+        if not prefix:
+            return []
+
+        index = self.index
+        if index is None:
+            pattern = (prefix.replace('\\', '\\\\').replace('%', '\\%')
+                       .replace('_', '\\_')) + '%'
+            rows = db.session.execute(
+                PREFIX_SQL, {'pattern': pattern, 'limit': limit})
+            return [(user_id, name) for user_id, name in rows]
+
+        with self._lock:
+            skip = frozenset(self._tombstones)
+            extra = [(weight, key, user_id, name)
+                     for user_id, (key, name, weight) in self._overlay.items()
+                     if key.startswith(prefix)]
+
+        found = []
+        for entry in index.top(prefix, skip):
+            found.append(entry)
+            if len(found) == limit:
+                break
+
+        best = sorted(found + extra, key=lambda e: (-e[0], e[1]))[:limit]
+        return [(user_id, name) for _, _, user_id, name in best]
+
+    def _start_rebuilder(self):
+        # one thread per process; a forked worker needs its own
+        if self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.rebuild()
+            except Exception:
+                if self.logger:
+                    self.logger.exception("couldn't rebuild the typeahead index")
+            time.sleep(self.rebuild_seconds)
+
+
+def init_typeahead(app):
+    """Attach a username completer to `app`."""
+
+    app.config.setdefault('TYPEAHEAD_REBUILD_SECONDS', 600)
+    app.extensions['typeahead'] = UsernameCompleter(
+        db.get_engine(app),
+        rebuild_seconds=app.config['TYPEAHEAD_REBUILD_SECONDS'],
+        logger=app.logger)
+
+
+def get_typeahead():
+    """Return the current app's username completer."""
+
+    return current_app.extensions['typeahead']
@@ -0,0 +1,766 @@
+"""Routes for Warbler."""
+
+import json
+import time
+from functools import wraps
+
+from flask import (Blueprint, render_template, request, flash, redirect,
+                   session, g, jsonify, current_app, Response, abort,
+                   send_file, url_for)
+from sqlalchemy.exc import IntegrityError
+
+from forms import UserAddForm, LoginForm, UserEditForm, MessageForm
+from models import db, User, Message, MessageTag
+from archive import get_archive
+from availability import get_availability
+from trending import get_trending
+from follow_graph import get_follow_graph
+from images import get_images, InvalidImage
+from like_counts import get_like_counts
+from entity_cache import get_entity_cache
+from live import get_live
+from export import export_file, export_size, get_export
+from explore import get_explore
+from notifications import get_notifications, inbox_page, mark_read
+from group_commit import get_group_commit
+import projections
+from nearby import get_geocoder, get_nearby
+from typeahead import get_typeahead
+
+CURR_USER_KEY = "curr_user"
+
+TAG_PAGE_SIZE = 50
+
+LIVE_PAGE_SIZE = 100
+
+EXPLORE_PREVIEW = 20
+
+COMPLETIONS = 10
+
+NEARBY_DEFAULT = 12
+NEARBY_MAX = 50
+
+NOTIFICATION_PAGE_SIZE = 20
+
+bp = Blueprint('warbler', __name__)
+
+
+@bp.before_app_request
+def add_user_to_g():
+    """If we're logged in, add curr user to Flask global."""
+
+    if CURR_USER_KEY in session:
+        g.user = get_entity_cache().get(User, session[CURR_USER_KEY])
+
+    else:
+        g.user = None
+
+
+def do_login(user):
+    """Log in user."""
+
+    session[CURR_USER_KEY] = user.id
+
+
+def do_logout():
+    """Logout user."""
+
+    if CURR_USER_KEY in session:
+        del session[CURR_USER_KEY]
+
+
+def redirect_if_missing(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not g.user:
+            flash("Access unauthorized.", "danger")
+            return redirect("/")
+        return func(*args,**kwargs)
+    return wrapper
+
+
+def feed_author_ids(user):
+    """Return the ids whose messages are in `user`'s home feed."""
+
+    return [f.id for f in user.following] + [user.id]
+
+
+def check_availability(form):
+    """Add errors to `form` for a taken username or email.
+
+    Returns True if both are free.
+    """
+
+    checker = get_availability()
+    available = True
+
+    if checker.username_taken(form.username.data):
+        form.username.errors.append("Username already taken")
+        available = False
+
+    if checker.email_taken(form.email.data):
+        form.email.errors.append("Email already registered")
+        available = False
+
+    return available
+
+
+def store_uploads(form):
+    """Store images uploaded with `form`, pointing its URL fields at them.
+
+    Returns False, with errors on the form, if an upload isn't usable.
+    """
+
+    images = get_images()
+    stored = True
+
+    for upload, url_field, kind in (
+            (form.image_file, form.image_url, 'avatar'),
+            (form.header_image_file, form.header_image_url, 'header')):
+        if upload.data:
+            try:
+                url_field.data = images.save(kind, upload.data.read())
+            except InvalidImage as exc:
+                upload.errors.append(str(exc))
+                stored = False
+
+    return stored
+
+
+@bp.route('/signup', methods=["GET", "POST"])
+def signup():
+    """Handle user signup.
+
+    Create new user and add to DB. Redirect to home page.
+
+    If form not valid, present form.
+
+    If the there already is a user with that username or email: show
+    the error on the form (checked before paying for password hashing)
+    and re-present form.
+    """
+
+    form = UserAddForm()
+
+    if (form.validate_on_submit() and check_availability(form)
+            and store_uploads(form)):
+        try:
+            user = User.signup(
+                username=form.username.data,
+                password=form.password.data,
+                email=form.email.data,
+                image_url=form.image_url.data or User.image_url.default.arg,
+                header_image_url=form.header_image_url.data or User.header_image_url.default.arg,
+                bio=form.bio.data or User.bio.default.arg,
+            )
+            db.session.commit()
+
+        except IntegrityError:
+            # taken through another worker since our filter was built
+            db.session.rollback()
+            check_availability(form)
+            flash("Username or email already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+
+        get_availability().add(user.username, user.email)
+        get_typeahead().add(user.id, user.username)
+        do_login(user)
+
+        return redirect("/")
+
+    else:
+        return render_template('users/signup.html', form=form)
+
+
+@bp.route('/users/available')
+def users_available():
+    """Report whether the `username` and/or `email` params are free.
+
+    Returns JSON like {"username": true, "email": false}, for live
+    validation of the signup form.
+    """
+
+    checker = get_availability()
+    result = {}
+
+    if 'username' in request.args:
+        result['username'] = not checker.username_taken(
+            request.args['username'])
+    if 'email' in request.args:
+        result['email'] = not checker.email_taken(request.args['email'])
+
+    return jsonify(result)
+
+
+@bp.route('/users/complete')
+def users_complete():
+    """Return usernames starting with the `q` param, most followed first.
+
+    Like {"users": [{"id": 1, "username": "alice", "url": "/users/1"}]},
+    for the search box.
+    """
+
+    prefix = request.args.get('q', '').strip().lstrip('@')
+    return jsonify(users=[
+        {'id': user_id, 'username': username,
+         'url': url_for('.users_show', user_id=user_id)}
+        for user_id, username in get_typeahead().complete(prefix,
+                                                          COMPLETIONS)])
+
+
+@bp.route('/login', methods=["GET", "POST"])
+def login():
+    """Handle user login."""
+
+    form = LoginForm()
+
+    if form.validate_on_submit():
+        user = User.authenticate(form.username.data,
+                                 form.password.data)
+
+        if user:
+            do_login(user)
+            flash(f"Hello, {user.username}!", "success")
+            return redirect("/")
+
+        flash("Invalid credentials.", 'danger')
+
+    return render_template('users/login.html', form=form)
+
+
+@bp.route('/logout')
+def logout():
+    """Handle logout of user."""
+
+    do_logout()
+    flash("You have successfully logged out")
+    return redirect('/login')
+
+
+##############################################################################
+# General user routes:
+
+@bp.route('/users')
+def list_users():
+    """Page with listing of users.
+
+    Can take a 'q' param in querystring to search by that username.
+    """
+
+    search = request.args.get('q')
+
+    if not search:
+        users = User.query.all()
+    else:
+        users = User.query.filter(User.username.like(f"%{search}%")).all()
+
+    return render_template('users/index.html', users=users)
+
+
+@bp.route('/users/<int:user_id>')
+def users_show(user_id):
+    """Show user profile."""
+
+    user = get_entity_cache().get_or_404(User, user_id)
+
+    # snagging messages in order from the database;
+    # user.messages won't be in order by default
+    messages = projections.user_timeline(user_id)
+
+    # older history may have moved to the archive
+    if len(messages) < 100:
+        messages += get_archive().user_messages(
+            user_id, 100 - len(messages),
+            before=messages[-1].timestamp if messages else None)
+
+    # "followed by people you follow" and "follows you", from the snapshot
+    mutual_followers = []
+    mutual_count = 0
+    follows_you = False
+    if g.user and g.user.id != user_id:
+        graph = get_follow_graph()
+        mutual_ids = graph.followed_by_followed(g.user.id, user_id)
+        mutual_count = len(mutual_ids)
+        mutual_followers = User.query.filter(
+            User.id.in_(mutual_ids[:3].tolist())).all()
+        follows_you = graph.is_following(user_id, g.user.id)
+
+    liked_ids = (projections.liked_ids(g.user.id, messages)
+                 if g.user else set())
+
+    return render_template('users/show.html', user=user, messages=messages,
+                           liked_ids=liked_ids,
+                           mutual_followers=mutual_followers,
+                           mutual_count=mutual_count, follows_you=follows_you)
+
+@bp.route('/users/nearby')
+@redirect_if_missing
+def users_nearby():
+    """Show the users nearest the current user's location, nearest first.
+
+    How many is the `k` param, up to NEARBY_MAX.
+    """
+
+    k = max(1, min(request.args.get('k', NEARBY_DEFAULT, type=int),
+                   NEARBY_MAX))
+
+    # read fresh: the position is filled in after the profile is saved
+    latitude, longitude = (db.session.query(User.latitude, User.longitude)
+                           .filter(User.id == g.user.id).first())
+    nearest = []
+    if latitude is not None:
+        nearest = get_nearby().nearest(latitude, longitude, k,
+                                       exclude_id=g.user.id)
+
+    users = {u.id: u for u in
+             User.query.filter(User.id.in_([id for id, _ in nearest]))}
+    nearby = [(users[id], km) for id, km in nearest if id in users]
+
+    return render_template('users/nearby.html', nearby=nearby,
+                           located=latitude is not None)
+
+
+@bp.route('/users/<int:user_id>/following')
+@redirect_if_missing
+def show_following(user_id):
+    """Show list of people this user is following."""
+
+    user = get_entity_cache().get_or_404(User, user_id)
+    return render_template('users/following.html', user=user)
+
+
+@bp.route('/users/<int:user_id>/followers')
+@redirect_if_missing
+def users_followers(user_id):
+    """Show list of followers of this user."""
+
+    user = get_entity_cache().get_or_404(User, user_id)
+    return render_template('users/followers.html', user=user)
+
+@bp.route('/users/<int:user_id>/likes')
+@redirect_if_missing
+def users_likes(user_id):
+    """Show list of liked messages for this user."""
+
+    user = get_entity_cache().get_or_404(User, user_id)
+    messages = projections.liked_messages(user_id)
+    liked_ids = (set(msg.id for msg in messages) if g.user.id == user_id
+                 else projections.liked_ids(g.user.id, messages))
+
+    return render_template('users/likes.html', user=user, messages=messages,
+                           liked_ids=liked_ids)
+
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
+@redirect_if_missing
+def add_follow(follow_id):
+    """Add a follow for the currently-logged-in user."""
+
+    followed_user = get_entity_cache().get_or_404(User, follow_id)
+    g.user.following.append(followed_user)
+    db.session.commit()
+    get_follow_graph().follow(g.user.id, follow_id)
+    get_notifications().add(follow_id, 'follow', g.user.id)
+
+    return redirect(f"/users/{g.user.id}/following")
+
+
+@bp.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@redirect_if_missing
+def stop_following(follow_id):
+    """Have currently-logged-in-user stop following this user."""
+
+    followed_user = get_entity_cache().get(User, follow_id)
+    g.user.following.remove(followed_user)
+    db.session.commit()
+    get_follow_graph().unfollow(g.user.id, follow_id)
+
+    return redirect(f"/users/{g.user.id}/following")
+
+@bp.route('/users/toggle_like/<int:like_id>', methods=['POST'])
+@redirect_if_missing
+def add_like(like_id):
+    """Toggle like for the currently-logged-in user."""
+    liked_message = get_entity_cache().get(Message, like_id)
+    liked = liked_message not in g.user.likes
+    if liked:
+        g.user.likes.append(liked_message)
+    else:
+        g.user.likes.remove(liked_message)
+    db.session.commit()
+    get_like_counts().add(like_id)
+    if liked:
+        get_notifications().add(liked_message.user_id, 'like', g.user.id,
+                                like_id)
+    if request.referrer:
+        return redirect(f"{request.referrer}")
+    return redirect('/')
+
+@bp.route('/users/profile', methods=["GET", "POST"])
+@redirect_if_missing
+def profile():
+    """Update profile for current user."""
+    form = UserEditForm(obj=g.user)
+    if form.validate_on_submit():
+        user = User.authenticate(g.user.username,
+                                 form.password.data)
+        if user:
+            if not store_uploads(form):
+                return render_template('users/edit.html', form=form)
+            old_username = user.username
+            user.username = form.username.data
+            user.email = form.email.data
+            user.image_url = form.image_url.data
+            user.header_image_url = form.header_image_url.data
+            user.bio = form.bio.data
+            moved = user.location != form.location.data
+            user.location = form.location.data
+            db.session.add(user)
+            db.session.commit()
+            get_availability().add(user.username, user.email)
+            get_explore().update_author(user)
+            if user.username != old_username:
+                get_typeahead().add(user.id, user.username, old_username)
+            if moved:
+                get_geocoder().geocode_later(user.id, user.location)
+            return redirect(f"/users/{user.id}")
+        flash('Incorrect password.', "danger")
+        return redirect('/users/profile')
+    return render_template('users/edit.html',form=form)
+
+
+@bp.route('/users/export')
+@redirect_if_missing
+def export_data():
+    """Send a zip of everything of the current user's."""
+
+    exports = get_export()
+    user_id = g.user.id
+    filename = f"warbler-{g.user.username}.zip"
+
+    if (export_size(db.session, user_id)
+            > current_app.config['EXPORT_STREAM_MAX_ROWS']):
+        # too big to build while the request waits
+        return redirect(f"/users/export/{exports.start(user_id)}")
+
+    # the export reads on its own connection
+    db.session.remove()
+
+    return send_file(export_file(exports.engine, exports.archive, user_id),
+                     mimetype='application/zip', as_attachment=True,
+                     attachment_filename=filename)
+
+
+@bp.route('/users/export', methods=["POST"])
+@redirect_if_missing
+def export_data_later():
+    """Build the current user's export in the background."""
+
+    token = get_export().start(g.user.id)
+    return redirect(f"/users/export/{token}")
+
+
+@bp.route('/users/export/<token>')
+@redirect_if_missing
+def export_download(token):
+    """Download a background export, or say it isn't ready yet."""
+
+    state, path = get_export().status(g.user.id, token)
+    if state == 'missing':
+        abort(404)
+    if state == 'failed':
+        return render_template('users/export.html', failed=True), 500
+    if state == 'pending':
+        return render_template('users/export.html'), 202, {'Refresh': '5'}
+
+    return send_file(path, mimetype='application/zip', as_attachment=True,
+                     attachment_filename=f"warbler-{g.user.username}.zip")
+
+
+@bp.route('/images/<kind>/<digest>/<size>.jpg')
+def image_thumbnail(kind, digest, size):
+    """Serve an uploaded image's thumbnail; it never changes."""
+
+    return get_images().send(kind, digest, size)
+
+
+@bp.route('/users/delete', methods=["POST"])
+@redirect_if_missing
+def delete_user():
+    """Delete user."""
+
+    do_logout()
+
+    user_id = g.user.id
+    db.session.delete(g.user)
+    db.session.commit()
+    get_explore().delete_author(user_id)
+    get_typeahead().remove(user_id)
+
+    return redirect("/signup")
+
+
+@bp.route('/notifications')
+@redirect_if_missing
+def notifications():
+    """Show the current user's notifications, newest first.
+
+    Pages are keyed by the `before` param, the last seq of the page before.
+    Unread ones are highlighted until marked read, by a POST to
+    /notifications/read.
+    """
+
+    before = request.args.get('before', type=int)
+    rows, next_before = inbox_page(g.user.id, before, NOTIFICATION_PAGE_SIZE)
+
+    actor_ids = {actor_id for n in rows for actor_id in n.actor_ids[:2]}
+    target_ids = [n.target_id for n in rows if n.kind == 'like']
+    actors = {u.id: u for u in User.query.filter(User.id.in_(actor_ids))}
+    targets = {m.id: m for m in Message.query.filter(Message.id.in_(target_ids))}
+
+    # the two newest actors are named, the rest counted
+    notifications = [
+        (n, [actors[actor_id] for actor_id in n.actor_ids[:2]
+             if actor_id in actors])
+        for n in rows]
+
+    # unread rows were written last, so they're all on the first page
+    unread = before is None and any(n.unread for n in rows)
+
+    return render_template('notifications.html',
+                           notifications=notifications, targets=targets,
+                           next_before=next_before,
+                           read_up_to=rows[0].seq if unread else None)
+
+
+@bp.route('/notifications/read', methods=['POST'])
+@redirect_if_missing
+def notifications_read():
+    """Mark the current user's notifications read, up to the `seq` form
+    field: the newest they were shown."""
+
+    mark_read(g.user.id, request.form.get('seq', type=int))
+    return redirect(url_for('.notifications'))
+
+
+##############################################################################
+# Messages routes:
+
+@bp.route('/messages/new', methods=["GET", "POST"])
+@redirect_if_missing
+def messages_add():
+    """Add a message:
+
+    Show form if GET. If valid, update message and redirect to user page.
+    """
+
+    form = MessageForm()
+
+    if form.validate_on_submit():
+        committer = get_group_commit()
+        if committer:
+            # shares its commit with other posts; returns once durable
+            try:
+                msg = committer.post(g.user, form.text.data)
+            except TimeoutError:
+                # it may yet commit, and posting again would add it twice
+                flash("Your warble is still being posted.", "warning")
+                return redirect(f"/users/{g.user.id}")
+        else:
+            msg = Message(text=form.text.data)
+            msg.tags = MessageTag.extract(msg.text)
+            g.user.messages.append(msg)
+            db.session.commit()
+
+        get_trending().record(t.tag for t in msg.tags if t.kind == '#')
+        get_live().publish(g.user.id)
+        get_explore().append(msg)
+
+        return redirect(f"/users/{g.user.id}")
+
+    return render_template('messages/new.html', form=form)
+
+
+@bp.route('/messages/since')
+@redirect_if_missing
+def messages_since():
+    """Return the viewer's feed messages newer than `since_id`, as JSON.
+
+    Like {"messages": [{"id": "...", "html": "<li>..."}], "more": false},
+    newest first. Ids are strings, as they don't fit in a JS number.
+    "more" means there were more than LIVE_PAGE_SIZE; reload instead.
+    """
+
+    since_id = request.args.get('since_id', 0, type=int)
+    messages = projections.home_timeline_since(
+        feed_author_ids(g.user), since_id, LIVE_PAGE_SIZE + 1)
+    more = len(messages) > LIVE_PAGE_SIZE
+    messages = messages[:LIVE_PAGE_SIZE]
+    liked_ids = projections.liked_ids(g.user.id, messages)
+
+    return jsonify(
+        messages=[{'id': str(msg.id),
+                   'html': render_template('messages/item.html', msg=msg,
+                                           liked_ids=liked_ids)}
+                  for msg in messages],
+        more=more)
+
+
+@bp.route('/messages/stream')
+@redirect_if_missing
+def messages_stream():
+    """Stream server-sent "count" events: new messages after `since_id`.
+
+    Each event's data is like {"count": 3}. Streams end after
+    STREAM_SECONDS; the browser reconnects, recounting from the database.
+    """
+
+    since_id = request.args.get('since_id', 0, type=int)
+    author_ids = feed_author_ids(g.user)
+    count = Message.count_since(author_ids, since_id) if since_id else 0
+
+    broker = get_live()
+    sub = broker.subscribe(author_ids, count)
+    heartbeat = current_app.config['STREAM_HEARTBEAT_SECONDS']
+    lifetime = current_app.config['STREAM_SECONDS']
+
+    # idle streams mustn't hold on to a database connection
+    db.session.remove()
+
+    def events():
+        deadline = time.monotonic() + lifetime
+        try:
+            yield "retry: 5000\n\n"
+            while time.monotonic() < deadline:
+                if sub.wait(heartbeat):
+                    data = json.dumps({'count': sub.count})
+                    yield f"event: count\ndata: {data}\n\n"
+                else:
+                    yield ": keepalive\n\n"
+        finally:
+            broker.unsubscribe(sub)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no'})
+
+
+@bp.route('/messages/<int:message_id>', methods=["GET"])
+def messages_show(message_id):
+    """Show a message."""
+
+    msg = (get_entity_cache().get(Message, message_id)
+           or get_archive().get(message_id))
+    return render_template('messages/show.html', message=msg)
+
+
+@bp.route('/messages/<int:message_id>/delete', methods=["POST"])
+@redirect_if_missing
+def messages_destroy(message_id):
+    """Delete a message."""
+    
+    msg = Message.query.get(message_id)
+    if msg.user_id != g.user.id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+    db.session.delete(msg)
+    db.session.commit()
+    get_explore().delete(message_id)
+
+    return redirect(f"/users/{g.user.id}")
+
+
+##############################################################################
+# Hashtag routes:
+
+@bp.route('/tags')
+def tags_trending():
+    """Show the hashtags trending right now."""
+
+    return render_template('tags/index.html', tags=get_trending().top(20))
+
+
+@bp.route('/tags/<tag>')
+def tags_show(tag):
+    """Show messages with hashtag `tag`, newest first.
+
+    Pages by message id: pass the last id seen as `before` for the next page.
+    """
+
+    tag = tag.lower()
+    before = request.args.get('before', type=int)
+
+    query = (Message
+             .query
+             .join(MessageTag, MessageTag.message_id == Message.id)
+             .filter(MessageTag.kind == '#', MessageTag.tag == tag))
+    if before:
+        query = query.filter(MessageTag.message_id < before)
+
+    messages = (query
+                .order_by(MessageTag.message_id.desc())
+                .limit(TAG_PAGE_SIZE)
+                .all())
+    next_before = messages[-1].id if len(messages) == TAG_PAGE_SIZE else None
+
+    return render_template('tags/show.html', tag=tag, messages=messages,
+                           next_before=next_before)
+
+
+##############################################################################
+# Homepage and error pages
+
+
+@bp.route('/cache-stats')
+def cache_stats():
+    """Report this worker's entity cache hit ratios as JSON."""
+
+    return jsonify(get_entity_cache().stats())
+
+
+@bp.route('/explore')
+def explore():
+    """Show the newest messages from everyone, from memory."""
+
+    return render_template('explore.html', messages=get_explore().latest())
+
+
+@bp.route('/')
+def homepage():
+    """Show homepage:
+
+    - anon users: the newest messages from everyone
+    - logged in: 100 most recent messages of followed_users
+    """
+
+    if g.user:
+        messages = projections.home_timeline(feed_author_ids(g.user))
+
+        return render_template('home.html', messages=messages,
+                               liked_ids=projections.liked_ids(g.user.id,
+                                                               messages),
+                               recommendations=g.user.who_to_follow())
+
+    else:
+        return render_template('home-anon.html',
+                               messages=get_explore().latest(EXPLORE_PREVIEW))
+
+
+##############################################################################
+# Turn off all caching in Flask
+#   (useful for dev; in production, this kind of stuff is typically
+#   handled elsewhere)
+#
+# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+
+@bp.after_app_request
+def add_header(req):
+    """Add non-caching headers on every request."""
+
+    # content-addressed images are cacheable forever
+    if req.cache_control.immutable:
+        return req
+
+    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    req.headers["Pragma"] = "no-cache"
+    req.headers["Expires"] = "0"
+    req.headers['Cache-Control'] = 'public, max-age=0'
+    return req
\ No newline at end of file